@@ -1,4 +1,4 @@
-let empresaAtualId = null; let rolUsuario = null; let planoAtivo = ''; let rucAtual = null; let funcionarioId = null; let nomeFuncionario = ''; let productosGlobais = [];
+let empresaAtualId = null; let tokenSessao = null; let rolUsuario = null; let planoAtivo = ''; let rucAtual = null; let funcionarioId = null; let nomeFuncionario = ''; let productosGlobais = [];
 
 // Constantes de perfis RBAC
 const PERFIL_OWNER = 'admin';
@@ -11,32 +11,52 @@ let pixJaFoiConfirmado = false;
 let pixCopiaEColaAtual = "";
 
 // O MOTOR DO RADAR
+// O servidor empurra o status (SSE) a partir do webhook do Mercado Pago; polling só em navegador sem EventSource
+function pararRadarPix() {
+    if (radarPix && radarPix.close) radarPix.close(); else clearInterval(radarPix);
+    radarPix = null;
+}
+
+function tratarStatusPix(status) {
+    if (status === "approved") {
+        pararRadarPix();
+        showToast("✅ Pago Aprobado!");
+        fecharModalPix();
+        
+        document.getElementById('checkout-metodo').value = "Pix Confirmado";
+        pixJaFoiConfirmado = true;
+        confirmarVenta(); 
+    } else if (["rejected", "cancelled", "refunded", "charged_back"].includes(status)) {
+        pararRadarPix();
+        fecharModalPix();
+        showToast("❌ Pago PIX no aprobado (" + status + ")", "error");
+    }
+}
+
 function iniciarRadarPix(pagamentoId) {
-    clearInterval(radarPix); 
+    pararRadarPix();
+    if (window.EventSource) {
+        radarPix = new EventSource(`/status-pix/${pagamentoId}/eventos?empresa_id=${empresaAtualId}&token=${encodeURIComponent(tokenSessao || '')}`);
+        radarPix.onmessage = (evento) => tratarStatusPix(JSON.parse(evento.data).status);
+        return;
+    }
     radarPix = setInterval(async () => {
         try {
             const resposta = await fetch(`/status-pix/${pagamentoId}`, {
                 method: 'GET',
-                headers: { 'X-Empresa-ID': empresaAtualId.toString() }
+                headers: { 'X-Empresa-ID': empresaAtualId.toString(), ...getAuthHeaders() }
             });
             const dados = await resposta.json();
-            
-            if (dados.sucesso && dados.status === "approved") {
-                clearInterval(radarPix);
-                showToast("✅ Pago Aprobado!");
-                fecharModalPix();
-                
-                document.getElementById('checkout-metodo').value = "Pix Confirmado";
-                pixJaFoiConfirmado = true;
-                confirmarVenta(); 
-            }
+            if (dados.sucesso) tratarStatusPix(dados.status);
         } catch (erro) {
             console.log("Aguardando pagamento...");
         }
     }, 5000);
 }
 
-const getSaaSHeaders = (extraHeaders = {}) => { return { 'Content-Type': 'application/json', 'X-Empresa-ID': empresaAtualId ? empresaAtualId.toString() : "1", ...extraHeaders }; };
+// Token assinado do login: o servidor tira a empresa dele, não do X-Empresa-ID
+const getAuthHeaders = () => tokenSessao ? { 'Authorization': 'Bearer ' + tokenSessao } : {};
+const getSaaSHeaders = (extraHeaders = {}) => { return { 'Content-Type': 'application/json', 'X-Empresa-ID': empresaAtualId ? empresaAtualId.toString() : "1", ...getAuthHeaders(), ...extraHeaders }; };
     
 document.addEventListener("DOMContentLoaded", () => {
     const hoje = new Date();
@@ -90,7 +110,7 @@ async function fazerLogin() {
     try { 
         const res = await fetch('/api/login', { method: 'POST', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({ruc: ruc, senha: senha}) }); 
         if (res.ok) { 
-            const dados = await res.json(); empresaAtualId = dados.empresa_id; rolUsuario = dados.rol; planoAtivo = dados.plano || 'Inicial'; rucAtual = ruc; 
+            const dados = await res.json(); empresaAtualId = dados.empresa_id; tokenSessao = dados.token || null; rolUsuario = dados.rol; planoAtivo = dados.plano || 'Inicial'; rucAtual = ruc; 
             if (dados.funcionario_id) { 
                 funcionarioId = dados.funcionario_id; 
                 nomeFuncionario = dados.nome || ''; 
@@ -320,17 +340,17 @@ function abrirModalEditarEmpresa(id, planoAtual, valorAtual) {
     document.getElementById('modal-editar-empresa').classList.add('flex'); 
 }
 function fecharModalEditarEmpresa() { document.getElementById('modal-editar-empresa').classList.add('hidden'); document.getElementById('modal-editar-empresa').classList.remove('flex'); }
-async function salvarEdicaoEmpresa() { const id = document.getElementById('edit-empresa-id').value; const plano = document.getElementById('edit-plano').value; const valor = parseFloat(document.getElementById('edit-valor').value) || 0; try { const res = await fetch(`/super-admin/editar-empresa/${id}`, { method: 'PUT', headers: {'Content-Type': 'application/json'}, body: JSON.stringify({plano: plano, valor_mensalidade: valor}) }); if(res.ok) { showToast("✅ Plan actualizado."); fecharModalEditarEmpresa(); carregarEmpresasSaaS(); } else { showToast("❌ Error.", "error"); } } catch(e) { showToast("❌ Error.", "error"); } }
+async function salvarEdicaoEmpresa() { const id = document.getElementById('edit-empresa-id').value; const plano = document.getElementById('edit-plano').value; const valor = parseFloat(document.getElementById('edit-valor').value) || 0; try { const res = await fetch(`/super-admin/editar-empresa/${id}`, { method: 'PUT', headers: {'Content-Type': 'application/json', ...getAuthHeaders()}, body: JSON.stringify({plano: plano, valor_mensalidade: valor}) }); if(res.ok) { showToast("✅ Plan actualizado."); fecharModalEditarEmpresa(); carregarEmpresasSaaS(); } else { showToast("❌ Error.", "error"); } } catch(e) { showToast("❌ Error.", "error"); } }
 async function carregarEmpresasSaaS() { 
     try { 
-        const resMet = await fetch('/super-admin/metricas'); 
+        const resMet = await fetch('/super-admin/metricas', { headers: getAuthHeaders() }); 
         if (resMet.ok) { 
             const met = await resMet.json(); 
             document.getElementById('saas-mrr').innerText = met.mrr.toLocaleString('es-PY'); 
             document.getElementById('saas-ativos').innerText = met.clientes_ativos; 
             document.getElementById('saas-vencidos').innerText = met.clientes_vencidos; 
         } 
-        const res = await fetch('/super-admin/empresas'); 
+        const res = await fetch('/super-admin/empresas', { headers: getAuthHeaders() }); 
         if (res.ok) { 
             const empresas = await res.json(); 
             const tbody = document.getElementById('tabela-saas'); 
@@ -363,7 +383,7 @@ async function criarEmpresaSaaS() {
     try {
         const res = await fetch('/super-admin/criar-empresa', {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: { 'Content-Type': 'application/json', ...getAuthHeaders() },
             body: JSON.stringify({
                 nome,
                 ruc,
@@ -554,6 +574,11 @@ async function confirmarVenta() {
             textoResultado.textContent = '✅ Venta Registrada';
             textoResultado.classList.remove('text-green-600');
             textoResultado.classList.add('text-blue-600');
+        } else if (dados.status_sifen === 'PENDENTE') {
+            textoResultado.textContent = '✅ Factura Emitida · Enviando a la SET...';
+            textoResultado.classList.remove('text-blue-600');
+            textoResultado.classList.add('text-green-600');
+            acompanharStatusSifen(dados.cdc, textoResultado);
         } else {
             textoResultado.textContent = '✅ ¡Factura Aprobada!';
             textoResultado.classList.remove('text-blue-600');
@@ -582,6 +607,21 @@ async function confirmarVenta() {
     } catch(e) { showToast("❌ Error.", "error"); } finally { btn.disabled = false; } 
 }
 
+// O envio à SET acontece em segundo plano no servidor; aqui só acompanhamos o resultado
+async function acompanharStatusSifen(cdc, elemento, tentativas = 30) {
+    for (let i = 0; i < tentativas; i++) {
+        await new Promise(r => setTimeout(r, 2000));
+        if (ultimoCDCGerado !== cdc) return; // outra venda já está na tela
+        try {
+            const res = await fetch(`/status-sifen/${encodeURIComponent(cdc)}`, { headers: getSaaSHeaders() });
+            if (!res.ok) continue;
+            const st = await res.json();
+            if (st.status === 'APROBADO') { elemento.textContent = '✅ ¡Factura Aprobada!'; return; }
+            if (st.status === 'ERRO' || st.status === 'RECHAZADO') { elemento.textContent = '⚠️ Factura emitida · SET: ' + (st.mensagem_retorno || 'Error'); return; }
+        } catch(e) {}
+    }
+}
+
 function novaVenda() { document.getElementById('resultado').classList.add('hidden'); document.getElementById('btn-emitir').classList.remove('hidden'); document.getElementById('cliente').value = ''; descuentoPorcentaje = 0; productosCaixa = []; atualizarInterfaceCaixa(); }
 async function sincronizarFila() { if (filaContingencia.length === 0 || !navigator.onLine) return; let pendentes = [...filaContingencia]; filaContingencia = []; let sucesso = 0; for (let n of pendentes) { try { const res = await fetch('/emitir-nota', { method: 'POST', headers: getSaaSHeaders(), body: JSON.stringify(n) }); if (res.ok) sucesso++; else filaContingencia.push(n); } catch(e) { filaContingencia.push(n); } } localStorage.setItem('nube_fila', JSON.stringify(filaContingencia)); atualizarStatusConexao(); if(sucesso>0) showToast(`✅ ${sucesso} sincronizadas.`); }
 
@@ -726,17 +766,45 @@ async function carregarCierreCaja() {
     } catch(e) {}
 }
 
-async function carregarHistorico(busca="") { 
-    const i=document.getElementById('filtro-data-inicio-hist')?.value||''; 
-    const f=document.getElementById('filtro-data-fim-hist')?.value||''; 
-    try { 
-        const res=await fetch(`/listar-notas?busca=${busca}&inicio=${i}&fim=${f}`, {headers:getSaaSHeaders()}); 
-        const d=await res.json(); const tb=document.getElementById('tabela-historico'); tb.innerHTML=''; 
-        d.historico.forEach(n=>{ 
+// Paginação do histórico: o servidor devolve uma página e o id para buscar a próxima
+let historicoFiltro = '';
+let historicoProximoId = null;
+
+async function carregarHistorico(busca="", anexar=false) {
+    const i=document.getElementById('filtro-data-inicio-hist')?.value||'';
+    const f=document.getElementById('filtro-data-fim-hist')?.value||'';
+    if(!anexar) { historicoFiltro = `busca=${encodeURIComponent(busca)}&inicio=${i}&fim=${f}`; historicoProximoId = null; }
+    try {
+        const cursorPagina = anexar && historicoProximoId ? `&after_id=${historicoProximoId}` : '';
+        const res=await fetch(`/listar-notas?${historicoFiltro}${cursorPagina}`, {headers:getSaaSHeaders()});
+        const d=await res.json(); const tb=document.getElementById('tabela-historico'); if(!anexar) tb.innerHTML='';
+        historicoProximoId = d.proximo_after_id;
+        const btnMais = document.getElementById('btn-mais-historico');
+        if(btnMais) btnMais.classList.toggle('hidden', !historicoProximoId);
+        if(!anexar) contarHistorico();
+        d.historico.forEach(n=>{
             tb.innerHTML+=`<tr class="border-b border-slate-700"><td class="p-4 text-xs font-mono text-gray-400">${n.cdc.substring(0,20)}...</td><td class="p-4 text-white">${n.nome_cliente}</td><td class="p-4 text-right text-brand-accent">Gs. ${n.valor_total.toLocaleString('es-PY')}</td><td class="p-4">${n.metodo_pago}</td><td class="p-4 flex gap-2"><button onclick="imprimirTicketHistorico('${n.cdc}')" class="bg-slate-700 hover:bg-slate-600 px-3 py-1.5 rounded-lg text-xs font-bold text-white shadow-sm transition">🖨️ Ticket</button><a href="${n.link_pdf}" target="_blank" class="bg-slate-700 hover:bg-slate-600 px-3 py-1.5 rounded-lg text-xs font-bold text-white shadow-sm transition">📄 PDF</a></td></tr>`; 
         }); 
     } catch(e){} 
 } 
+async function contarHistorico() {
+    const el = document.getElementById('contador-historico');
+    if(!el) return;
+    try {
+        const res = await fetch(`/contar-notas?${historicoFiltro}`, {headers:getSaaSHeaders()});
+        const d = await res.json();
+        el.innerText = `${d.total.toLocaleString('es-PY')} notas`;
+    } catch(e){}
+}
+// Exportação gerada no servidor: o navegador baixa direto pelo link, sem montar o arquivo em memória
+function exportarDoServidor(tipo, formato='csv', sufixoFiltro='') {
+    const i = sufixoFiltro ? (document.getElementById(`filtro-data-inicio-${sufixoFiltro}`)?.value || '') : '';
+    const f = sufixoFiltro ? (document.getElementById(`filtro-data-fim-${sufixoFiltro}`)?.value || '') : '';
+    const link = document.createElement('a');
+    link.href = `/exportar/${tipo}?formato=${formato}&inicio=${i}&fim=${f}&empresa_id=${empresaAtualId || 1}` + (tokenSessao ? `&token=${encodeURIComponent(tokenSessao)}` : '');
+    link.click();
+}
+function carregarMaisHistorico() { if(historicoProximoId) carregarHistorico('', true); }
 function buscarNotas() { carregarHistorico(document.getElementById('busca').value); }
 
 // Função auxiliar para aguardar elemento estar visível
@@ -954,7 +1022,7 @@ async function salvarConfiguracao() {
 
         const resposta = await fetch('/salvar-configuracao', {
             method: 'POST',
-            headers: {'X-Empresa-ID': empresaAtualId.toString()},
+            headers: {'X-Empresa-ID': empresaAtualId.toString(), ...getAuthHeaders()},
             body: f
         }); 
 
@@ -972,7 +1040,7 @@ async function salvarConfiguracao() {
 async function alterarAmbienteSifen() { await fetch('/alternar-ambiente',{method:'POST',headers:getSaaSHeaders(),body:JSON.stringify({ambiente:document.getElementById('conf-ambiente').value})}); }
 
 
-async function fazerUploadCertificado() { const file=document.getElementById('arquivo-cert').files[0]; if(file){ const f=new FormData(); f.append('arquivo',file); await fetch('/upload-certificado',{method:'POST',headers:{'X-Empresa-ID':empresaAtualId.toString()},body:f}); showToast("✅ Subido"); } }
+async function fazerUploadCertificado() { const file=document.getElementById('arquivo-cert').files[0]; if(file){ const f=new FormData(); f.append('arquivo',file); await fetch('/upload-certificado',{method:'POST',headers:{'X-Empresa-ID':empresaAtualId.toString(), ...getAuthHeaders()},body:f}); showToast("✅ Subido"); } }
 async function carregarStockTake() { await carregarEstoque(); await carregarCategorias(); await carregarProveedores(); filtrarStockTake(); } function filtrarStockTake() {
     const texto = document.getElementById('busca-st').value.toLowerCase();
     const categoria = document.getElementById('stocktake-categoria').value;
@@ -1398,7 +1466,7 @@ function abrirModalPix(valorReaisEstimado) {
 }
 
 function fecharModalPix() {
-    clearInterval(radarPix);
+    pararRadarPix();
     document.getElementById('modal-pix').classList.add('hidden');
     document.getElementById('modal-pix').classList.remove('flex');
 }
@@ -1420,7 +1488,8 @@ async function gerarPixNaTela(valorGuaranis) {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
-                'X-Empresa-ID': empresaAtualId.toString()
+                'X-Empresa-ID': empresaAtualId.toString(),
+                ...getAuthHeaders()
             },
             body: JSON.stringify({ valor_guaranis: parseFloat(valorGuaranis) })
         });
@@ -1436,6 +1505,7 @@ async function gerarPixNaTela(valorGuaranis) {
 
             document.getElementById('pix-valor-reais').innerText = dados.valor_reais.toFixed(2).replace('.', ',');
             pixCopiaEColaAtual = dados.copia_cola;
+            if (dados.taxa_estimada) showToast("⚠️ Cotización BRL/PYG estimada, confirme el valor con el cliente");
             
             iniciarRadarPix(dados.id_pagamento_mp);
 
@@ -1458,7 +1528,7 @@ async function gerarFaturaSaaS(empresaId) {
     if (!confirm("¿Generar factura de mensualidad para esta empresa? (Plazo: 5 días)")) return;
     
     try {
-        const res = await fetch(`/super-admin/gerar-fatura/${empresaId}`, { method: 'POST' });
+        const res = await fetch(`/super-admin/gerar-fatura/${empresaId}`, { method: 'POST', headers: getAuthHeaders() });
         const dados = await res.json();
         
         if (res.ok && dados.sucesso) {
@@ -1474,7 +1544,7 @@ async function gerarFaturaSaaS(empresaId) {
 
 async function carregarFaturasSaaS() {
     try {
-        const res = await fetch('/super-admin/faturas');
+        const res = await fetch('/super-admin/faturas', { headers: getAuthHeaders() });
         if (res.ok) {
             const faturas = await res.json();
             const tbody = document.getElementById('tabela-faturas-saas');
@@ -1512,7 +1582,7 @@ async function aprovarPagamentoSaaS(faturaId) {
     if (!confirm("¿Confirmar que recibiste la transferencia SIPAP en tu cuenta bancaria?")) return;
     
     try {
-        const res = await fetch(`/super-admin/faturas/${faturaId}/pagar`, { method: 'PUT' });
+        const res = await fetch(`/super-admin/faturas/${faturaId}/pagar`, { method: 'PUT', headers: getAuthHeaders() });
         if (res.ok) {
             showToast("✅ Pago Aprobado y registrado!");
             carregarFaturasSaaS(); // Atualiza a tabela na hora
@@ -0,0 +1,150 @@
+import os
+import time
+import hashlib
+import tempfile
+from urllib.parse import quote, unquote
+
+# Onde os PDFs ficam: "local" (disco, padrão) ou "s3" (qualquer API compatível: AWS, MinIO, R2...)
+PDF_ARMAZENAMENTO = os.environ.get("PDF_ARMAZENAMENTO", "local")
+# Nome diferente do módulo cache_pdf.py para a pasta de dados não se confundir com o código
+PDF_DIR = os.environ.get("PDF_CACHE_DIR", "pdf_armazenados")
+PDF_S3_BUCKET = os.environ.get("PDF_S3_BUCKET", "")
+PDF_S3_PREFIXO = os.environ.get("PDF_S3_PREFIXO", "pdf/")
+# Para MinIO / servidor S3 local nos testes; vazio usa a AWS
+PDF_S3_ENDPOINT = os.environ.get("PDF_S3_ENDPOINT") or None
+
+TAMANHO_PEDACO = 64 * 1024
+
+
+class ArmazenamentoLocal:
+    """
+    Arquivos em disco em subpastas pelo hash da chave (ab/cd/...), para nenhuma pasta
+    passar de alguns milhares de arquivos. O nome do arquivo é a chave codificada.
+    """
+
+    def __init__(self, raiz=PDF_DIR):
+        self.raiz = raiz
+        os.makedirs(raiz, exist_ok=True)
+
+    def _caminho(self, chave):
+        h = hashlib.sha256(chave.encode("utf-8")).hexdigest()
+        return os.path.join(self.raiz, h[:2], h[2:4], quote(chave, safe=""))
+
+    def gravar(self, chave, conteudo):
+        caminho = self._caminho(chave)
+        pasta = os.path.dirname(caminho)
+        os.makedirs(pasta, exist_ok=True)
+        # Temporário na mesma pasta + rename: leitores nunca veem o arquivo pela metade
+        fd, temporario = tempfile.mkstemp(dir=pasta, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(conteudo)
+            os.replace(temporario, caminho)
+        except BaseException:
+            if os.path.exists(temporario): os.remove(temporario)
+            raise
+
+    def tamanho(self, chave):
+        """Tamanho em bytes, ou None se a chave não existe."""
+        try:
+            return os.path.getsize(self._caminho(chave))
+        except FileNotFoundError:
+            return None
+
+    def ler(self, chave, inicio=0, fim=None):
+        """Gera os bytes de inicio até fim (inclusive) em pedaços."""
+        with open(self._caminho(chave), "rb") as f:
+            f.seek(inicio)
+            restante = None if fim is None else fim - inicio + 1
+            while restante is None or restante > 0:
+                pedaco = f.read(TAMANHO_PEDACO if restante is None else min(TAMANHO_PEDACO, restante))
+                if not pedaco: break
+                if restante is not None: restante -= len(pedaco)
+                yield pedaco
+
+    def remover(self, chave):
+        try:
+            os.remove(self._caminho(chave))
+        except FileNotFoundError:
+            pass
+
+    def tocar(self, chave):
+        """Marca o uso (mtime), para a ordem de despejo sobreviver a um restart."""
+        agora = time.time()
+        try:
+            os.utime(self._caminho(chave), (agora, agora))
+        except FileNotFoundError:
+            pass
+
+    def listar(self):
+        """(chave, tamanho, modificado_em) de tudo o que está armazenado."""
+        for pasta, _, arquivos in os.walk(self.raiz):
+            for nome in arquivos:
+                if nome.endswith(".tmp"): continue
+                info = os.stat(os.path.join(pasta, nome))
+                yield unquote(nome), info.st_size, info.st_mtime
+
+
+class ArmazenamentoS3:
+    """Mesmo contrato do ArmazenamentoLocal sobre um bucket S3 (boto3 só é exigido se usado)."""
+
+    def __init__(self, bucket=PDF_S3_BUCKET, prefixo=PDF_S3_PREFIXO, endpoint_url=PDF_S3_ENDPOINT):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("PDF_ARMAZENAMENTO=s3 requiere el paquete boto3")
+        if not bucket:
+            raise RuntimeError("PDF_ARMAZENAMENTO=s3 requiere PDF_S3_BUCKET")
+        self.bucket = bucket
+        self.prefixo = prefixo
+        self.s3 = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _chave(self, chave):
+        return self.prefixo + chave
+
+    def gravar(self, chave, conteudo):
+        # PUT no S3 já é atômico: o objeto só aparece completo
+        self.s3.put_object(Bucket=self.bucket, Key=self._chave(chave), Body=conteudo, ContentType="application/pdf")
+
+    def tamanho(self, chave):
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=self._chave(chave))["ContentLength"]
+        except self.s3.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def ler(self, chave, inicio=0, fim=None):
+        intervalo = f"bytes={inicio}-{'' if fim is None else fim}"
+        corpo = self.s3.get_object(Bucket=self.bucket, Key=self._chave(chave), Range=intervalo)["Body"]
+        try:
+            yield from corpo.iter_chunks(TAMANHO_PEDACO)
+        finally:
+            corpo.close()
+
+    def remover(self, chave):
+        self.s3.delete_object(Bucket=self.bucket, Key=self._chave(chave))
+
+    def tocar(self, chave):
+        # Reescrever o objeto só para atualizar a data não compensa; a ordem de uso fica em memória
+        pass
+
+    def listar(self):
+        paginador = self.s3.get_paginator("list_objects_v2")
+        for pagina in paginador.paginate(Bucket=self.bucket, Prefix=self.prefixo):
+            for obj in pagina.get("Contents", []):
+                yield obj["Key"][len(self.prefixo):], obj["Size"], obj["LastModified"].timestamp()
+
+
+BACKENDS = {"local": ArmazenamentoLocal, "s3": ArmazenamentoS3}
+
+_armazenamento = None
+
+
+def obter_armazenamento():
+    global _armazenamento
+    if _armazenamento is None:
+        if PDF_ARMAZENAMENTO not in BACKENDS:
+            raise RuntimeError(f"PDF_ARMAZENAMENTO desconocido: {PDF_ARMAZENAMENTO}")
+        _armazenamento = BACKENDS[PDF_ARMAZENAMENTO]()
+    return _armazenamento
@@ -1,43 +1,127 @@
-from cryptography.hazmat.primitives.serialization import pkcs12
-from cryptography.hazmat.primitives import serialization
 from signxml import XMLSigner, methods
 from lxml import etree
 import os
+import hashlib
+import threading
+import weakref
+from cryptography.hazmat.primitives import serialization
+from cache_certificados import obter_material
+from pool_cpu import pool_cpu, PoolCpuOcupado
 
-def carregar_certificado_p12(caminho_p12, senha):
-    """Abre o ficheiro .p12 e extrai a Chave Privada e o Certificado Público."""
-    with open(caminho_p12, "rb") as f:
-        p12_data = f.read()
-    
-    # Extrai os dados usando a password fornecida pelo lojista
-    private_key, certificate, additional_certificates = pkcs12.load_key_and_certificates(
-        p12_data, senha.encode()
-    )
-    return private_key, certificate
-
-def assinar_documento(xml_string, caminho_p12, senha):
-    """Aplica a assinatura XMLDSig Enveloped exigida pela SIFEN."""
-    try:
-        private_key, cert = carregar_certificado_p12(caminho_p12, senha)
-        
-        # Converte o XML de texto para um objeto manipulável
-        root = etree.fromstring(xml_string.encode('utf-8'))
-        
-        # Prepara as chaves no formato PEM
-        cert_pem = cert.public_bytes(serialization.Encoding.PEM)
-        key_pem = private_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=serialization.NoEncryption()
-        )
-        
-        # Assinatura Enveloped (SHA256) conforme o manual técnico da DNIT
-        signer = XMLSigner(method=methods.enveloped, signature_algorithm="rsa-sha256", digest_algorithm="sha256")
-        signed_root = signer.sign(root, key=key_pem, cert=cert_pem)
-        
-        # Devolve o XML final já carimbado
+# Lotes menores que o limiar são assinados aqui mesmo em assinar_varios
+ASSINATURA_LIMIAR_POOL = int(os.environ.get("ASSINATURA_LIMIAR_POOL", "8"))
+# Documentos avulsos (venda no caixa) também vão para o pool de CPU; 0 assina na thread da requisição
+ASSINATURA_AVULSA_NO_POOL = os.environ.get("ASSINATURA_AVULSA_NO_POOL", "1") == "1"
+
+def carregar_certificado_p12(caminho_p12, senha, empresa_id=None):
+    """Chave Privada e Certificado Público do .p12 (decodificado uma vez e mantido em cache)."""
+    material = obter_material(caminho_p12, senha, empresa_id)
+    return material.private_key, material.certificate
+
+class AssinadorSifen:
+    """
+    Assinador de uma empresa: guarda a chave já desserializada e a cadeia de certificados,
+    e assina quantos documentos forem precisos sem voltar ao PEM.
+    """
+
+    def __init__(self, private_key, cadeia_pem):
+        self.private_key = private_key
+        self.cadeia = [c.decode() if isinstance(c, bytes) else c for c in cadeia_pem]
+        # XMLSigner guarda estado durante o sign(); um por thread
+        self._local = threading.local()
+        self._chave_pem = None
+        self._impressao = None
+
+    def _signer(self):
+        signer = getattr(self._local, "signer", None)
+        if signer is None:
+            # Assinatura Enveloped (SHA256) conforme o manual técnico da DNIT
+            signer = XMLSigner(method=methods.enveloped, signature_algorithm="rsa-sha256", digest_algorithm="sha256")
+            self._local.signer = signer
+        return signer
+
+    def assinar(self, xml):
+        """`xml` pode ser o elemento lxml de gerador_xml.construir_de_sifen (assinado direto) ou texto."""
+        root = xml if isinstance(xml, etree._Element) else etree.fromstring(xml.encode('utf-8'))
+        signed_root = self._signer().sign(root, key=self.private_key, cert=self.cadeia)
         return etree.tostring(signed_root, encoding='unicode')
-        
+
+    def _tarefa(self, docs):
+        """Argumento de _assinar_no_processo para uma lista de documentos."""
+        if self._chave_pem is None:
+            # Chaves não são serializáveis por pickle: os processos recebem o PEM e desserializam uma vez cada
+            self._chave_pem = self.private_key.private_bytes(
+                encoding=serialization.Encoding.PEM,
+                format=serialization.PrivateFormat.PKCS8,
+                encryption_algorithm=serialization.NoEncryption()
+            )
+            self._impressao = hashlib.sha256(self._chave_pem).hexdigest()
+        # Elementos lxml não atravessam processos; vão como texto
+        textos = [etree.tostring(d, encoding='unicode') if isinstance(d, etree._Element) else d for d in docs]
+        return (self._impressao, self._chave_pem, self.cadeia, textos)
+
+    def assinar_no_pool(self, xml):
+        """Como assinar(), mas o RSA + C14N roda no pool de CPU e não disputa o GIL com as outras requisições."""
+        if not pool_cpu.ativo:
+            return self.assinar(xml)
+        return pool_cpu.executar(_assinar_no_processo, self._tarefa([xml]))[0]
+
+    def assinar_varios(self, docs):
+        """
+        Assina uma lista de documentos (reprocessamento de contingência, lotes).
+        Acima do limiar o trabalho (RSA-SHA256 + C14N) é dividido entre os processos do pool de CPU.
+        """
+        docs = list(docs)
+        if len(docs) < ASSINATURA_LIMIAR_POOL or pool_cpu.processos <= 1:
+            return [self.assinar(d) for d in docs]
+        tamanho = max(1, len(docs) // (pool_cpu.processos * 2))
+        partes = [docs[i:i + tamanho] for i in range(0, len(docs), tamanho)]
+        try:
+            futuros = [pool_cpu.submeter(_assinar_no_processo, self._tarefa(p)) for p in partes]
+        except PoolCpuOcupado:
+            # Lote é trabalho de fundo: com o pool cheio de vendas, assina aqui mesmo
+            return [self.assinar(d) for d in docs]
+        return [assinado for f in futuros for assinado in f.result()]
+
+# Um assinador por material de certificado; sai junto quando o cache de certificados o descarta
+_assinadores = weakref.WeakKeyDictionary()
+_assinadores_lock = threading.Lock()
+
+def obter_assinador(caminho_p12, senha, empresa_id=None):
+    material = obter_material(caminho_p12, senha, empresa_id)
+    with _assinadores_lock:
+        assinador = _assinadores.get(material)
+        if assinador is None:
+            assinador = AssinadorSifen(material.private_key, material.cadeia_pem)
+            _assinadores[material] = assinador
+        return assinador
+
+# Dentro de cada processo do pool: a chave é desserializada uma vez por empresa
+_assinadores_processo = {}
+
+def _assinar_no_processo(tarefa):
+    impressao, chave_pem, cadeia, textos = tarefa
+    assinador = _assinadores_processo.get(impressao)
+    if assinador is None:
+        chave = serialization.load_pem_private_key(chave_pem, password=None)
+        assinador = AssinadorSifen(chave, cadeia)
+        _assinadores_processo[impressao] = assinador
+    return [assinador.assinar(xml) for xml in textos]
+
+def assinar_documento(xml, caminho_p12, senha, empresa_id=None):
+    """
+    Aplica a assinatura XMLDSig Enveloped exigida pela SIFEN.
+    `xml` pode ser o elemento lxml de gerador_xml.construir_de_sifen (assinado direto) ou texto.
+    """
+    try:
+        assinador = obter_assinador(caminho_p12, senha, empresa_id)
+        return assinador.assinar_no_pool(xml) if ASSINATURA_AVULSA_NO_POOL else assinador.assinar(xml)
+    except PoolCpuOcupado:
+        raise
     except Exception as e:
         print(f"Erro na assinatura digital: {e}")
-        raise e
\ No newline at end of file
+        raise e
+
+def assinar_documentos(docs, caminho_p12, senha, empresa_id=None):
+    """Versão em lote de assinar_documento (ver AssinadorSifen.assinar_varios)."""
+    return obter_assinador(caminho_p12, senha, empresa_id).assinar_varios(docs)
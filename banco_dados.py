@@ -1,5 +1,6 @@
 ﻿import sys
 import hashlib
+import hmac
 import traceback
 import os
 import json
@@ -7,280 +8,579 @@ import psycopg2
 import hashlib
 import sys
 from datetime import date, timedelta
+from psycopg2.extras import execute_values
+from pool_banco import obter_conexao, metricas_pool
+from cache_empresas import cache_empresas, CANAL_EMPRESAS
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
-def get_conexao():
-    return psycopg2.connect(DATABASE_URL)
-
 def hash_senha(senha):
     """Retorna hash SHA256 da senha"""
     return hashlib.sha256(senha.encode()).hexdigest()
 
-def inicializar_banco():
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-
+def _migracao_nota_itens(cursor):
+    """Itens das notas em tabela própria, preenchida a partir do JSON das notas já existentes"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS empresas (
+        CREATE TABLE IF NOT EXISTS nota_itens (
             id SERIAL PRIMARY KEY,
-            nome_empresa TEXT,
-            ruc TEXT UNIQUE,
-            endereco TEXT,
-            senha_certificado TEXT,
-            caminho_certificado TEXT,
-            ambiente_sifen TEXT DEFAULT 'testes',
-            senha_admin TEXT DEFAULT 'admin123',
-            senha_caixa TEXT DEFAULT 'caja123',
-            plano TEXT DEFAULT 'Inicial',
-            status_assinatura TEXT DEFAULT 'Activo',
-            data_vencimento DATE,
-            valor_mensalidade REAL DEFAULT 0,
-            csc TEXT DEFAULT ''
+            nota_id INTEGER NOT NULL REFERENCES notas(id) ON DELETE CASCADE,
+            codigo_barras TEXT,
+            descricao TEXT,
+            quantidade INTEGER DEFAULT 0,
+            preco_unitario REAL DEFAULT 0,
+            preco_custo REAL DEFAULT 0
         )
     ''')
-
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_nota_itens_nota ON nota_itens (nota_id)")
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS funcionarios (
-            id SERIAL PRIMARY KEY,
-            empresa_id INTEGER NOT NULL REFERENCES empresas(id) ON DELETE CASCADE,
-            nome TEXT NOT NULL,
-            email TEXT UNIQUE,
-            senha_hash TEXT NOT NULL,
-            rol TEXT NOT NULL CHECK (rol IN ('cajero', 'gerente')),
-            ativo BOOLEAN DEFAULT TRUE,
-            data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
+        INSERT INTO nota_itens (nota_id, codigo_barras, descricao, quantidade, preco_unitario, preco_custo)
+        SELECT n.id,
+               i->>'codigo_barras',
+               i->>'descricao',
+               COALESCE(NULLIF(i->>'quantidade', '')::numeric, 0)::integer,
+               COALESCE(NULLIF(i->>'preco_unitario', '')::numeric, 0),
+               COALESCE(NULLIF(i->>'preco_custo', '')::numeric, 0)
+        FROM notas n
+        CROSS JOIN LATERAL json_array_elements(n.itens::json) AS i
+        WHERE n.itens LIKE '[%'
+          AND NOT EXISTS (SELECT 1 FROM nota_itens ni WHERE ni.nota_id = n.id)
     ''')
-
+    print(f"[MIGRACAO] nota_itens: {cursor.rowcount} itens copiados do JSON das notas.")
+
+def _migracao_indices_multiempresa(cursor):
+    """Índices compostos/parciais para os filtros por empresa + período usados em toda requisição"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_empresa_data ON notas (empresa_id, data_emissao)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_empresa_cdc ON notas (empresa_id, cdc)")
+    # Só existe uma sessão aberta por empresa; o índice parcial fica minúsculo
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_caixa_sessoes_aberto ON caixa_sessoes (empresa_id, id DESC) WHERE status = 'ABERTO'")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_caixa_mov_empresa_tipo_data ON caixa_movimentacoes (empresa_id, tipo, data)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auditorias_empresa_data ON auditorias (empresa_id, data)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_auditorias_itens_auditoria ON auditorias_itens (auditoria_id)")
+
+def _migracao_resumo_vendas(cursor):
+    """Resumo diário de vendas por empresa, mantido junto com cada nota emitida"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS notas (
-            id SERIAL PRIMARY KEY,
-            empresa_id INTEGER DEFAULT 1,
-            ruc_emissor TEXT,
-            nome_cliente TEXT,
-            valor_total REAL,
-            cdc TEXT,
-            itens TEXT,
-            data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            link_pdf TEXT DEFAULT '',
-            link_qrcode TEXT DEFAULT '',
-            metodo_pago TEXT DEFAULT 'Efectivo',
-            caixa_id INTEGER DEFAULT 0
+        CREATE TABLE IF NOT EXISTS resumo_vendas_dia (
+            empresa_id INTEGER NOT NULL,
+            dia DATE NOT NULL,
+            faturamento REAL DEFAULT 0,
+            tickets INTEGER DEFAULT 0,
+            devolucoes REAL DEFAULT 0,
+            notas_credito INTEGER DEFAULT 0,
+            PRIMARY KEY (empresa_id, dia)
         )
     ''')
-
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS produtos (
-            codigo_barras TEXT,
-            empresa_id INTEGER DEFAULT 1,
-            descricao TEXT NOT NULL,
-            categoria TEXT,
-            subcategoria TEXT,
-            preco_custo REAL,
-            preco_venda REAL NOT NULL,
+        CREATE TABLE IF NOT EXISTS resumo_vendas_dia_produtos (
+            empresa_id INTEGER NOT NULL,
+            dia DATE NOT NULL,
+            nome TEXT NOT NULL,
             quantidade INTEGER DEFAULT 0,
-            codigo_proveedor TEXT DEFAULT '',
-            PRIMARY KEY (empresa_id, codigo_barras)
+            receita REAL DEFAULT 0,
+            PRIMARY KEY (empresa_id, dia, nome)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS resumo_vendas_dia_pagamentos (
+            empresa_id INTEGER NOT NULL,
+            dia DATE NOT NULL,
+            metodo_pago TEXT NOT NULL,
+            total REAL DEFAULT 0,
+            tickets INTEGER DEFAULT 0,
+            PRIMARY KEY (empresa_id, dia, metodo_pago)
         )
     ''')
+    recalcular_resumo_vendas(cursor)
+
+def _migracao_busca_notas(cursor):
+    """Índices da busca do histórico: prefixo de CDC e trigramas no nome do cliente"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_empresa_cdc_prefixo ON notas (empresa_id, cdc text_pattern_ops)")
+    # pg_trgm pode não estar liberado para o usuário do banco; sem ele a busca por cliente só fica sem índice
+    cursor.execute("SAVEPOINT busca_trgm")
+    try:
+        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_cliente_trgm ON notas USING gin (nome_cliente gin_trgm_ops)")
+        cursor.execute("RELEASE SAVEPOINT busca_trgm")
+    except psycopg2.Error as e:
+        cursor.execute("ROLLBACK TO SAVEPOINT busca_trgm")
+        print(f"[MIGRACAO] pg_trgm indisponível, busca por cliente sem índice: {e}")
 
+def _migracao_fila_sifen(cursor):
+    """Outbox dos documentos assinados à espera de envio para a SIFEN"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS categorias (
+        CREATE TABLE IF NOT EXISTS sifen_envios (
             id SERIAL PRIMARY KEY,
-            empresa_id INTEGER DEFAULT 1,
-            nome TEXT NOT NULL,
-            UNIQUE (empresa_id, nome)
+            empresa_id INTEGER NOT NULL,
+            cdc TEXT NOT NULL,
+            tipo_documento TEXT DEFAULT 'FACTURA',
+            ambiente TEXT DEFAULT 'testes',
+            xml_assinado TEXT NOT NULL,
+            status TEXT DEFAULT 'PENDENTE',
+            tentativas INTEGER DEFAULT 0,
+            proxima_tentativa TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            codigo_retorno TEXT,
+            mensagem_retorno TEXT,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sifen_envios_empresa_cdc ON sifen_envios (empresa_id, cdc)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sifen_envios_fila ON sifen_envios (proxima_tentativa) WHERE status IN ('PENDENTE', 'ENVIANDO')")
 
+def _migracao_lotes_sifen(cursor):
+    """Lotes assíncronos (rEnvioLote) e o vínculo de cada envio com o seu lote"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS caixa_sessoes (
+        CREATE TABLE IF NOT EXISTS sifen_lotes (
             id SERIAL PRIMARY KEY,
-            empresa_id INTEGER DEFAULT 1,
-            data_abertura TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            data_fechamento TIMESTAMP,
-            valor_abertura REAL DEFAULT 0,
-            valor_fechamento REAL,
-            status TEXT DEFAULT 'ABERTO'
+            empresa_id INTEGER NOT NULL,
+            ambiente TEXT DEFAULT 'testes',
+            protocolo TEXT,
+            status TEXT DEFAULT 'ENVIADO',
+            consultas INTEGER DEFAULT 0,
+            proxima_consulta TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            mensagem_retorno TEXT,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sifen_lotes_consulta ON sifen_lotes (proxima_consulta) WHERE status = 'ENVIADO'")
+    cursor.execute("ALTER TABLE sifen_envios ADD COLUMN IF NOT EXISTS lote_id INTEGER")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_sifen_envios_lote ON sifen_envios (lote_id) WHERE lote_id IS NOT NULL")
 
+def _migracao_sequencias_documentos(cursor):
+    """Numeração dos documentos por empresa, estabelecimento, ponto de expedição e tipo"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS caixa_movimentacoes (
-            id SERIAL PRIMARY KEY,
-            empresa_id INTEGER DEFAULT 1,
-            caixa_id INTEGER,
-            tipo TEXT,
-            valor REAL,
-            motivo TEXT,
-            data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        CREATE TABLE IF NOT EXISTS sequencias_documentos (
+            empresa_id INTEGER NOT NULL,
+            estab TEXT NOT NULL,
+            pex TEXT NOT NULL,
+            tipo_doc TEXT NOT NULL,
+            proximo BIGINT NOT NULL DEFAULT 1,
+            PRIMARY KEY (empresa_id, estab, pex, tipo_doc)
         )
     ''')
 
+def _migracao_pagamentos_pix(cursor):
+    """Cobranças PIX geradas, com a cotação BRL/PYG usada em cada uma"""
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS proveedores (
+        CREATE TABLE IF NOT EXISTS pagamentos_pix (
             id SERIAL PRIMARY KEY,
-            empresa_id INTEGER DEFAULT 1,
-            nome TEXT NOT NULL,
-            ruc TEXT,
-            telefone TEXT,
-            email TEXT,
-            endereco TEXT,
-            UNIQUE(empresa_id, ruc)
+            empresa_id INTEGER NOT NULL,
+            pagamento_id TEXT NOT NULL UNIQUE,
+            valor_guaranis REAL NOT NULL,
+            valor_reais REAL NOT NULL,
+            taxa_cambio REAL NOT NULL,
+            fonte_taxa TEXT,
+            taxa_obtida_em TIMESTAMP,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_pagamentos_pix_empresa ON pagamentos_pix (empresa_id, criado_em)")
+
+def _migracao_status_pix(cursor):
+    """Status do pagamento PIX gravado pelo webhook do Mercado Pago"""
+    cursor.execute("ALTER TABLE pagamentos_pix ADD COLUMN IF NOT EXISTS status TEXT DEFAULT 'pending'")
+    cursor.execute("ALTER TABLE pagamentos_pix ADD COLUMN IF NOT EXISTS status_atualizado_em TIMESTAMP")
+
+def _migracao_paginacao_notas(cursor):
+    """Índice da paginação por chave do histórico (empresa_id = ? AND id < ? ORDER BY id DESC)"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_empresa_id_desc ON notas (empresa_id, id DESC)")
+
+# (tabela, coluna do CDC) de cada tipo de documento emitido
+TABELAS_CDC = [
+    ("notas", "cdc"),
+    ("notas_credito", "cdc_novo"),
+    ("notas_remision", "cdc"),
+    ("autofacturas", "cdc"),
+]
+
+def _migracao_cdc_unico(cursor):
+    """CDC único por empresa em cada tipo de documento"""
+    for tabela, coluna in TABELAS_CDC:
+        # CDCs aleatórios antigos (demo/uso interno) podem ter repetido: os repetidos ganham sufixo
+        cursor.execute(f'''
+            UPDATE {tabela} SET {coluna} = {coluna} || '-DUP' || id
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, ROW_NUMBER() OVER (PARTITION BY empresa_id, {coluna} ORDER BY id) AS ordem
+                    FROM {tabela} WHERE {coluna} IS NOT NULL AND {coluna} <> ''
+                ) d WHERE d.ordem > 1
+            )
+        ''')
+        if cursor.rowcount:
+            print(f"[MIGRACAO] {tabela}: {cursor.rowcount} CDCs duplicados renomeados.")
+        cursor.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS uq_{tabela}_empresa_cdc ON {tabela} (empresa_id, {coluna}) WHERE {coluna} IS NOT NULL AND {coluna} <> ''")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_notas_credito_referencia ON notas_credito (empresa_id, cdc_referencia)")
+    # Coberto pelo índice único
+    cursor.execute("DROP INDEX IF EXISTS idx_notas_empresa_cdc")
+
+# (versão, nome, função) - aplicadas em ordem, uma única vez por banco
+MIGRACOES = [
+    (1, "nota_itens", _migracao_nota_itens),
+    (2, "indices_multiempresa", _migracao_indices_multiempresa),
+    (3, "resumo_vendas", _migracao_resumo_vendas),
+    (4, "busca_notas", _migracao_busca_notas),
+    (5, "fila_sifen", _migracao_fila_sifen),
+    (6, "lotes_sifen", _migracao_lotes_sifen),
+    (7, "sequencias_documentos", _migracao_sequencias_documentos),
+    (8, "cdc_unico", _migracao_cdc_unico),
+    (9, "pagamentos_pix", _migracao_pagamentos_pix),
+    (10, "status_pix", _migracao_status_pix),
+    (11, "paginacao_notas", _migracao_paginacao_notas),
+]
+
+def aplicar_migracoes(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migracoes (
+            versao INTEGER PRIMARY KEY,
+            nome TEXT,
+            aplicada_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
+    # Vários workers sobem ao mesmo tempo: só um aplica, os outros esperam o commit
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext('schema_migracoes'))")
+    cursor.execute("SELECT versao FROM schema_migracoes")
+    aplicadas = {l[0] for l in cursor.fetchall()}
+    for versao, nome, migracao in MIGRACOES:
+        if versao in aplicadas: continue
+        print(f"[MIGRACAO] Aplicando {versao} - {nome}")
+        migracao(cursor)
+        cursor.execute("INSERT INTO schema_migracoes (versao, nome) VALUES (%s, %s)", (versao, nome))
+
+def inserir_itens_nota(cursor, nota_id, itens):
+    """Grava as linhas de nota_itens de uma nota recém inserida"""
+    linhas = [
+        (nota_id, i.get('codigo_barras'), i.get('descricao'), i.get('quantidade', 0), i.get('preco_unitario', 0), i.get('preco_custo', 0) or 0)
+        for i in itens
+    ]
+    if not linhas: return
+    execute_values(cursor, '''
+        INSERT INTO nota_itens (nota_id, codigo_barras, descricao, quantidade, preco_unitario, preco_custo)
+        VALUES %s
+    ''', linhas, page_size=len(linhas))
+
+def _resumo_produtos_venda(itens):
+    """(nome, quantidade, receita) por produto para resumo_vendas_dia_produtos"""
+    produtos = {}
+    for i in itens:
+        nome = i.get('descricao') or 'Manual / Otros'
+        qtd, receita = produtos.get(nome, (0, 0))
+        quantidade = i.get('quantidade', 0) or 0
+        produtos[nome] = (qtd + quantidade, receita + (i.get('preco_unitario', 0) or 0) * quantidade)
+    # Mesma ordem de chaves em todo caixa, como em _movimentar_estoque
+    return [{"nome": nome, "quantidade": qtd, "receita": receita} for nome, (qtd, receita) in sorted(produtos.items())]
+
+def _acumular_resumo_credito(cursor, empresa_id, valor):
+    cursor.execute('''
+        INSERT INTO resumo_vendas_dia (empresa_id, dia, devolucoes, notas_credito)
+        VALUES (%s, CURRENT_DATE, %s, 1)
+        ON CONFLICT (empresa_id, dia) DO UPDATE
+        SET devolucoes = resumo_vendas_dia.devolucoes + EXCLUDED.devolucoes,
+            notas_credito = resumo_vendas_dia.notas_credito + 1
+    ''', (empresa_id, valor or 0))
+
+def recalcular_resumo_vendas(cursor, empresa_id=None):
+    """
+    Reconstrói o resumo diário a partir de notas/nota_itens/notas_credito.
+    Usado na migração e nas cargas em massa (demo), que gravam notas sem passar por salvar_nota.
+    Sem `empresa_id`, recalcula todas as empresas.
+    """
+    filtro, params = ("WHERE empresa_id = %s", (empresa_id,)) if empresa_id is not None else ("", ())
+    filtro_n = filtro.replace("empresa_id", "n.empresa_id")
+    for tabela in ("resumo_vendas_dia", "resumo_vendas_dia_produtos", "resumo_vendas_dia_pagamentos"):
+        cursor.execute(f"DELETE FROM {tabela} {filtro}", params)
+    cursor.execute(f'''
+        INSERT INTO resumo_vendas_dia (empresa_id, dia, faturamento, tickets, devolucoes, notas_credito)
+        SELECT empresa_id, dia, SUM(faturamento), SUM(tickets), SUM(devolucoes), SUM(notas_credito)
+        FROM (
+            SELECT empresa_id, data_emissao::date AS dia, COALESCE(valor_total, 0) AS faturamento, 1 AS tickets, 0 AS devolucoes, 0 AS notas_credito
+            FROM notas {filtro}
+            UNION ALL
+            SELECT empresa_id, data_emissao::date, 0, 0, COALESCE(valor_total, 0), 1
+            FROM notas_credito {filtro}
+        ) t
+        GROUP BY empresa_id, dia
+    ''', params + params)
+    cursor.execute(f'''
+        INSERT INTO resumo_vendas_dia_pagamentos (empresa_id, dia, metodo_pago, total, tickets)
+        SELECT empresa_id, data_emissao::date, COALESCE(NULLIF(metodo_pago, ''), 'Efectivo'), SUM(COALESCE(valor_total, 0)), COUNT(*)
+        FROM notas {filtro}
+        GROUP BY 1, 2, 3
+    ''', params)
+    cursor.execute(f'''
+        INSERT INTO resumo_vendas_dia_produtos (empresa_id, dia, nome, quantidade, receita)
+        SELECT n.empresa_id, n.data_emissao::date, COALESCE(NULLIF(i.descricao, ''), 'Manual / Otros'),
+               SUM(i.quantidade), SUM(i.preco_unitario * i.quantidade)
+        FROM nota_itens i
+        JOIN notas n ON n.id = i.nota_id
+        {filtro_n}
+        GROUP BY 1, 2, 3
+    ''', params)
+
+def inicializar_banco():
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
 
-    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS compras (
+            CREATE TABLE IF NOT EXISTS empresas (
                 id SERIAL PRIMARY KEY,
-                empresa_id INTEGER DEFAULT 1,
-                proveedor_id INTEGER,
-                numero_factura TEXT,
-                data_emissao DATE,
-                valor_total REAL,
-                itens TEXT,
-                data_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                nome_empresa TEXT,
+                ruc TEXT UNIQUE,
+                endereco TEXT,
+                senha_certificado TEXT,
+                caminho_certificado TEXT,
+                ambiente_sifen TEXT DEFAULT 'testes',
+                senha_admin TEXT DEFAULT 'admin123',
+                senha_caixa TEXT DEFAULT 'caja123',
+                plano TEXT DEFAULT 'Inicial',
+                status_assinatura TEXT DEFAULT 'Activo',
+                data_vencimento DATE,
+                valor_mensalidade REAL DEFAULT 0,
+                csc TEXT DEFAULT ''
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS funcionarios (
+                id SERIAL PRIMARY KEY,
+                empresa_id INTEGER NOT NULL REFERENCES empresas(id) ON DELETE CASCADE,
+                nome TEXT NOT NULL,
+                email TEXT UNIQUE,
+                senha_hash TEXT NOT NULL,
+                rol TEXT NOT NULL CHECK (rol IN ('cajero', 'gerente')),
+                ativo BOOLEAN DEFAULT TRUE,
+                data_criacao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
-    except Exception as e:
-        pass
 
-    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS autofacturas (
+            CREATE TABLE IF NOT EXISTS notas (
                 id SERIAL PRIMARY KEY,
                 empresa_id INTEGER DEFAULT 1,
-                nome_vendedor TEXT,
-                cedula_vendedor TEXT,
-                endereco_vendedor TEXT,
-                cdc TEXT,
+                ruc_emissor TEXT,
+                nome_cliente TEXT,
                 valor_total REAL,
+                cdc TEXT,
                 itens TEXT,
                 data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                 link_pdf TEXT DEFAULT '',
-                link_qrcode TEXT DEFAULT ''
+                link_qrcode TEXT DEFAULT '',
+                metodo_pago TEXT DEFAULT 'Efectivo',
+                caixa_id INTEGER DEFAULT 0
             )
         ''')
-    except Exception as e:
-        pass
 
-    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS mermas (
-                id SERIAL PRIMARY KEY,
-                empresa_id INTEGER DEFAULT 1,
+            CREATE TABLE IF NOT EXISTS produtos (
                 codigo_barras TEXT,
-                descricao TEXT,
-                quantidade INTEGER,
-                custo_unitario REAL,
-                motivo TEXT,
-                data_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                empresa_id INTEGER DEFAULT 1,
+                descricao TEXT NOT NULL,
+                categoria TEXT,
+                subcategoria TEXT,
+                preco_custo REAL,
+                preco_venda REAL NOT NULL,
+                quantidade INTEGER DEFAULT 0,
+                codigo_proveedor TEXT DEFAULT '',
+                PRIMARY KEY (empresa_id, codigo_barras)
             )
         ''')
-    except Exception as e:
-        pass
 
-    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notas_credito (
+            CREATE TABLE IF NOT EXISTS categorias (
                 id SERIAL PRIMARY KEY,
                 empresa_id INTEGER DEFAULT 1,
-                cdc_referencia TEXT,
-                cdc_novo TEXT,
-                nome_cliente TEXT,
-                valor_total REAL,
-                itens TEXT,
-                data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                link_pdf TEXT DEFAULT ''
+                nome TEXT NOT NULL,
+                UNIQUE (empresa_id, nome)
             )
         ''')
-    except Exception as e:
-        pass
-        
-    try:
+
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS notas_remision (
+            CREATE TABLE IF NOT EXISTS caixa_sessoes (
                 id SERIAL PRIMARY KEY,
                 empresa_id INTEGER DEFAULT 1,
-                ruc_destinatario TEXT,
-                nome_destinatario TEXT,
-                motivo TEXT,
-                chapa_vehiculo TEXT,
-                dados_chofer TEXT,
-                cdc TEXT,
-                itens TEXT,
-                data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                link_pdf TEXT DEFAULT '',
-                link_qrcode TEXT DEFAULT ''
+                data_abertura TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                data_fechamento TIMESTAMP,
+                valor_abertura REAL DEFAULT 0,
+                valor_fechamento REAL,
+                status TEXT DEFAULT 'ABERTO'
             )
         ''')
-    except Exception as e:
-        pass
 
-    try:
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS auditorias (
+            CREATE TABLE IF NOT EXISTS caixa_movimentacoes (
                 id SERIAL PRIMARY KEY,
                 empresa_id INTEGER DEFAULT 1,
-                data TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                impacto_financeiro REAL DEFAULT 0,
-                total_itens INTEGER DEFAULT 0
+                caixa_id INTEGER,
+                tipo TEXT,
+                valor REAL,
+                motivo TEXT,
+                data TIMESTAMP DEFAULT CURRENT_TIMESTAMP
             )
         ''')
+
         cursor.execute('''
-            CREATE TABLE IF NOT EXISTS auditorias_itens (
+            CREATE TABLE IF NOT EXISTS proveedores (
                 id SERIAL PRIMARY KEY,
-                auditoria_id INTEGER,
-                codigo_barras TEXT,
-                descricao TEXT,
-                qtd_sistema INTEGER,
-                qtd_fisica INTEGER,
-                diferenca INTEGER,
-                custo_unitario REAL
+                empresa_id INTEGER DEFAULT 1,
+                nome TEXT NOT NULL,
+                ruc TEXT,
+                telefone TEXT,
+                email TEXT,
+                endereco TEXT,
+                UNIQUE(empresa_id, ruc)
             )
         ''')
+
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS compras (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER DEFAULT 1,
+                    proveedor_id INTEGER,
+                    numero_factura TEXT,
+                    data_emissao DATE,
+                    valor_total REAL,
+                    itens TEXT,
+                    data_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        except Exception as e:
+            pass
+
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS autofacturas (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER DEFAULT 1,
+                    nome_vendedor TEXT,
+                    cedula_vendedor TEXT,
+                    endereco_vendedor TEXT,
+                    cdc TEXT,
+                    valor_total REAL,
+                    itens TEXT,
+                    data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    link_pdf TEXT DEFAULT '',
+                    link_qrcode TEXT DEFAULT ''
+                )
+            ''')
+        except Exception as e:
+            pass
+
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS mermas (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER DEFAULT 1,
+                    codigo_barras TEXT,
+                    descricao TEXT,
+                    quantidade INTEGER,
+                    custo_unitario REAL,
+                    motivo TEXT,
+                    data_registro TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        except Exception as e:
+            pass
+
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notas_credito (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER DEFAULT 1,
+                    cdc_referencia TEXT,
+                    cdc_novo TEXT,
+                    nome_cliente TEXT,
+                    valor_total REAL,
+                    itens TEXT,
+                    data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    link_pdf TEXT DEFAULT ''
+                )
+            ''')
+        except Exception as e:
+            pass
         
-        cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS plano TEXT DEFAULT 'Inicial'")
-        cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS status_assinatura TEXT DEFAULT 'Activo'")
-        cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS data_vencimento DATE")
-        cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS valor_mensalidade REAL DEFAULT 0")
-        cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS csc TEXT DEFAULT ''")
-        # HERE IS THE NEW MERCADO PAGO TOKEN COLUMN
-        cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS mercado_pago_token TEXT DEFAULT ''")
-    except Exception as e:
-        pass
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS notas_remision (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER DEFAULT 1,
+                    ruc_destinatario TEXT,
+                    nome_destinatario TEXT,
+                    motivo TEXT,
+                    chapa_vehiculo TEXT,
+                    dados_chofer TEXT,
+                    cdc TEXT,
+                    itens TEXT,
+                    data_emissao TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    link_pdf TEXT DEFAULT '',
+                    link_qrcode TEXT DEFAULT ''
+                )
+            ''')
+        except Exception as e:
+            pass
 
-    try:
-        vencimento_inicial = date.today() + timedelta(days=365)
-        cursor.execute('''
-            INSERT INTO empresas (id, nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade) 
-            VALUES (1, 'Mi Empresa S.A.', '80012345-6', 'admin123', 'caja123', 'VIP', 'Activo', %s, 0) 
-            ON CONFLICT DO NOTHING
-        ''', (vencimento_inicial,))
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS auditorias (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER DEFAULT 1,
+                    data TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    impacto_financeiro REAL DEFAULT 0,
+                    total_itens INTEGER DEFAULT 0
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS auditorias_itens (
+                    id SERIAL PRIMARY KEY,
+                    auditoria_id INTEGER,
+                    codigo_barras TEXT,
+                    descricao TEXT,
+                    qtd_sistema INTEGER,
+                    qtd_fisica INTEGER,
+                    diferenca INTEGER,
+                    custo_unitario REAL
+                )
+            ''')
         
-        cursor.execute("SELECT 1 FROM categorias WHERE nome = 'General' AND empresa_id = 1")
-        if not cursor.fetchone():
-            cursor.execute("INSERT INTO categorias (empresa_id, nome) VALUES (1, 'General')")
-    except Exception as e:
-        pass
-    try:
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS faturas_saas (
-                id SERIAL PRIMARY KEY,
-                empresa_id INTEGER,
-                valor REAL,
-                data_vencimento TIMESTAMP,
-                status TEXT DEFAULT 'Pendente',
-                id_pagamento_mp TEXT
-            )
-        ''')
-    except Exception as e:
-        pass
-    conexao.commit()
-    cursor.close()
-    conexao.close()
+            cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS plano TEXT DEFAULT 'Inicial'")
+            cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS status_assinatura TEXT DEFAULT 'Activo'")
+            cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS data_vencimento DATE")
+            cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS valor_mensalidade REAL DEFAULT 0")
+            cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS csc TEXT DEFAULT ''")
+            # HERE IS THE NEW MERCADO PAGO TOKEN COLUMN
+            cursor.execute("ALTER TABLE empresas ADD COLUMN IF NOT EXISTS mercado_pago_token TEXT DEFAULT ''")
+        except Exception as e:
+            pass
+
+        try:
+            vencimento_inicial = date.today() + timedelta(days=365)
+            cursor.execute('''
+                INSERT INTO empresas (id, nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade) 
+                VALUES (1, 'Mi Empresa S.A.', '80012345-6', 'admin123', 'caja123', 'VIP', 'Activo', %s, 0) 
+                ON CONFLICT DO NOTHING
+            ''', (vencimento_inicial,))
+        
+            cursor.execute("SELECT 1 FROM categorias WHERE nome = 'General' AND empresa_id = 1")
+            if not cursor.fetchone():
+                cursor.execute("INSERT INTO categorias (empresa_id, nome) VALUES (1, 'General')")
+        except Exception as e:
+            pass
+        try:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS faturas_saas (
+                    id SERIAL PRIMARY KEY,
+                    empresa_id INTEGER,
+                    valor REAL,
+                    data_vencimento TIMESTAMP,
+                    status TEXT DEFAULT 'Pendente',
+                    id_pagamento_mp TEXT
+                )
+            ''')
+        except Exception as e:
+            pass
+
+        aplicar_migracoes(cursor)
+        conexao.commit()
+        cursor.close()
 
 if DATABASE_URL:
     inicializar_banco()
@@ -309,813 +609,1178 @@ def plano_permite_sifen(plano_empresa):
     return plano_empresa not in planos_nao_fiscais
 
 def obter_plano_empresa(empresa_id):
-    """Obtém o plano da empresa pelo ID"""
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT plano FROM empresas WHERE id = %s", (empresa_id,))
-    linha = cursor.fetchone()
-    conexao.close()
-    return linha[0] if linha else 'Inicial'
+    """Obtém o plano da empresa pelo ID (via cache_empresas)"""
+    dados = cache_empresas.obter(empresa_id, _ler_empresa)
+    return dados["plano"] if dados else 'Inicial'
 
 def autenticar_usuario(identificador, senha_fornecida):
     print(f"[AUTH DEBUG] Tentativa de autenticação com identificador: {identificador}")
 
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-
-    try:
-        # ==========================================================
-        # FASE 1: Buscar empresa por RUC (para donos e caixas legados)
-        # ==========================================================
-        cursor.execute("""
-            SELECT id, senha_admin, senha_caixa, plano, nome_empresa
-            FROM empresas
-            WHERE ruc = %s
-        """, (identificador,))
-
-        empresa = cursor.fetchone()
-
-        if empresa:
-            emp_id, senha_admin, senha_caixa, plano, nome_empresa = empresa
-            print(f"[AUTH DEBUG] Empresa encontrada via RUC: ID {emp_id}")
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
 
-            # Verificar senhas de dono/admin (texto plano - legado)
-            if senha_fornecida == senha_admin:
-                print("[AUTH DEBUG] Senha de ADMIN correta")
-                cursor.close()
-                conexao.close()
+        try:
+            # ==========================================================
+            # FASE 1: Buscar empresa por RUC (para donos e caixas legados)
+            # ==========================================================
+            # E-mail nunca é RUC: funcionários vão direto para a fase 2
+            empresa = None
+            if '@' not in identificador:
+                cursor.execute("""
+                    SELECT id, senha_admin, senha_caixa, plano, nome_empresa
+                    FROM empresas
+                    WHERE ruc = %s
+                """, (identificador,))
+
+                empresa = cursor.fetchone()
+
+            if empresa:
+                emp_id, senha_admin, senha_caixa, plano, nome_empresa = empresa
+                print(f"[AUTH DEBUG] Empresa encontrada via RUC: ID {emp_id}")
+
+                # Verificar senhas de dono/admin (texto plano - legado)
+                if senha_fornecida == senha_admin:
+                    print("[AUTH DEBUG] Senha de ADMIN correta")
+                    cursor.close()
                 
-                # Identifica se é o dono do sistema
-                cargo = "superadmin" if identificador == "NUBE" else "admin"
+                    # Identifica se é o dono do sistema
+                    cargo = "superadmin" if identificador == "NUBE" else "admin"
                 
-                return {
-                    "sucesso": True,
-                    "empresa_id": emp_id,
-                    "rol": cargo,
-                    "plano": plano,
-                    "nome_empresa": nome_empresa
-                }
+                    return {
+                        "sucesso": True,
+                        "empresa_id": emp_id,
+                        "rol": cargo,
+                        "plano": plano,
+                        "nome_empresa": nome_empresa
+                    }
             
-            # Verificar senha de caixa (texto plano - legado)
-            if senha_fornecida == senha_caixa:
-                print("[AUTH DEBUG] Senha de CAJA correta")
-                cursor.close()
-                conexao.close()
-                return {
-                    "sucesso": True,
-                    "empresa_id": emp_id,
-                    "rol": "cajero",
-                    "plano": plano,
-                    "nome_empresa": nome_empresa
-                }
-
-        # ==========================================================
-        # FASE 2: Buscar funcionário por EMAIL (fallback)
-        # ==========================================================
-        print(f"[AUTH DEBUG] Buscando funcionário por email...")
+                # Verificar senha de caixa (texto plano - legado)
+                if senha_fornecida == senha_caixa:
+                    print("[AUTH DEBUG] Senha de CAJA correta")
+                    cursor.close()
+                    return {
+                        "sucesso": True,
+                        "empresa_id": emp_id,
+                        "rol": "cajero",
+                        "plano": plano,
+                        "nome_empresa": nome_empresa
+                    }
+
+            # ==========================================================
+            # FASE 2: Buscar funcionário por EMAIL (fallback)
+            # ==========================================================
+            print(f"[AUTH DEBUG] Buscando funcionário por email...")
         
-        cursor.execute("""
-            SELECT f.id, f.rol, f.nome, f.email, f.empresa_id, e.plano, e.nome_empresa
-            FROM funcionarios f
-            JOIN empresas e ON f.empresa_id = e.id
-            WHERE f.email = %s AND f.ativo = TRUE
-        """, (identificador,))
-
-        funcionario = cursor.fetchone()
+            cursor.execute("""
+                SELECT f.id, f.rol, f.nome, f.email, f.empresa_id, e.plano, e.nome_empresa, f.senha_hash
+                FROM funcionarios f
+                JOIN empresas e ON f.empresa_id = e.id
+                WHERE f.email = %s AND f.ativo = TRUE
+            """, (identificador,))
 
-        if funcionario:
-            func_id, rol, nome_func, email, emp_id, plano, nome_empresa = funcionario
+            funcionario = cursor.fetchone()
 
-            # Verificar hash da senha
-            senha_hash = hash_senha(senha_fornecida)
-            cursor.execute("""
-                SELECT id FROM funcionarios
-                WHERE id = %s AND senha_hash = %s
-            """, (func_id, senha_hash))
+            if funcionario:
+                func_id, rol, nome_func, email, emp_id, plano, nome_empresa, senha_hash = funcionario
 
-            if cursor.fetchone():
-                print(f"[AUTH DEBUG] Hash da senha do funcionário OK")
+                # Verificar hash da senha (já veio na mesma linha)
+                if senha_hash and hmac.compare_digest(hash_senha(senha_fornecida), senha_hash):
+                    print(f"[AUTH DEBUG] Hash da senha do funcionário OK")
                 
-                # Validar restrições de plano
-                erro_plano = validar_plano_funcionario(plano, rol)
-                if erro_plano:
-                    cursor.close()
-                    conexao.close()
-                    return {"sucesso": False, "mensagem": erro_plano}
+                    # Validar restrições de plano
+                    erro_plano = validar_plano_funcionario(plano, rol)
+                    if erro_plano:
+                        cursor.close()
+                        return {"sucesso": False, "mensagem": erro_plano}
                 
-                cursor.close()
-                conexao.close()
-                return {
-                    "sucesso": True,
-                    "empresa_id": emp_id,
-                    "rol": rol,
-                    "plano": plano,
-                    "funcionario_id": func_id,
-                    "nome": nome_func,
-                    "email": email,
-                    "nome_empresa": nome_empresa
-                }
-            else:
-                print(f"[AUTH DEBUG] Hash da senha do funcionário INCORRETO")
-                cursor.close()
-                conexao.close()
-                return {"sucesso": False, "mensagem": "Contraseña incorrecta"}
-
-        # ==========================================================
-        # FASE 3: Nenhum usuário encontrado
-        # ==========================================================
-        cursor.close()
-        conexao.close()
-
-        if '@' in identificador:
-            return {"sucesso": False, "mensagem": "Email no encontrado o inactivo"}
-        else:
-            return {"sucesso": False, "mensagem": "Empresa no encontrada o contraseña incorrecta"}
+                    cursor.close()
+                    return {
+                        "sucesso": True,
+                        "empresa_id": emp_id,
+                        "rol": rol,
+                        "plano": plano,
+                        "funcionario_id": func_id,
+                        "nome": nome_func,
+                        "email": email,
+                        "nome_empresa": nome_empresa
+                    }
+                else:
+                    print(f"[AUTH DEBUG] Hash da senha do funcionário INCORRETO")
+                    cursor.close()
+                    return {"sucesso": False, "mensagem": "Contraseña incorrecta"}
 
-    except Exception as e:
-        print(f"[AUTH ERROR] Erro durante autenticação: {e}")
-        import sys
-        import traceback
-        traceback.print_exc(file=sys.stderr)
-        try:
+            # ==========================================================
+            # FASE 3: Nenhum usuário encontrado
+            # ==========================================================
             cursor.close()
-            conexao.close()
-        except:
-            pass
-        return {"sucesso": False, "mensagem": "Error interno del servidor"}
+
+            if '@' in identificador:
+                return {"sucesso": False, "mensagem": "Email no encontrado o inactivo"}
+            else:
+                return {"sucesso": False, "mensagem": "Empresa no encontrada o contraseña incorrecta"}
+
+        except Exception as e:
+            print(f"[AUTH ERROR] Erro durante autenticação: {e}")
+            import sys
+            import traceback
+            traceback.print_exc(file=sys.stderr)
+            try:
+                cursor.close()
+            except:
+                pass
+            return {"sucesso": False, "mensagem": "Error interno del servidor"}
 def adicionar_funcionario(empresa_id, nome, email, senha, rol):
     """Adiciona um novo funcionário para a empresa"""
     senha_hash = hash_senha(senha)
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        cursor.execute("""
-            INSERT INTO funcionarios (empresa_id, nome, email, senha_hash, rol)
-            VALUES (%s, %s, %s, %s, %s)
-            RETURNING id
-        """, (empresa_id, nome, email, senha_hash, rol))
-        funcionario_id = cursor.fetchone()[0]
-        conexao.commit()
-        return {"sucesso": True, "id": funcionario_id}
-    except psycopg2.IntegrityError as e:
-        conexao.rollback()
-        if "email" in str(e):
-            return {"sucesso": False, "mensagem": "Email já cadastrado"}
-        return {"sucesso": False, "mensagem": "Erro ao adicionar funcionário"}
-    except Exception as e:
-        conexao.rollback()
-        return {"sucesso": False, "mensagem": f"Erro: {e}"}
-    finally:
-        cursor.close()
-        conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            cursor.execute("""
+                INSERT INTO funcionarios (empresa_id, nome, email, senha_hash, rol)
+                VALUES (%s, %s, %s, %s, %s)
+                RETURNING id
+            """, (empresa_id, nome, email, senha_hash, rol))
+            funcionario_id = cursor.fetchone()[0]
+            conexao.commit()
+            return {"sucesso": True, "id": funcionario_id}
+        except psycopg2.IntegrityError as e:
+            conexao.rollback()
+            if "email" in str(e):
+                return {"sucesso": False, "mensagem": "Email já cadastrado"}
+            return {"sucesso": False, "mensagem": "Erro ao adicionar funcionário"}
+        except Exception as e:
+            conexao.rollback()
+            return {"sucesso": False, "mensagem": f"Erro: {e}"}
+        finally:
+            cursor.close()
 
 def listar_funcionarios(empresa_id):
     """Lista todos os funcionários de uma empresa"""
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("""
-        SELECT id, nome, email, rol, ativo, data_criacao
-        FROM funcionarios
-        WHERE empresa_id = %s
-        ORDER BY nome
-    """, (empresa_id,))
-    resultados = cursor.fetchall()
-    cursor.close()
-    conexao.close()
-    return [
-        {
-            "id": r[0],
-            "nome": r[1],
-            "email": r[2],
-            "rol": r[3],
-            "ativo": r[4],
-            "data_criacao": r[5].isoformat() if r[5] else None
-        }
-        for r in resultados
-    ]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("""
+            SELECT id, nome, email, rol, ativo, data_criacao
+            FROM funcionarios
+            WHERE empresa_id = %s
+            ORDER BY nome
+        """, (empresa_id,))
+        resultados = cursor.fetchall()
+        cursor.close()
+        return [
+            {
+                "id": r[0],
+                "nome": r[1],
+                "email": r[2],
+                "rol": r[3],
+                "ativo": r[4],
+                "data_criacao": r[5].isoformat() if r[5] else None
+            }
+            for r in resultados
+        ]
 
 def remover_funcionario(empresa_id, funcionario_id):
     """Remove ou desativa um funcionário"""
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        # Verificar se o funcionário pertence à empresa
-        cursor.execute("SELECT id FROM funcionarios WHERE id = %s AND empresa_id = %s", (funcionario_id, empresa_id))
-        if not cursor.fetchone():
-            return {"sucesso": False, "mensagem": "Funcionário não encontrado"}
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            # Verificar se o funcionário pertence à empresa
+            cursor.execute("SELECT id FROM funcionarios WHERE id = %s AND empresa_id = %s", (funcionario_id, empresa_id))
+            if not cursor.fetchone():
+                return {"sucesso": False, "mensagem": "Funcionário não encontrado"}
         
-        # Desativar em vez de excluir (soft delete)
-        cursor.execute("UPDATE funcionarios SET ativo = FALSE WHERE id = %s", (funcionario_id,))
-        conexao.commit()
-        return {"sucesso": True}
-    except Exception as e:
-        conexao.rollback()
-        return {"sucesso": False, "mensagem": f"Erro: {e}"}
-    finally:
-        cursor.close()
-        conexao.close()
+            # Desativar em vez de excluir (soft delete)
+            cursor.execute("UPDATE funcionarios SET ativo = FALSE WHERE id = %s", (funcionario_id,))
+            conexao.commit()
+            return {"sucesso": True}
+        except Exception as e:
+            conexao.rollback()
+            return {"sucesso": False, "mensagem": f"Erro: {e}"}
+        finally:
+            cursor.close()
 
 def atualizar_funcionario(empresa_id, funcionario_id, nome=None, email=None, senha=None, rol=None, ativo=None):
     """Atualiza os dados de um funcionário"""
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        # Verificar se o funcionário pertence à empresa
-        cursor.execute("SELECT id FROM funcionarios WHERE id = %s AND empresa_id = %s", (funcionario_id, empresa_id))
-        if not cursor.fetchone():
-            return {"sucesso": False, "mensagem": "Funcionário não encontrado"}
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            # Verificar se o funcionário pertence à empresa
+            cursor.execute("SELECT id FROM funcionarios WHERE id = %s AND empresa_id = %s", (funcionario_id, empresa_id))
+            if not cursor.fetchone():
+                return {"sucesso": False, "mensagem": "Funcionário não encontrado"}
         
-        updates = []
-        params = []
-        if nome is not None:
-            updates.append("nome = %s")
-            params.append(nome)
-        if email is not None:
-            updates.append("email = %s")
-            params.append(email)
-        if senha is not None:
-            updates.append("senha_hash = %s")
-            params.append(hash_senha(senha))
-        if rol is not None:
-            updates.append("rol = %s")
-            params.append(rol)
-        if ativo is not None:
-            updates.append("ativo = %s")
-            params.append(ativo)
+            updates = []
+            params = []
+            if nome is not None:
+                updates.append("nome = %s")
+                params.append(nome)
+            if email is not None:
+                updates.append("email = %s")
+                params.append(email)
+            if senha is not None:
+                updates.append("senha_hash = %s")
+                params.append(hash_senha(senha))
+            if rol is not None:
+                updates.append("rol = %s")
+                params.append(rol)
+            if ativo is not None:
+                updates.append("ativo = %s")
+                params.append(ativo)
         
-        if not updates:
-            return {"sucesso": False, "mensagem": "Nenhum campo para atualizar"}
+            if not updates:
+                return {"sucesso": False, "mensagem": "Nenhum campo para atualizar"}
         
-        params.append(funcionario_id)
-        cursor.execute(f"""
-            UPDATE funcionarios 
-            SET {', '.join(updates)}
-            WHERE id = %s
-        """, tuple(params))
-        conexao.commit()
-        return {"sucesso": True}
-    except psycopg2.IntegrityError as e:
-        conexao.rollback()
-        if "email" in str(e):
-            return {"sucesso": False, "mensagem": "Email já cadastrado"}
-        return {"sucesso": False, "mensagem": "Erro ao atualizar funcionário"}
-    except Exception as e:
-        conexao.rollback()
-        return {"sucesso": False, "mensagem": f"Erro: {e}"}
-    finally:
-        cursor.close()
-        conexao.close()
+            params.append(funcionario_id)
+            cursor.execute(f"""
+                UPDATE funcionarios 
+                SET {', '.join(updates)}
+                WHERE id = %s
+            """, tuple(params))
+            conexao.commit()
+            return {"sucesso": True}
+        except psycopg2.IntegrityError as e:
+            conexao.rollback()
+            if "email" in str(e):
+                return {"sucesso": False, "mensagem": "Email já cadastrado"}
+            return {"sucesso": False, "mensagem": "Erro ao atualizar funcionário"}
+        except Exception as e:
+            conexao.rollback()
+            return {"sucesso": False, "mensagem": f"Erro: {e}"}
+        finally:
+            cursor.close()
 
 def obter_metricas_saas():
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("UPDATE empresas SET status_assinatura = 'Vencido' WHERE data_vencimento < CURRENT_DATE AND status_assinatura = 'Activo'")
-    conexao.commit()
-    cursor.execute("SELECT COUNT(*) FROM empresas WHERE status_assinatura = 'Activo'")
-    clientes_ativos = cursor.fetchone()[0]
-    cursor.execute("SELECT SUM(valor_mensalidade) FROM empresas WHERE status_assinatura = 'Activo'")
-    mrr = cursor.fetchone()[0] or 0
-    cursor.execute("SELECT COUNT(*) FROM empresas WHERE status_assinatura = 'Vencido'")
-    clientes_vencidos = cursor.fetchone()[0]
-    conexao.close()
-    return {"mrr": mrr, "clientes_ativos": clientes_ativos, "clientes_vencidos": clientes_vencidos}
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("UPDATE empresas SET status_assinatura = 'Vencido' WHERE data_vencimento < CURRENT_DATE AND status_assinatura = 'Activo'")
+        conexao.commit()
+        cursor.execute("SELECT COUNT(*) FROM empresas WHERE status_assinatura = 'Activo'")
+        clientes_ativos = cursor.fetchone()[0]
+        cursor.execute("SELECT SUM(valor_mensalidade) FROM empresas WHERE status_assinatura = 'Activo'")
+        mrr = cursor.fetchone()[0] or 0
+        cursor.execute("SELECT COUNT(*) FROM empresas WHERE status_assinatura = 'Vencido'")
+        clientes_vencidos = cursor.fetchone()[0]
+        return {"mrr": mrr, "clientes_ativos": clientes_ativos, "clientes_vencidos": clientes_vencidos}
 
 def listar_todas_empresas():
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT id, nome_empresa, ruc, ambiente_sifen, plano, status_assinatura, data_vencimento, valor_mensalidade FROM empresas ORDER BY id ASC")
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "nome": l[1], "ruc": l[2], "ambiente": l[3], "plano": l[4], "status": l[5], "vencimento": str(l[6]) if l[6] else "N/A", "valor": l[7]} for l in linhas]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("SELECT id, nome_empresa, ruc, ambiente_sifen, plano, status_assinatura, data_vencimento, valor_mensalidade FROM empresas ORDER BY id ASC")
+        linhas = cursor.fetchall()
+        return [{"id": l[0], "nome": l[1], "ruc": l[2], "ambiente": l[3], "plano": l[4], "status": l[5], "vencimento": str(l[6]) if l[6] else "N/A", "valor": l[7]} for l in linhas]
 
 def criar_nova_empresa(nome, ruc, senha_admin, senha_caixa, plano, valor):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    vencimento = date.today() + timedelta(days=30)
-    try:
-        cursor.execute("INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, valor_mensalidade, status_assinatura, data_vencimento) VALUES (%s, %s, %s, %s, %s, %s, 'Activo', %s)", (nome, ruc, senha_admin, senha_caixa, plano, valor, vencimento))
-        conexao.commit()
-        return True, "Empresa creada exitosamente."
-    except psycopg2.IntegrityError:
-        return False, "Ya existe una empresa con este RUC."
-    finally:
-        conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        vencimento = date.today() + timedelta(days=30)
+        try:
+            cursor.execute("INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, valor_mensalidade, status_assinatura, data_vencimento) VALUES (%s, %s, %s, %s, %s, %s, 'Activo', %s)", (nome, ruc, senha_admin, senha_caixa, plano, valor, vencimento))
+            conexao.commit()
+            return True, "Empresa creada exitosamente."
+        except psycopg2.IntegrityError:
+            return False, "Ya existe una empresa con este RUC."
 
 def atualizar_plano_empresa(empresa_id, novo_plano, novo_valor):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("UPDATE empresas SET plano = %s, valor_mensalidade = %s WHERE id = %s", (novo_plano, novo_valor, empresa_id))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("UPDATE empresas SET plano = %s, valor_mensalidade = %s WHERE id = %s", (novo_plano, novo_valor, empresa_id))
+        _avisar_empresa_alterada(cursor, empresa_id)
+        conexao.commit()
+    cache_empresas.invalidar(empresa_id)
     return True
 
 def status_caixa_atual(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT id, valor_abertura, data_abertura FROM caixa_sessoes WHERE empresa_id = %s AND status = 'ABERTO' ORDER BY id DESC LIMIT 1", (empresa_id,))
-    linha = cursor.fetchone()
-    conexao.close()
-    if linha: return {"aberto": True, "caixa_id": linha[0], "valor_abertura": linha[1], "data_abertura": linha[2]}
-    return {"aberto": False}
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("SELECT id, valor_abertura, data_abertura FROM caixa_sessoes WHERE empresa_id = %s AND status = 'ABERTO' ORDER BY id DESC LIMIT 1", (empresa_id,))
+        linha = cursor.fetchone()
+        if linha: return {"aberto": True, "caixa_id": linha[0], "valor_abertura": linha[1], "data_abertura": linha[2]}
+        return {"aberto": False}
 
 def abrir_caixa(empresa_id, valor_inicial):
     atual = status_caixa_atual(empresa_id)
     if atual["aberto"]: return False, "Ya existe una caja abierta."
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("INSERT INTO caixa_sessoes (empresa_id, valor_abertura, status) VALUES (%s, %s, 'ABERTO')", (empresa_id, valor_inicial))
-    conexao.commit()
-    conexao.close()
-    return True, "Caja abierta con Ã©xito."
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("INSERT INTO caixa_sessoes (empresa_id, valor_abertura, status) VALUES (%s, %s, 'ABERTO')", (empresa_id, valor_inicial))
+        conexao.commit()
+        return True, "Caja abierta con Ã©xito."
 
 def fechar_caixa(empresa_id, valor_fechamento):
     atual = status_caixa_atual(empresa_id)
     if not atual["aberto"]: return False, "No hay caja abierta."
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("UPDATE caixa_sessoes SET status = 'FECHADO', data_fechamento = CURRENT_TIMESTAMP, valor_fechamento = %s WHERE id = %s AND empresa_id = %s", (valor_fechamento, atual["caixa_id"], empresa_id))
-    conexao.commit()
-    conexao.close()
-    return True, "Caja cerrada con Ã©xito."
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("UPDATE caixa_sessoes SET status = 'FECHADO', data_fechamento = CURRENT_TIMESTAMP, valor_fechamento = %s WHERE id = %s AND empresa_id = %s", (valor_fechamento, atual["caixa_id"], empresa_id))
+        conexao.commit()
+        return True, "Caja cerrada con Ã©xito."
 
 def registrar_sangria(empresa_id, valor, motivo):
     atual = status_caixa_atual(empresa_id)
     if not atual["aberto"]: return False, "La caja debe estar abierta."
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("INSERT INTO caixa_movimentacoes (empresa_id, caixa_id, tipo, valor, motivo) VALUES (%s, %s, 'SANGRIA', %s, %s)", (empresa_id, atual["caixa_id"], valor, motivo))
-    conexao.commit()
-    conexao.close()
-    return True, "Retiro registrado."
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("INSERT INTO caixa_movimentacoes (empresa_id, caixa_id, tipo, valor, motivo) VALUES (%s, %s, 'SANGRIA', %s, %s)", (empresa_id, atual["caixa_id"], valor, motivo))
+        conexao.commit()
+        return True, "Retiro registrado."
 
 def cadastrar_categoria(empresa_id, nome):
-    try:
-        conexao = get_conexao()
+    with obter_conexao() as conexao:
         cursor = conexao.cursor()
         cursor.execute("SELECT 1 FROM categorias WHERE empresa_id = %s AND nome = %s", (empresa_id, nome))
         if cursor.fetchone(): return False
         cursor.execute('INSERT INTO categorias (empresa_id, nome) VALUES (%s, %s)', (empresa_id, nome))
         conexao.commit()
         return True
-    finally:
-        if 'conexao' in locals(): conexao.close()
 
 def listar_categorias(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT id, nome FROM categorias WHERE empresa_id = %s ORDER BY nome ASC', (empresa_id,))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "nome": l[1]} for l in linhas]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT id, nome FROM categorias WHERE empresa_id = %s ORDER BY nome ASC', (empresa_id,))
+        linhas = cursor.fetchall()
+        return [{"id": l[0], "nome": l[1]} for l in linhas]
 
 def deletar_categoria(empresa_id, id_categoria):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('DELETE FROM categorias WHERE id = %s AND empresa_id = %s', (id_categoria, empresa_id))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('DELETE FROM categorias WHERE id = %s AND empresa_id = %s', (id_categoria, empresa_id))
+        conexao.commit()
+
+def _ler_empresa(empresa_id):
+    """Configuração e plano numa consulta só; usado pelo cache_empresas quando não há entrada válida."""
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT nome_empresa, ruc, endereco, senha_certificado, caminho_certificado, ambiente_sifen, csc, mercado_pago_token, plano FROM empresas WHERE id = %s', (empresa_id,))
+        linha = cursor.fetchone()
+    if not linha: return None
+    config = {"nome_empresa": linha[0], "ruc": linha[1], "endereco": linha[2], "senha_certificado": linha[3], "caminho_certificado": linha[4], "ambiente_sifen": linha[5], "csc": linha[6], "mercado_pago_token": linha[7]}
+    return {"config": config, "plano": linha[8] or 'Inicial'}
+
+def _avisar_empresa_alterada(cursor, empresa_id):
+    """NOTIFY na mesma transação da alteração: os outros processos só recebem depois do commit."""
+    cursor.execute("SELECT pg_notify(%s, %s)", (CANAL_EMPRESAS, str(empresa_id)))
 
 def obter_configuracao(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    # ADDED mercado_pago_token TO THE SELECT HERE
-    cursor.execute('SELECT nome_empresa, ruc, endereco, senha_certificado, caminho_certificado, ambiente_sifen, csc, mercado_pago_token FROM empresas WHERE id = %s', (empresa_id,))
-    linha = cursor.fetchone()
-    conexao.close()
-    if linha: return {"nome_empresa": linha[0], "ruc": linha[1], "endereco": linha[2], "senha_certificado": linha[3], "caminho_certificado": linha[4], "ambiente_sifen": linha[5], "csc": linha[6], "mercado_pago_token": linha[7]}
-    return None
+    dados = cache_empresas.obter(empresa_id, _ler_empresa)
+    # Cópia: quem chama pode alterar o dict sem sujar o cache
+    return dict(dados["config"]) if dados else None
 
 # UPDATED TO RECEIVE AND SAVE mercado_pago_token
 def salvar_configuracao_texto(empresa_id, nome, ruc, endereco, senha, csc, mercado_pago_token=""):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('UPDATE empresas SET nome_empresa = %s, ruc = %s, endereco = %s, senha_certificado = %s, csc = %s, mercado_pago_token = %s WHERE id = %s', (nome, ruc, endereco, senha, csc, mercado_pago_token, empresa_id))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('UPDATE empresas SET nome_empresa = %s, ruc = %s, endereco = %s, senha_certificado = %s, csc = %s, mercado_pago_token = %s WHERE id = %s', (nome, ruc, endereco, senha, csc, mercado_pago_token, empresa_id))
+        _avisar_empresa_alterada(cursor, empresa_id)
+        conexao.commit()
+    cache_empresas.invalidar(empresa_id)
 
 def salvar_caminho_certificado(empresa_id, caminho):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('UPDATE empresas SET caminho_certificado = %s WHERE id = %s', (caminho, empresa_id))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('UPDATE empresas SET caminho_certificado = %s WHERE id = %s', (caminho, empresa_id))
+        _avisar_empresa_alterada(cursor, empresa_id)
+        conexao.commit()
+    cache_empresas.invalidar(empresa_id)
 
 def alternar_ambiente_sifen(empresa_id, ambiente):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('UPDATE empresas SET ambiente_sifen = %s WHERE id = %s', (ambiente, empresa_id))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('UPDATE empresas SET ambiente_sifen = %s WHERE id = %s', (ambiente, empresa_id))
+        _avisar_empresa_alterada(cursor, empresa_id)
+        conexao.commit()
+    cache_empresas.invalidar(empresa_id)
 
 def cadastrar_produto(empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor=""):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('''
-        INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (empresa_id, codigo_barras) DO UPDATE SET
-        descricao = EXCLUDED.descricao,
-        categoria = EXCLUDED.categoria,
-        subcategoria = EXCLUDED.subcategoria,
-        preco_custo = EXCLUDED.preco_custo,
-        preco_venda = EXCLUDED.preco_venda,
-        quantidade = EXCLUDED.quantidade,
-        codigo_proveedor = EXCLUDED.codigo_proveedor
-    ''', (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (empresa_id, codigo_barras) DO UPDATE SET
+            descricao = EXCLUDED.descricao,
+            categoria = EXCLUDED.categoria,
+            subcategoria = EXCLUDED.subcategoria,
+            preco_custo = EXCLUDED.preco_custo,
+            preco_venda = EXCLUDED.preco_venda,
+            quantidade = EXCLUDED.quantidade,
+            codigo_proveedor = EXCLUDED.codigo_proveedor
+        ''', (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor))
+        conexao.commit()
 
 def listar_produtos(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor FROM produtos WHERE empresa_id = %s', (empresa_id,))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"codigo_barras": l[0], "descricao": l[1], "categoria": l[2], "subcategoria": l[3], "preco_custo": l[4], "preco_venda": l[5], "quantidade": l[6], "codigo_proveedor": l[7]} for l in linhas]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor FROM produtos WHERE empresa_id = %s', (empresa_id,))
+        linhas = cursor.fetchall()
+        return [{"codigo_barras": l[0], "descricao": l[1], "categoria": l[2], "subcategoria": l[3], "preco_custo": l[4], "preco_venda": l[5], "quantidade": l[6], "codigo_proveedor": l[7]} for l in linhas]
 
 def buscar_produto_por_codigo(empresa_id, codigo_barras):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT * FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, codigo_barras))
-    l = cursor.fetchone()
-    conexao.close()
-    if l: return {"descricao": l[2], "preco_venda": l[6], "codigo_proveedor": l[8]}
-    return None
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT * FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, codigo_barras))
+        l = cursor.fetchone()
+        if l: return {"descricao": l[2], "preco_venda": l[6], "codigo_proveedor": l[8]}
+        return None
 
 def deletar_produto(empresa_id, codigo_barras):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('DELETE FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, codigo_barras))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('DELETE FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, codigo_barras))
+        conexao.commit()
 
 def salvar_auditoria_estoque(empresa_id, itens_auditados):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        cursor.execute("INSERT INTO auditorias (empresa_id) VALUES (%s) RETURNING id", (empresa_id,))
-        auditoria_id = cursor.fetchone()[0]
-
-        impacto_total = 0
-        total_itens = 0
-
-        for item in itens_auditados:
-            cod = item['codigo_barras']
-            fisica = item['qtd_fisica']
-
-            cursor.execute("SELECT descricao, quantidade, preco_custo FROM produtos WHERE empresa_id = %s AND codigo_barras = %s", (empresa_id, cod))
-            linha = cursor.fetchone()
-            if not linha: continue
-
-            desc, qtd_sis, custo = linha
-            diferenca = fisica - qtd_sis
-            impacto = diferenca * custo
-
-            if diferenca != 0:
-                impacto_total += impacto
-                total_itens += 1
-                cursor.execute("UPDATE produtos SET quantidade = %s WHERE empresa_id = %s AND codigo_barras = %s", (fisica, empresa_id, cod))
-                cursor.execute("INSERT INTO auditorias_itens (auditoria_id, codigo_barras, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario) VALUES (%s, %s, %s, %s, %s, %s, %s)", (auditoria_id, cod, desc, qtd_sis, fisica, diferenca, custo))
-
-        cursor.execute("UPDATE auditorias SET impacto_financeiro = %s, total_itens = %s WHERE id = %s", (impacto_total, total_itens, auditoria_id))
-        conexao.commit()
-        return True, "AuditorÃ­a completada. Inventario actualizado."
-    except Exception as e:
-        conexao.rollback()
-        return False, str(e)
-    finally:
-        cursor.close()
-        conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            cursor.execute("INSERT INTO auditorias (empresa_id) VALUES (%s) RETURNING id", (empresa_id,))
+            auditoria_id = cursor.fetchone()[0]
+
+            impacto_total = 0
+            total_itens = 0
+
+            for item in itens_auditados:
+                cod = item['codigo_barras']
+                fisica = item['qtd_fisica']
+
+                cursor.execute("SELECT descricao, quantidade, preco_custo FROM produtos WHERE empresa_id = %s AND codigo_barras = %s", (empresa_id, cod))
+                linha = cursor.fetchone()
+                if not linha: continue
+
+                desc, qtd_sis, custo = linha
+                diferenca = fisica - qtd_sis
+                impacto = diferenca * custo
+
+                if diferenca != 0:
+                    impacto_total += impacto
+                    total_itens += 1
+                    cursor.execute("UPDATE produtos SET quantidade = %s WHERE empresa_id = %s AND codigo_barras = %s", (fisica, empresa_id, cod))
+                    cursor.execute("INSERT INTO auditorias_itens (auditoria_id, codigo_barras, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario) VALUES (%s, %s, %s, %s, %s, %s, %s)", (auditoria_id, cod, desc, qtd_sis, fisica, diferenca, custo))
+
+            cursor.execute("UPDATE auditorias SET impacto_financeiro = %s, total_itens = %s WHERE id = %s", (impacto_total, total_itens, auditoria_id))
+            conexao.commit()
+            return True, "AuditorÃ­a completada. Inventario actualizado."
+        except Exception as e:
+            conexao.rollback()
+            return False, str(e)
+        finally:
+            cursor.close()
 
 def obter_relatorio_variancia(empresa_id, data_inicio, data_fim):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
     
-    cursor.execute('''
-        SELECT a.data AS fecha,
-               ai.codigo_barras AS codigo,
-               ai.descricao AS descricao,
-               COALESCE(SUM(ai.diferenca), 0) AS total_unidades,
-               COALESCE(SUM(ai.diferenca * ai.custo_unitario), 0) AS impacto_financeiro
-        FROM auditorias a
-        JOIN auditorias_itens ai ON a.id = ai.auditoria_id
-        WHERE a.empresa_id = %s AND DATE(a.data) BETWEEN %s AND %s
-        GROUP BY ai.codigo_barras, ai.descricao, a.data
-        ORDER BY a.data DESC
-    ''', (empresa_id, data_inicio, data_fim))
+        cursor.execute('''
+            SELECT a.data AS fecha,
+                   ai.codigo_barras AS codigo,
+                   ai.descricao AS descricao,
+                   COALESCE(SUM(ai.diferenca), 0) AS total_unidades,
+                   COALESCE(SUM(ai.diferenca * ai.custo_unitario), 0) AS impacto_financeiro
+            FROM auditorias a
+            JOIN auditorias_itens ai ON a.id = ai.auditoria_id
+            WHERE a.empresa_id = %s AND a.data >= %s AND a.data < %s::date + 1
+            GROUP BY ai.codigo_barras, ai.descricao, a.data
+            ORDER BY a.data DESC
+        ''', (empresa_id, data_inicio, data_fim))
     
-    dados = cursor.fetchall()
-    conexao.close()
+        dados = cursor.fetchall()
     
-    resultado = []
-    for fecha, codigo, descricao, total_unidades, impacto_financeiro in dados:
-        resultado.append({
-            "fecha": str(fecha)[:10],           # YYYY-MM-DD
-            "codigo": codigo,                   # Código de barras
-            "tipo": "Auditoria",                # Fixo para todas as linhas
-            "descricao": descricao,             # Nome do produto
-            "total_unidades": total_unidades,   # Soma das diferenças (pode ser negativo)
-            "impacto_financeiro": impacto_financeiro  # Impacto em guaranies
-        })
+        resultado = []
+        for fecha, codigo, descricao, total_unidades, impacto_financeiro in dados:
+            resultado.append({
+                "fecha": str(fecha)[:10],           # YYYY-MM-DD
+                "codigo": codigo,                   # Código de barras
+                "tipo": "Auditoria",                # Fixo para todas as linhas
+                "descricao": descricao,             # Nome do produto
+                "total_unidades": total_unidades,   # Soma das diferenças (pode ser negativo)
+                "impacto_financeiro": impacto_financeiro  # Impacto em guaranies
+            })
     
-    return resultado
+        return resultado
 
 def listar_auditorias(empresa_id, data_inicio, data_fim):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
     
-    cursor.execute('''
-        SELECT id,
-               data,
-               COALESCE(impacto_financeiro, 0) AS impacto_financeiro,
-               COALESCE(total_itens, 0) AS total_itens
-        FROM auditorias
-        WHERE empresa_id = %s AND DATE(data) BETWEEN %s AND %s
-        ORDER BY data DESC
-    ''', (empresa_id, data_inicio, data_fim))
+        cursor.execute('''
+            SELECT id,
+                   data,
+                   COALESCE(impacto_financeiro, 0) AS impacto_financeiro,
+                   COALESCE(total_itens, 0) AS total_itens
+            FROM auditorias
+            WHERE empresa_id = %s AND data >= %s AND data < %s::date + 1
+            ORDER BY data DESC
+        ''', (empresa_id, data_inicio, data_fim))
     
-    dados = cursor.fetchall()
-    conexao.close()
+        dados = cursor.fetchall()
     
-    resultado = []
-    for id, data, impacto_financeiro, total_itens in dados:
-        resultado.append({
-            "id": id,
-            "data": str(data),                  # Data completa (YYYY-MM-DD)
-            "impacto_financeiro": impacto_financeiro,  # Impacto total da auditoria
-            "total_itens": total_itens          # Número de itens auditados
-        })
+        resultado = []
+        for id, data, impacto_financeiro, total_itens in dados:
+            resultado.append({
+                "id": id,
+                "data": str(data),                  # Data completa (YYYY-MM-DD)
+                "impacto_financeiro": impacto_financeiro,  # Impacto total da auditoria
+                "total_itens": total_itens          # Número de itens auditados
+            })
     
-    return resultado
+        return resultado
 
 def obter_detalhes_auditoria(empresa_id, auditoria_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('''
-        SELECT codigo_barras, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario
-        FROM auditorias_itens
-        WHERE auditoria_id = %s AND EXISTS (SELECT 1 FROM auditorias WHERE id = %s AND empresa_id = %s)
-        ORDER BY id
-    ''', (auditoria_id, auditoria_id, empresa_id))
-    linhas = cursor.fetchall()
-    conexao.close()
-    resultado = []
-    for codigo, descricao, qtd_sistema, qtd_fisica, diferenca, custo in linhas:
-        resultado.append({
-            "codigo": codigo,
-            "descricao": descricao,
-            "qtd_sistema": qtd_sistema,
-            "qtd_fisica": qtd_fisica,
-            "diferenca": diferenca,
-            "impacto": diferenca * custo
-        })
-    return resultado
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            SELECT codigo_barras, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario
+            FROM auditorias_itens
+            WHERE auditoria_id = %s AND EXISTS (SELECT 1 FROM auditorias WHERE id = %s AND empresa_id = %s)
+            ORDER BY id
+        ''', (auditoria_id, auditoria_id, empresa_id))
+        linhas = cursor.fetchall()
+        resultado = []
+        for codigo, descricao, qtd_sistema, qtd_fisica, diferenca, custo in linhas:
+            resultado.append({
+                "codigo": codigo,
+                "descricao": descricao,
+                "qtd_sistema": qtd_sistema,
+                "qtd_fisica": qtd_fisica,
+                "diferenca": diferenca,
+                "impacto": diferenca * custo
+            })
+        return resultado
 
 def registrar_merma(empresa_id, codigo_barras, quantidade, motivo):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        cursor.execute('SELECT descricao, preco_custo, quantidade FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, codigo_barras))
-        prod = cursor.fetchone()
-        if not prod: return False, "Producto no encontrado."
-        desc, custo, qtd_atual = prod
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            cursor.execute('SELECT descricao, preco_custo, quantidade FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, codigo_barras))
+            prod = cursor.fetchone()
+            if not prod: return False, "Producto no encontrado."
+            desc, custo, qtd_atual = prod
         
-        if qtd_atual < quantidade:
-            return False, f"Stock insuficiente (Solo tienes {qtd_atual})."
+            if qtd_atual < quantidade:
+                return False, f"Stock insuficiente (Solo tienes {qtd_atual})."
 
-        cursor.execute('UPDATE produtos SET quantidade = quantidade - %s WHERE empresa_id = %s AND codigo_barras = %s', (quantidade, empresa_id, codigo_barras))
-        cursor.execute('INSERT INTO mermas (empresa_id, codigo_barras, descricao, quantidade, custo_unitario, motivo) VALUES (%s, %s, %s, %s, %s, %s)', (empresa_id, codigo_barras, desc, quantidade, custo, motivo))
+            cursor.execute('UPDATE produtos SET quantidade = quantidade - %s WHERE empresa_id = %s AND codigo_barras = %s', (quantidade, empresa_id, codigo_barras))
+            cursor.execute('INSERT INTO mermas (empresa_id, codigo_barras, descricao, quantidade, custo_unitario, motivo) VALUES (%s, %s, %s, %s, %s, %s)', (empresa_id, codigo_barras, desc, quantidade, custo, motivo))
         
-        conexao.commit()
-        return True, "Baja de producto registrada correctamente."
-    except Exception as e:
-        conexao.rollback()
-        return False, str(e)
-    finally:
-        cursor.close()
-        conexao.close()
+            conexao.commit()
+            return True, "Baja de producto registrada correctamente."
+        except Exception as e:
+            conexao.rollback()
+            return False, str(e)
+        finally:
+            cursor.close()
 
 def listar_mermas(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT id, codigo_barras, descricao, quantidade, custo_unitario, motivo, data_registro FROM mermas WHERE empresa_id = %s ORDER BY id DESC', (empresa_id,))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "codigo": l[1], "descricao": l[2], "quantidade": l[3], "custo": l[4], "motivo": l[5], "data": str(l[6])[:16]} for l in linhas]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT id, codigo_barras, descricao, quantidade, custo_unitario, motivo, data_registro FROM mermas WHERE empresa_id = %s ORDER BY id DESC', (empresa_id,))
+        linhas = cursor.fetchall()
+        return [{"id": l[0], "codigo": l[1], "descricao": l[2], "quantidade": l[3], "custo": l[4], "motivo": l[5], "data": str(l[6])[:16]} for l in linhas]
 
 def salvar_nota_remision(empresa_id, ruc_dest, nome_dest, motivo, chapa, chofer, cdc, itens, link_pdf, link_qrcode):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    itens_json = json.dumps(itens)
-    cursor.execute('''
-        INSERT INTO notas_remision (empresa_id, ruc_destinatario, nome_destinatario, motivo, chapa_vehiculo, dados_chofer, cdc, itens, link_pdf, link_qrcode)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (empresa_id, ruc_dest, nome_dest, motivo, chapa, chofer, cdc, itens_json, link_pdf, link_qrcode))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        itens_json = json.dumps(itens)
+        cursor.execute('''
+            INSERT INTO notas_remision (empresa_id, ruc_destinatario, nome_destinatario, motivo, chapa_vehiculo, dados_chofer, cdc, itens, link_pdf, link_qrcode)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (empresa_id, ruc_dest, nome_dest, motivo, chapa, chofer, cdc, itens_json, link_pdf, link_qrcode))
+        conexao.commit()
 
 def listar_remisiones(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT id, nome_destinatario, motivo, cdc, link_pdf, data_emissao FROM notas_remision WHERE empresa_id = %s ORDER BY id DESC", (empresa_id,))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "destinatario": l[1], "motivo": l[2], "cdc": l[3], "link_pdf": l[4], "data": str(l[5])[:16]} for l in linhas]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("SELECT id, nome_destinatario, motivo, cdc, link_pdf, data_emissao FROM notas_remision WHERE empresa_id = %s ORDER BY id DESC", (empresa_id,))
+        linhas = cursor.fetchall()
+        return [{"id": l[0], "destinatario": l[1], "motivo": l[2], "cdc": l[3], "link_pdf": l[4], "data": str(l[5])[:16]} for l in linhas]
 
 def salvar_autofactura(empresa_id, nome_vendedor, cedula, endereco, cdc, itens, mover_stock, link_pdf, link_qrcode):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        valor_total = sum(i['quantidade'] * i['preco_unitario'] for i in itens)
-        itens_json = json.dumps(itens)
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            valor_total = sum(i['quantidade'] * i['preco_unitario'] for i in itens)
+            itens_json = json.dumps(itens)
+
+            if mover_stock:
+                _movimentar_estoque(cursor, empresa_id, [(i.get('codigo_barras'), i.get('quantidade', 0), i.get('preco_unitario', 0)) for i in itens])
+
+            cursor.execute('''
+                INSERT INTO autofacturas (empresa_id, nome_vendedor, cedula_vendedor, endereco_vendedor, cdc, valor_total, itens, link_pdf, link_qrcode)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ''', (empresa_id, nome_vendedor, cedula, endereco, cdc, valor_total, itens_json, link_pdf, link_qrcode))
+
+            cursor.execute("SELECT id FROM caixa_sessoes WHERE empresa_id = %s AND status = 'ABERTO' ORDER BY id DESC LIMIT 1", (empresa_id,))
+            caixa_aberto = cursor.fetchone()
+            if caixa_aberto:
+                cursor.execute("INSERT INTO caixa_movimentacoes (empresa_id, caixa_id, tipo, valor, motivo) VALUES (%s, %s, 'AUTOFACTURA', %s, %s)", (empresa_id, caixa_aberto[0], valor_total, f"Autofactura a {nome_vendedor}"))
+
+            conexao.commit()
+            return True, "Autofactura generada con Ã©xito."
+        except Exception as e:
+            conexao.rollback()
+            return False, str(e)
+        finally:
+            cursor.close()
 
-        if mover_stock:
-            for item in itens:
-                cod = item.get('codigo_barras')
-                qtd = item.get('quantidade', 0)
-                preco = item.get('preco_unitario', 0)
-                if cod:
-                    cursor.execute('UPDATE produtos SET quantidade = quantidade + %s, preco_custo = %s WHERE empresa_id = %s AND codigo_barras = %s', (qtd, preco, empresa_id, cod))
+def listar_autofacturas(empresa_id):
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("SELECT id, nome_vendedor, valor_total, cdc, link_pdf, data_emissao FROM autofacturas WHERE empresa_id = %s ORDER BY id DESC", (empresa_id,))
+        linhas = cursor.fetchall()
+        return [{"id": l[0], "vendedor": l[1], "valor": l[2], "cdc": l[3], "link_pdf": l[4], "data": str(l[5])[:16]} for l in linhas]
 
+def _movimentar_estoque(cursor, empresa_id, movimentos):
+    """
+    Aplica todas as variações de estoque num único UPDATE ... FROM (VALUES ...).
+    `movimentos` é uma lista de (codigo_barras, delta, novo_custo_ou_None); códigos repetidos
+    são somados e o último custo informado prevalece, como no laço linha a linha.
+    """
+    agregados = {}
+    for cod, delta, custo in movimentos:
+        if not cod: continue
+        delta_atual, custo_atual = agregados.get(cod, (0, None))
+        agregados[cod] = (delta_atual + delta, custo if custo is not None else custo_atual)
+    if not agregados: return
+    # Ordem fixa de código evita deadlock entre dois caixas movimentando os mesmos produtos
+    linhas = [(empresa_id, cod, delta, custo) for cod, (delta, custo) in sorted(agregados.items())]
+    execute_values(cursor, '''
+        UPDATE produtos p
+        SET quantidade = p.quantidade + v.delta,
+            preco_custo = COALESCE(v.custo, p.preco_custo)
+        FROM (VALUES %s) AS v(empresa_id, codigo_barras, delta, custo)
+        WHERE p.empresa_id = v.empresa_id AND p.codigo_barras = v.codigo_barras
+    ''', linhas, template='(%s::integer, %s::text, %s::integer, %s::real)', page_size=len(linhas))
+
+def carregar_contexto_emissao(empresa_id, codigos_barras):
+    """
+    Carrega numa única consulta tudo o que a emissão precisa: configuração da empresa,
+    plano, caixa aberto e as linhas de produtos dos itens do carrinho.
+    Retorna None se a empresa não existir.
+    """
+    codigos = sorted({c for c in codigos_barras if c})
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
         cursor.execute('''
-            INSERT INTO autofacturas (empresa_id, nome_vendedor, cedula_vendedor, endereco_vendedor, cdc, valor_total, itens, link_pdf, link_qrcode)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (empresa_id, nome_vendedor, cedula, endereco, cdc, valor_total, itens_json, link_pdf, link_qrcode))
+            SELECT e.nome_empresa, e.ruc, e.endereco, e.senha_certificado, e.caminho_certificado,
+                   e.ambiente_sifen, e.csc, e.mercado_pago_token, e.plano, c.id,
+                   COALESCE((
+                       SELECT json_agg(json_build_object(
+                           'codigo_barras', p.codigo_barras, 'descricao', p.descricao,
+                           'preco_custo', p.preco_custo, 'preco_venda', p.preco_venda, 'quantidade', p.quantidade))
+                       FROM produtos p
+                       WHERE p.empresa_id = e.id AND p.codigo_barras = ANY(%s)
+                   ), '[]'::json)
+            FROM empresas e
+            LEFT JOIN LATERAL (
+                SELECT id FROM caixa_sessoes
+                WHERE empresa_id = e.id AND status = 'ABERTO'
+                ORDER BY id DESC LIMIT 1
+            ) c ON TRUE
+            WHERE e.id = %s
+        ''', (codigos, empresa_id))
+        linha = cursor.fetchone()
+        cursor.close()
+    if not linha: return None
+    config = {"nome_empresa": linha[0], "ruc": linha[1], "endereco": linha[2], "senha_certificado": linha[3], "caminho_certificado": linha[4], "ambiente_sifen": linha[5], "csc": linha[6], "mercado_pago_token": linha[7]}
+    caixa = {"aberto": True, "caixa_id": linha[9]} if linha[9] else {"aberto": False}
+    return {
+        "config": config,
+        "plano": linha[8] or 'Inicial',
+        "caixa": caixa,
+        "produtos": {p["codigo_barras"]: p for p in linha[10]}
+    }
+
+# Vendas além do estoque são recusadas; 1 volta ao comportamento antigo (estoque pode ficar negativo)
+PERMITIR_ESTOQUE_NEGATIVO = os.environ.get("PERMITIR_ESTOQUE_NEGATIVO", "0") == "1"
 
-        caixa_atual = status_caixa_atual(empresa_id)
-        if caixa_atual["aberto"]:
-            cursor.execute("INSERT INTO caixa_movimentacoes (empresa_id, caixa_id, tipo, valor, motivo) VALUES (%s, %s, 'AUTOFACTURA', %s, %s)", (empresa_id, caixa_atual["caixa_id"], valor_total, f"Autofactura a {nome_vendedor}"))
+class EstoqueInsuficiente(Exception):
+    """O estoque de algum item do carrinho não cobre a venda."""
 
+def faltas_estoque(produtos, itens):
+    """
+    Códigos do carrinho cuja quantidade passa do estoque em `produtos` (linhas de
+    carregar_contexto_emissao). Itens sem produto cadastrado não são conferidos.
+    """
+    pedidos = {}
+    for i in itens:
+        i = i.dict() if hasattr(i, 'dict') else i
+        cod = i.get('codigo_barras')
+        if cod in produtos: pedidos[cod] = pedidos.get(cod, 0) + (i.get('quantidade', 0) or 0)
+    return {cod: produtos[cod]["quantidade"] or 0 for cod, qtd in pedidos.items() if qtd > (produtos[cod]["quantidade"] or 0)}
+
+def salvar_nota(empresa_id, ruc, cliente, valor, cdc, itens, link_pdf="", link_qrcode="", metodo_pago="Efectivo", contexto=None, envio_sifen=None):
+    """
+    Baixa o estoque e grava a nota, os itens, o resumo do dia e a outbox da SIFEN num único
+    comando (CTEs) e numa única transação: com o `contexto` de carregar_contexto_emissao, a venda
+    é essa ida ao banco mais o COMMIT. A baixa só acontece se o estoque ainda cobrir cada item
+    (dois caixas vendendo o último produto): senão nada é gravado e sobe EstoqueInsuficiente.
+    Com `envio_sifen` ({"xml_assinado", "ambiente"}), o documento entra na fila de envio junto com a nota.
+    """
+    itens_com_custo = [item.dict() if hasattr(item, 'dict') else item for item in itens]
+    if contexto is None:
+        contexto = carregar_contexto_emissao(empresa_id, [i.get('codigo_barras') for i in itens_com_custo])
+    caixa_id = contexto["caixa"]["caixa_id"] if contexto["caixa"]["aberto"] else 0
+    produtos = contexto["produtos"]
+
+    baixas = {}
+    for item_dict in itens_com_custo:
+        cod = item_dict.get('codigo_barras')
+        item_dict['preco_custo'] = (produtos[cod]["preco_custo"] or 0) if cod in produtos else 0
+        # Só produtos cadastrados movimentam estoque, como no UPDATE linha a linha de antes
+        if cod in produtos: baixas[cod] = baixas.get(cod, 0) + (item_dict.get('quantidade', 0) or 0)
+    estoque = [{"codigo_barras": cod, "quantidade": qtd} for cod, qtd in sorted(baixas.items())]
+
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            WITH mov AS (
+                SELECT * FROM json_to_recordset(%(estoque)s::json) AS v(codigo_barras TEXT, quantidade INTEGER)
+            ),
+            baixa AS (
+                UPDATE produtos p SET quantidade = p.quantidade - mov.quantidade
+                FROM mov
+                WHERE p.empresa_id = %(empresa_id)s AND p.codigo_barras = mov.codigo_barras
+                  AND (%(estoque_negativo)s OR p.quantidade >= mov.quantidade)
+                RETURNING p.codigo_barras
+            ),
+            nota AS (
+                INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, cdc, itens, link_pdf, link_qrcode, metodo_pago, caixa_id)
+                SELECT %(empresa_id)s, %(ruc)s, %(cliente)s, %(valor)s, %(cdc)s, %(itens)s, %(link_pdf)s, %(link_qrcode)s, %(metodo_pago)s, %(caixa_id)s
+                WHERE (SELECT COUNT(*) FROM baixa) = (SELECT COUNT(*) FROM mov)
+                RETURNING id
+            ),
+            itens AS (
+                INSERT INTO nota_itens (nota_id, codigo_barras, descricao, quantidade, preco_unitario, preco_custo)
+                SELECT nota.id, i.codigo_barras, i.descricao, COALESCE(i.quantidade, 0), COALESCE(i.preco_unitario, 0), COALESCE(i.preco_custo, 0)
+                FROM nota, json_to_recordset(%(itens)s::json) AS i(codigo_barras TEXT, descricao TEXT, quantidade INTEGER, preco_unitario REAL, preco_custo REAL)
+            ),
+            resumo AS (
+                INSERT INTO resumo_vendas_dia (empresa_id, dia, faturamento, tickets)
+                SELECT %(empresa_id)s, CURRENT_DATE, %(valor_resumo)s, 1 FROM nota
+                ON CONFLICT (empresa_id, dia) DO UPDATE
+                SET faturamento = resumo_vendas_dia.faturamento + EXCLUDED.faturamento,
+                    tickets = resumo_vendas_dia.tickets + 1
+            ),
+            resumo_pagamento AS (
+                INSERT INTO resumo_vendas_dia_pagamentos (empresa_id, dia, metodo_pago, total, tickets)
+                SELECT %(empresa_id)s, CURRENT_DATE, %(metodo_resumo)s, %(valor_resumo)s, 1 FROM nota
+                ON CONFLICT (empresa_id, dia, metodo_pago) DO UPDATE
+                SET total = resumo_vendas_dia_pagamentos.total + EXCLUDED.total,
+                    tickets = resumo_vendas_dia_pagamentos.tickets + 1
+            ),
+            resumo_produtos AS (
+                INSERT INTO resumo_vendas_dia_produtos (empresa_id, dia, nome, quantidade, receita)
+                SELECT %(empresa_id)s, CURRENT_DATE, r.nome, r.quantidade, r.receita
+                FROM nota, json_to_recordset(%(resumo_produtos)s::json) AS r(nome TEXT, quantidade INTEGER, receita REAL)
+                ON CONFLICT (empresa_id, dia, nome) DO UPDATE
+                SET quantidade = resumo_vendas_dia_produtos.quantidade + EXCLUDED.quantidade,
+                    receita = resumo_vendas_dia_produtos.receita + EXCLUDED.receita
+            ),
+            envio AS (
+                INSERT INTO sifen_envios (empresa_id, cdc, tipo_documento, ambiente, xml_assinado)
+                SELECT %(empresa_id)s, %(cdc)s, 'FACTURA', %(ambiente)s, %(xml_assinado)s FROM nota
+                WHERE %(enfileirar)s
+            )
+            SELECT id FROM nota
+        ''', {
+            "empresa_id": empresa_id, "ruc": ruc, "cliente": cliente, "valor": valor, "cdc": cdc,
+            "itens": json.dumps(itens_com_custo), "link_pdf": link_pdf, "link_qrcode": link_qrcode,
+            "metodo_pago": metodo_pago, "caixa_id": caixa_id, "estoque": json.dumps(estoque),
+            "estoque_negativo": PERMITIR_ESTOQUE_NEGATIVO,
+            "valor_resumo": valor or 0, "metodo_resumo": metodo_pago or 'Efectivo',
+            "resumo_produtos": json.dumps(_resumo_produtos_venda(itens_com_custo)),
+            "enfileirar": bool(envio_sifen),
+            "ambiente": (envio_sifen or {}).get("ambiente", "testes"),
+            "xml_assinado": (envio_sifen or {}).get("xml_assinado"),
+        })
+        if cursor.fetchone() is None:
+            # Outro caixa levou o estoque entre a leitura do contexto e a baixa: desfaz tudo
+            conexao.rollback()
+            raise EstoqueInsuficiente("Stock insuficiente para completar la venta.")
         conexao.commit()
-        return True, "Autofactura generada con Ã©xito."
-    except Exception as e:
-        conexao.rollback()
-        return False, str(e)
-    finally:
-        cursor.close()
-        conexao.close()
 
-def listar_autofacturas(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT id, nome_vendedor, valor_total, cdc, link_pdf, data_emissao FROM autofacturas WHERE empresa_id = %s ORDER BY id DESC", (empresa_id,))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "vendedor": l[1], "valor": l[2], "cdc": l[3], "link_pdf": l[4], "data": str(l[5])[:16]} for l in linhas]
-
-def salvar_nota(empresa_id, ruc, cliente, valor, cdc, itens, link_pdf="", link_qrcode="", metodo_pago="Efectivo"):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    caixa_atual = status_caixa_atual(empresa_id)
-    caixa_id = caixa_atual["caixa_id"] if caixa_atual["aberto"] else 0
-
-    itens_com_custo = []
-    for item in itens:
-        item_dict = item.dict() if hasattr(item, 'dict') else item
-        if item_dict.get('codigo_barras'):
-            cursor.execute('SELECT preco_custo FROM produtos WHERE empresa_id = %s AND codigo_barras = %s', (empresa_id, item_dict['codigo_barras']))
-            row = cursor.fetchone()
-            item_dict['preco_custo'] = row[0] if row else 0
-            cursor.execute('UPDATE produtos SET quantidade = quantidade - %s WHERE empresa_id = %s AND codigo_barras = %s', (item_dict.get('quantidade', 0), empresa_id, item_dict['codigo_barras']))
-        else:
-            item_dict['preco_custo'] = 0 
-        itens_com_custo.append(item_dict)
-
-    itens_json = json.dumps(itens_com_custo)
-    cursor.execute('''
-        INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, cdc, itens, link_pdf, link_qrcode, metodo_pago, caixa_id) 
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-    ''', (empresa_id, ruc, cliente, valor, cdc, itens_json, link_pdf, link_qrcode, metodo_pago, caixa_id))
-    conexao.commit()
-    conexao.close()
-
-def salvar_nota_credito(empresa_id, cdc_ref, cdc_novo, cliente, valor, itens, link_pdf=""):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    itens_json = json.dumps(itens)
+def salvar_nota_credito(empresa_id, cdc_ref, cdc_novo, cliente, valor, itens, link_pdf="", envio_sifen=None):
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        itens = [item.dict() if hasattr(item, 'dict') else item for item in itens]
+        itens_json = json.dumps(itens)
     
-    for item in itens:
-        if item.get('codigo_barras'):
-            cursor.execute('UPDATE produtos SET quantidade = quantidade + %s WHERE empresa_id = %s AND codigo_barras = %s', (item.get('quantidade', 0), empresa_id, item['codigo_barras']))
+        _movimentar_estoque(cursor, empresa_id, [(i.get('codigo_barras'), i.get('quantidade', 0), None) for i in itens])
             
+        cursor.execute('''
+            INSERT INTO notas_credito (empresa_id, cdc_referencia, cdc_novo, nome_cliente, valor_total, itens, link_pdf)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ''', (empresa_id, cdc_ref, cdc_novo, cliente, valor, itens_json, link_pdf))
+        _acumular_resumo_credito(cursor, empresa_id, valor)
+        if envio_sifen: _enfileirar_envio_sifen(cursor, empresa_id, cdc_novo, "NOTA_CREDITO", envio_sifen)
+        conexao.commit()
+
+def _enfileirar_envio_sifen(cursor, empresa_id, cdc, tipo_documento, envio):
+    """Grava o documento assinado na outbox, na mesma transação da nota"""
     cursor.execute('''
-        INSERT INTO notas_credito (empresa_id, cdc_referencia, cdc_novo, nome_cliente, valor_total, itens, link_pdf)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-    ''', (empresa_id, cdc_ref, cdc_novo, cliente, valor, itens_json, link_pdf))
-    conexao.commit()
-    conexao.close()
-
-def listar_todas_notas(empresa_id, busca="", data_inicio=None, data_fim=None):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    
-    query = "SELECT id, nome_cliente, valor_total, cdc, link_pdf, data_emissao, metodo_pago FROM notas WHERE empresa_id = %s"
+        INSERT INTO sifen_envios (empresa_id, cdc, tipo_documento, ambiente, xml_assinado)
+        VALUES (%s, %s, %s, %s, %s)
+    ''', (empresa_id, cdc, tipo_documento, envio.get("ambiente", "testes"), envio["xml_assinado"]))
+
+def reservar_bloco_numeracao(empresa_id, estab, pex, tipo_doc, tamanho):
+    """
+    Reserva `tamanho` números consecutivos e devolve o primeiro.
+    A linha fica travada só durante este UPDATE curto, não durante a venda.
+    """
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            INSERT INTO sequencias_documentos (empresa_id, estab, pex, tipo_doc, proximo)
+            VALUES (%s, %s, %s, %s, %s + 1)
+            ON CONFLICT (empresa_id, estab, pex, tipo_doc) DO UPDATE
+            SET proximo = sequencias_documentos.proximo + EXCLUDED.proximo - 1
+            RETURNING proximo - %s
+        ''', (empresa_id, estab, pex, tipo_doc, tamanho, tamanho))
+        inicio = cursor.fetchone()[0]
+        conexao.commit()
+        return inicio
+
+def devolver_sobra_numeracao(empresa_id, estab, pex, tipo_doc, proximo, fim):
+    """
+    Devolve os números [proximo, fim) de um bloco não usado. Só funciona se o bloco ainda for o
+    último reservado (sequência em `fim`); senão a sobra vira buraco. Retorna True se devolveu.
+    """
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            UPDATE sequencias_documentos SET proximo = %s
+            WHERE empresa_id = %s AND estab = %s AND pex = %s AND tipo_doc = %s AND proximo = %s
+        ''', (proximo, empresa_id, estab, pex, tipo_doc, fim))
+        devolvido = cursor.rowcount == 1
+        conexao.commit()
+        return devolvido
+
+def registrar_pagamento_pix(empresa_id, pagamento_id, valor_guaranis, valor_reais, cotacao):
+    """Guarda a cobrança PIX com a cotação usada (`cotacao` vem de cambio.obter_cotacao)."""
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            INSERT INTO pagamentos_pix (empresa_id, pagamento_id, valor_guaranis, valor_reais, taxa_cambio, fonte_taxa, taxa_obtida_em)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (pagamento_id) DO NOTHING
+        ''', (empresa_id, str(pagamento_id), valor_guaranis, valor_reais, cotacao["taxa"], cotacao["fonte"], cotacao["obtida_em"]))
+        conexao.commit()
+
+def atualizar_status_pix(empresa_id, pagamento_id, status):
+    """Grava o status vindo do Mercado Pago. Retorna False se a cobrança não é desta empresa."""
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            UPDATE pagamentos_pix SET status = %s, status_atualizado_em = CURRENT_TIMESTAMP
+            WHERE empresa_id = %s AND pagamento_id = %s
+        ''', (status, empresa_id, str(pagamento_id)))
+        conexao.commit()
+        return cursor.rowcount > 0
+
+def obter_status_pix(empresa_id, pagamento_id):
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            SELECT status, status_atualizado_em FROM pagamentos_pix
+            WHERE empresa_id = %s AND pagamento_id = %s
+        ''', (empresa_id, str(pagamento_id)))
+        linha = cursor.fetchone()
+    if not linha: return None
+    return {"status": linha[0], "atualizado_em": str(linha[1]) if linha[1] else None}
+
+def reservar_envio_sifen(envio_travado_s=300):
+    """
+    Pega o próximo envio vencido e marca como ENVIANDO. SKIP LOCKED deixa vários workers
+    (e vários processos) dividirem a fila; envios presos em ENVIANDO por mais de
+    `envio_travado_s` (worker que morreu no meio) voltam a ser elegíveis.
+    """
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            UPDATE sifen_envios SET status = 'ENVIANDO', tentativas = tentativas + 1, atualizado_em = NOW()
+            WHERE id = (
+                SELECT id FROM sifen_envios
+                WHERE (status = 'PENDENTE' AND proxima_tentativa <= NOW())
+                   OR (status = 'ENVIANDO' AND atualizado_em < NOW() - %s * INTERVAL '1 second')
+                ORDER BY proxima_tentativa
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, empresa_id, cdc, tipo_documento, ambiente, xml_assinado, tentativas
+        ''', (envio_travado_s,))
+        linha = cursor.fetchone()
+        conexao.commit()
+    if not linha: return None
+    return {"id": linha[0], "empresa_id": linha[1], "cdc": linha[2], "tipo_documento": linha[3], "ambiente": linha[4], "xml_assinado": linha[5], "tentativas": linha[6]}
+
+def registrar_resultado_envio_sifen(envio_id, status, codigo_retorno=None, mensagem_retorno=None, reenviar_em_s=None):
+    """Grava dCodRes/dMsgRes (ou o erro); com `reenviar_em_s` o envio volta para a fila"""
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            UPDATE sifen_envios
+            SET status = %s, codigo_retorno = %s, mensagem_retorno = %s, atualizado_em = NOW(),
+                proxima_tentativa = NOW() + COALESCE(%s, 0) * INTERVAL '1 second'
+            WHERE id = %s
+        ''', (status, codigo_retorno, mensagem_retorno, reenviar_em_s, envio_id))
+        conexao.commit()
+
+def reservar_lote_sifen(minimo, maximo=50, envio_travado_s=300):
+    """
+    Pega até `maximo` envios vencidos de uma mesma empresa/ambiente (mesmo certificado) e do mesmo
+    tipo de documento (a SIFEN não aceita tipos misturados num lote), desde que haja pelo menos `minimo`. Retorna (empresa_id, ambiente, envios) ou None.
+    """
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            WITH candidata AS (
+                SELECT empresa_id, ambiente, tipo_documento FROM sifen_envios
+                WHERE status = 'PENDENTE' AND proxima_tentativa <= NOW()
+                GROUP BY empresa_id, ambiente, tipo_documento
+                HAVING COUNT(*) >= %s
+                ORDER BY MIN(proxima_tentativa)
+                LIMIT 1
+            )
+            UPDATE sifen_envios SET status = 'ENVIANDO', tentativas = tentativas + 1, atualizado_em = NOW()
+            WHERE id IN (
+                SELECT e.id FROM sifen_envios e
+                JOIN candidata c ON c.empresa_id = e.empresa_id AND c.ambiente = e.ambiente
+                    AND c.tipo_documento = e.tipo_documento
+                WHERE e.status = 'PENDENTE' AND e.proxima_tentativa <= NOW()
+                ORDER BY e.id
+                FOR UPDATE OF e SKIP LOCKED
+                LIMIT %s
+            )
+            RETURNING id, empresa_id, cdc, tipo_documento, ambiente, xml_assinado, tentativas
+        ''', (minimo, maximo))
+        linhas = cursor.fetchall()
+        conexao.commit()
+    if not linhas: return None
+    envios = [{"id": l[0], "empresa_id": l[1], "cdc": l[2], "tipo_documento": l[3], "ambiente": l[4], "xml_assinado": l[5], "tentativas": l[6]} for l in sorted(linhas)]
+    return envios[0]["empresa_id"], envios[0]["ambiente"], envios
+
+def registrar_lote_enviado(empresa_id, ambiente, protocolo, envio_ids, consultar_em_s):
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            INSERT INTO sifen_lotes (empresa_id, ambiente, protocolo, proxima_consulta)
+            VALUES (%s, %s, %s, NOW() + %s * INTERVAL '1 second')
+            RETURNING id
+        ''', (empresa_id, ambiente, protocolo, consultar_em_s))
+        lote_id = cursor.fetchone()[0]
+        cursor.execute("UPDATE sifen_envios SET status = 'EN_LOTE', lote_id = %s, atualizado_em = NOW() WHERE id = ANY(%s)", (lote_id, list(envio_ids)))
+        conexao.commit()
+        return lote_id
+
+def reagendar_envios_sifen(envio_ids, mensagem_retorno, reenviar_em_s):
+    """Devolve envios (de um lote que falhou) para a fila"""
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            UPDATE sifen_envios
+            SET status = 'PENDENTE', lote_id = NULL, mensagem_retorno = %s, atualizado_em = NOW(),
+                proxima_tentativa = NOW() + %s * INTERVAL '1 second'
+            WHERE id = ANY(%s)
+        ''', (mensagem_retorno, reenviar_em_s, list(envio_ids)))
+        conexao.commit()
+
+def reservar_consulta_lote_sifen(intervalo_s):
+    """Pega um lote com consulta vencida e já empurra a próxima consulta, para outro worker não repetir"""
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            UPDATE sifen_lotes SET consultas = consultas + 1, proxima_consulta = NOW() + %s * INTERVAL '1 second'
+            WHERE id = (
+                SELECT id FROM sifen_lotes
+                WHERE status = 'ENVIADO' AND proxima_consulta <= NOW()
+                ORDER BY proxima_consulta
+                FOR UPDATE SKIP LOCKED
+                LIMIT 1
+            )
+            RETURNING id, empresa_id, ambiente, protocolo, consultas
+        ''', (intervalo_s,))
+        linha = cursor.fetchone()
+        conexao.commit()
+    if not linha: return None
+    return {"id": linha[0], "empresa_id": linha[1], "ambiente": linha[2], "protocolo": linha[3], "consultas": linha[4]}
+
+def concluir_lote_sifen(lote_id, resultados, status_lote="PROCESADO", mensagem_lote=None, espera_backoff=None, max_tentativas=None):
+    """
+    Distribui o resultado do lote para cada envio (por CDC) num único UPDATE.
+    Envios do lote sem resultado voltam para a fila individual com `espera_backoff(tentativas)`
+    segundos de espera, ou ficam em ERRO quando já passaram de `max_tentativas`.
+    """
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        if resultados:
+            linhas = [(lote_id, r["cdc"], "APROBADO" if r["aprovado"] else "RECHAZADO", str(r["codigo_retorno"]), r["mensagem_retorno"]) for r in resultados]
+            execute_values(cursor, '''
+                UPDATE sifen_envios e
+                SET status = v.status, codigo_retorno = v.codigo, mensagem_retorno = v.mensagem, atualizado_em = NOW()
+                FROM (VALUES %s) AS v(lote_id, cdc, status, codigo, mensagem)
+                WHERE e.lote_id = v.lote_id AND e.cdc = v.cdc
+            ''', linhas, page_size=len(linhas))
+        cursor.execute("SELECT id, tentativas FROM sifen_envios WHERE lote_id = %s AND status = 'EN_LOTE' FOR UPDATE", (lote_id,))
+        restantes = cursor.fetchall()
+        if restantes:
+            # Mesmas regras do envio avulso: espera crescente e desistência após o limite de tentativas
+            linhas = [(
+                envio_id,
+                "ERRO" if max_tentativas and tentativas >= max_tentativas else "PENDENTE",
+                espera_backoff(tentativas) if espera_backoff else 0,
+                mensagem_lote,
+            ) for envio_id, tentativas in restantes]
+            execute_values(cursor, '''
+                UPDATE sifen_envios e
+                SET status = v.status, lote_id = NULL, mensagem_retorno = COALESCE(v.mensagem, e.mensagem_retorno), atualizado_em = NOW(),
+                    proxima_tentativa = NOW() + v.espera * INTERVAL '1 second'
+                FROM (VALUES %s) AS v(id, status, espera, mensagem)
+                WHERE e.id = v.id
+            ''', linhas, template="(%s, %s, %s::float, %s::text)", page_size=len(linhas))
+        cursor.execute("UPDATE sifen_lotes SET status = %s, mensagem_retorno = %s WHERE id = %s", (status_lote, mensagem_lote, lote_id))
+        conexao.commit()
+
+def obter_status_sifen(empresa_id, cdc):
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            SELECT status, tentativas, codigo_retorno, mensagem_retorno, atualizado_em
+            FROM sifen_envios WHERE empresa_id = %s AND cdc = %s
+            ORDER BY id DESC LIMIT 1
+        ''', (empresa_id, cdc))
+        linha = cursor.fetchone()
+    if not linha: return None
+    return {"cdc": cdc, "status": linha[0], "tentativas": linha[1], "codigo_retorno": linha[2], "mensagem_retorno": linha[3], "atualizado_em": str(linha[4])[:19]}
+
+LIMITE_PAGINA_NOTAS = 50
+LIMITE_MAX_PAGINA_NOTAS = 200
+
+def _filtros_notas(empresa_id, busca="", data_inicio=None, data_fim=None):
+    """WHERE comum à listagem e à contagem do histórico"""
+    where = "empresa_id = %s"
     params = [empresa_id]
-    
     if data_inicio and data_fim:
-        query += " AND DATE(data_emissao) >= %s AND DATE(data_emissao) <= %s"
+        where += " AND data_emissao >= %s AND data_emissao < %s::date + 1"
         params.extend([data_inicio, data_fim])
-        
     if busca:
-        query += " AND (nome_cliente ILIKE %s OR cdc ILIKE %s)"
-        params.extend([f"%{busca}%", f"%{busca}%"])
-        
-    query += " ORDER BY id DESC"
-    
-    cursor.execute(query, tuple(params))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "nome_cliente": l[1], "valor_total": l[2], "cdc": l[3], "link_pdf": l[4], "data_emissao": l[5], "metodo_pago": l[6]} for l in linhas]
+        # CDC por prefixo (índice text_pattern_ops); cliente por trecho (índice de trigramas)
+        busca_like = busca.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        where += " AND (nome_cliente ILIKE %s OR cdc LIKE %s)"
+        params.extend([f"%{busca_like}%", f"{busca_like}%"])
+    return where, params
+
+def listar_todas_notas(empresa_id, busca="", data_inicio=None, data_fim=None, after_id=None, limite=LIMITE_PAGINA_NOTAS):
+    """
+    Uma página do histórico, da nota mais nova para a mais antiga.
+    Paginação por chave: `after_id` é o menor id da página anterior.
+    Retorna (notas, proximo_after_id), com proximo_after_id = None na última página.
+    """
+    limite = max(1, min(int(limite or LIMITE_PAGINA_NOTAS), LIMITE_MAX_PAGINA_NOTAS))
+    where, params = _filtros_notas(empresa_id, busca, data_inicio, data_fim)
+    if after_id:
+        where += " AND id < %s"
+        params.append(after_id)
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        # Uma linha a mais só para saber se existe próxima página
+        cursor.execute(f"SELECT id, nome_cliente, valor_total, cdc, link_pdf, data_emissao, metodo_pago FROM notas WHERE {where} ORDER BY id DESC LIMIT %s", tuple(params + [limite + 1]))
+        linhas = cursor.fetchall()
+    notas = [{"id": l[0], "nome_cliente": l[1], "valor_total": l[2], "cdc": l[3], "link_pdf": l[4], "data_emissao": l[5], "metodo_pago": l[6]} for l in linhas[:limite]]
+    proximo = notas[-1]["id"] if len(linhas) > limite else None
+    return notas, proximo
+
+def contar_notas(empresa_id, busca="", data_inicio=None, data_fim=None):
+    where, params = _filtros_notas(empresa_id, busca, data_inicio, data_fim)
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute(f"SELECT COUNT(*) FROM notas WHERE {where}", tuple(params))
+        return cursor.fetchone()[0]
 
 def gerar_vendas_mock_hoje(empresa_id):
     """Gera vendas fictícias para hoje, apenas para a demo."""
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    # Verificar se a empresa é demo (RUC 9999999-9)
-    cursor.execute('SELECT ruc FROM empresas WHERE id = %s', (empresa_id,))
-    row = cursor.fetchone()
-    if not row or row[0] != '9999999-9':
-        conexao.close()
-        return False
-    # Buscar produtos existentes da empresa (todos)
-    cursor.execute('SELECT codigo_barras, descricao, preco_venda FROM produtos WHERE empresa_id = %s', (empresa_id,))
-    produtos = cursor.fetchall()
-    if not produtos:
-        conexao.close()
-        return False
-    import random
-    from datetime import datetime, timedelta
-    metodos = ['EFECTIVO', 'TARJETA', 'TRANSFERENCIA']
-    clientes = ['Juan Pérez', 'María Gómez', 'Carlos López', 'Ana Martínez', 'Pedro Rodríguez',
-                'Laura Silva', 'Roberto Fernández', 'Claudia Rojas', 'Miguel Ángel', 'Sofía Castro']
-    # Gerar entre 5 e 15 vendas para hoje
-    num_vendas = random.randint(5, 15)
-    hoje = datetime.now().date()
-    for i in range(num_vendas):
-        # Horário aleatório ao longo do dia
-        horas = random.randint(8, 20)
-        minutos = random.randint(0, 59)
-        data_emissao = datetime(hoje.year, hoje.month, hoje.day, horas, minutos)
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        # Verificar se a empresa é demo (RUC 9999999-9)
+        cursor.execute('SELECT ruc FROM empresas WHERE id = %s', (empresa_id,))
+        row = cursor.fetchone()
+        if not row or row[0] != '9999999-9':
+            return False
+        # Buscar produtos existentes da empresa (todos)
+        cursor.execute('SELECT codigo_barras, descricao, preco_venda FROM produtos WHERE empresa_id = %s', (empresa_id,))
+        produtos = cursor.fetchall()
+        if not produtos:
+            return False
+        import random
+        from datetime import datetime, timedelta
+        metodos = ['EFECTIVO', 'TARJETA', 'TRANSFERENCIA']
+        clientes = ['Juan Pérez', 'María Gómez', 'Carlos López', 'Ana Martínez', 'Pedro Rodríguez',
+                    'Laura Silva', 'Roberto Fernández', 'Claudia Rojas', 'Miguel Ángel', 'Sofía Castro']
+        # Gerar entre 5 e 15 vendas para hoje
+        num_vendas = random.randint(5, 15)
+        hoje = datetime.now().date()
+        for i in range(num_vendas):
+            # Horário aleatório ao longo do dia
+            horas = random.randint(8, 20)
+            minutos = random.randint(0, 59)
+            data_emissao = datetime(hoje.year, hoje.month, hoje.day, horas, minutos)
         
-        cliente = random.choice(clientes)
-        metodo = random.choice(metodos)
-        itens = []
-        total = 0
-        # 1 a 3 itens por venda
-        for _ in range(random.randint(1, 3)):
-            prod = random.choice(produtos)
-            codigo = prod[0]
-            descricao = prod[1]
-            preco = prod[2]
-            quantidade = random.randint(1, 6)
-            # Calcular IVA (10%)
-            iva_unitario = round(preco * 0.1, 0)
-            itens.append({
-                "codigo_barras": codigo,
-                "descricao": descricao,
-                "preco_unitario": preco,
-                "quantidade": quantidade,
-                "iva_unitario": int(iva_unitario),
-                "subtotal": preco * quantidade,
-                "iva_total": int(iva_unitario * quantidade)
-            })
-            total += preco * quantidade
+            cliente = random.choice(clientes)
+            metodo = random.choice(metodos)
+            itens = []
+            total = 0
+            # 1 a 3 itens por venda
+            for _ in range(random.randint(1, 3)):
+                prod = random.choice(produtos)
+                codigo = prod[0]
+                descricao = prod[1]
+                preco = prod[2]
+                quantidade = random.randint(1, 6)
+                # Calcular IVA (10%)
+                iva_unitario = round(preco * 0.1, 0)
+                itens.append({
+                    "codigo_barras": codigo,
+                    "descricao": descricao,
+                    "preco_unitario": preco,
+                    "quantidade": quantidade,
+                    "iva_unitario": int(iva_unitario),
+                    "subtotal": preco * quantidade,
+                    "iva_total": int(iva_unitario * quantidade)
+                })
+                total += preco * quantidade
         
-        # CDC fictício
-        cdc = f"1234567890{random.randint(10000, 99999)}"
-        link_pdf = f"https://demo.nubepy.com/nota/{cdc}.pdf"
+            # CDC fictício
+            cdc = f"1234567890{random.randint(0, 10**14 - 1):014d}"
+            link_pdf = f"https://demo.nubepy.com/nota/{cdc}.pdf"
         
-        cursor.execute('''
-            INSERT INTO notas (empresa_id, nome_cliente, ruc_cliente, valor_total, itens, metodo_pago, data_emissao, ambiente, cdc, link_pdf)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (empresa_id, cliente, '123456-0', total, json.dumps(itens), metodo, data_emissao, 'testes', cdc, link_pdf))
-    conexao.commit()
-    cursor.close()
-    conexao.close()
-    print(f"[DEBUG] Geradas {num_vendas} vendas mock para hoje (empresa_id={empresa_id})")
-    return True
+            cursor.execute('''
+                INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, itens, metodo_pago, data_emissao, cdc, link_pdf)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
+            ''', (empresa_id, '9999999-9', cliente, total, json.dumps(itens), metodo, data_emissao, cdc, link_pdf))
+            inserir_itens_nota(cursor, cursor.fetchone()[0], itens)
+        recalcular_resumo_vendas(cursor, empresa_id)
+        conexao.commit()
+        cursor.close()
+        print(f"[DEBUG] Geradas {num_vendas} vendas mock para hoje (empresa_id={empresa_id})")
+        return True
 
 def verificar_e_semear_demo(empresa_id):
     """Verifica se a empresa demo tem dados básicos; se não, semeia automaticamente."""
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT ruc FROM empresas WHERE id = %s', (empresa_id,))
-    row = cursor.fetchone()
-    if not row or row[0] != '9999999-9':
-        conexao.close()
-        return False  # Não é a empresa demo
-    # Verificar se existem produtos
-    cursor.execute('SELECT COUNT(*) FROM produtos WHERE empresa_id = %s', (empresa_id,))
-    qtde_produtos = cursor.fetchone()[0]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT ruc FROM empresas WHERE id = %s', (empresa_id,))
+        row = cursor.fetchone()
+        if not row or row[0] != '9999999-9':
+            return False  # Não é a empresa demo
+        # Verificar se existem produtos
+        cursor.execute('SELECT COUNT(*) FROM produtos WHERE empresa_id = %s', (empresa_id,))
+        qtde_produtos = cursor.fetchone()[0]
+        # Verificar se há vendas hoje
+        cursor.execute('SELECT tickets FROM resumo_vendas_dia WHERE empresa_id = %s AND dia = CURRENT_DATE', (empresa_id,))
+        row = cursor.fetchone()
+        qtde_vendas_hoje = row[0] if row else 0
     if qtde_produtos == 0:
-        conexao.close()
         # Chamar a função de reset demo (que preenche produtos, fornecedores, categorias, vendas)
         injetar_dados_demo()
         return True  # Dados semeados
-    # Verificar se há vendas hoje
-    cursor.execute('SELECT COUNT(*) FROM notas WHERE empresa_id = %s AND DATE(data_emissao) = CURRENT_DATE', (empresa_id,))
-    qtde_vendas_hoje = cursor.fetchone()[0]
-    conexao.close()
     if qtde_vendas_hoje == 0:
         gerar_vendas_mock_hoje(empresa_id)
     return True
@@ -1124,128 +1789,103 @@ def obter_dados_dashboard(empresa_id):
     # Auto‑seed para demo (self‑healing)
     verificar_e_semear_demo(empresa_id)
     
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT valor_total, itens FROM notas WHERE empresa_id = %s AND DATE(data_emissao) = CURRENT_DATE', (empresa_id,))
-    notas = cursor.fetchall()
-    conexao.close()
-    
-    total_vendas = 0
-    total_notas = len(notas)
-    produtos_vendidos = {}
-    
-    for nota in notas:
-        total_vendas += nota[0]
-        itens = json.loads(nota[1]) 
-        for item in itens:
-            nome = item.get("descricao", "Manual / Otros")
-            qtd = item.get("quantidade", 0)
-            produtos_vendidos[nome] = produtos_vendidos.get(nome, 0) + qtd
-                
-    top_produtos = sorted(produtos_vendidos.items(), key=lambda x: x[1], reverse=True)[:5]
-    return {"total_vendas": total_vendas, "total_notas": total_notas, "top_produtos": [{"nome": p[0], "quantidade": p[1]} for p in top_produtos]}
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        # Só o resumo do dia, mantido por salvar_nota/salvar_nota_credito
+        cursor.execute('SELECT faturamento, tickets, devolucoes FROM resumo_vendas_dia WHERE empresa_id = %s AND dia = CURRENT_DATE', (empresa_id,))
+        linha = cursor.fetchone()
+        total_vendas, total_notas, total_devolucoes = linha if linha else (0, 0, 0)
+
+        cursor.execute('''
+            SELECT nome, quantidade FROM resumo_vendas_dia_produtos
+            WHERE empresa_id = %s AND dia = CURRENT_DATE
+            ORDER BY quantidade DESC
+            LIMIT 5
+        ''', (empresa_id,))
+        top_produtos = cursor.fetchall()
+
+        cursor.execute('SELECT metodo_pago, total, tickets FROM resumo_vendas_dia_pagamentos WHERE empresa_id = %s AND dia = CURRENT_DATE ORDER BY total DESC', (empresa_id,))
+        por_metodo = [{"metodo_pago": m, "total": t, "tickets": q} for m, t, q in cursor.fetchall()]
+        return {
+            "total_vendas": total_vendas, "total_notas": total_notas, "total_devolucoes": total_devolucoes,
+            "top_produtos": [{"nome": p[0], "quantidade": p[1]} for p in top_produtos],
+            "vendas_por_metodo": por_metodo
+        }
+
+# Vendas, sangrias e autofacturas do período, da mais recente para a mais antiga
+SQL_TRANSACOES_CIERRE = '''
+    SELECT data_emissao AS data, 'VENTA' AS tipo, valor_total AS monto,
+           COALESCE(nome_cliente, '') || ' (' || COALESCE(metodo_pago, '') || ')' AS detalle
+    FROM notas
+    WHERE empresa_id = %(empresa_id)s AND data_emissao >= %(inicio)s AND data_emissao < %(fim)s::date + 1
+    UNION ALL
+    SELECT data, tipo, valor, motivo
+    FROM caixa_movimentacoes
+    WHERE empresa_id = %(empresa_id)s AND tipo IN ('SANGRIA', 'AUTOFACTURA')
+      AND data >= %(inicio)s AND data < %(fim)s::date + 1
+    ORDER BY data DESC
+'''
 
 def obter_fechamento_caixa(empresa_id, data_inicio=None, data_fim=None):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    
     if not data_inicio: data_inicio = str(date.today())
     if not data_fim: data_fim = str(date.today())
-    
-    cursor.execute("SELECT valor_total, itens, metodo_pago FROM notas WHERE empresa_id = %s AND DATE(data_emissao) >= %s AND DATE(data_emissao) <= %s", (empresa_id, data_inicio, data_fim))
-    notas_periodo = cursor.fetchall()
-    
-    total_vendas_periodo = 0
-    lucro_bruto_periodo = 0
-    total_notas_periodo = len(notas_periodo)
-    
-    cursor.execute("SELECT SUM(valor) FROM caixa_movimentacoes WHERE empresa_id = %s AND tipo = 'SANGRIA' AND DATE(data) >= %s AND DATE(data) <= %s", (empresa_id, data_inicio, data_fim))
-    total_sangrias = cursor.fetchone()[0] or 0
-    
-    cursor.execute("SELECT SUM(valor) FROM caixa_movimentacoes WHERE empresa_id = %s AND tipo = 'AUTOFACTURA' AND DATE(data) >= %s AND DATE(data) <= %s", (empresa_id, data_inicio, data_fim))
-    total_autofacturas = cursor.fetchone()[0] or 0
-    
-    total_sangrias_geral = total_sangrias + total_autofacturas
-    
-    itens_agrupados = {}
-    for nota in notas_periodo:
-        total_vendas_periodo += nota[0]
-        itens = json.loads(nota[1])
-        for item in itens:
-            preco_venda = item.get('preco_unitario', 0)
-            preco_custo = item.get('preco_custo', 0)
-            qtd = item.get('quantidade', 0)
-            
-            receita_item = preco_venda * qtd
-            lucro_item = (preco_venda - preco_custo) * qtd
-            lucro_bruto_periodo += lucro_item
-            
-            cod = item.get('codigo_barras')
-            desc = item.get('descricao', 'Manual / Otros')
-            chave = cod if cod else desc
-            
-            if chave not in itens_agrupados:
-                itens_agrupados[chave] = {
-                    "codigo_barras": cod, "descricao": desc, "vendidos": 0, "estoque_restante": 0, "receita_total": 0, "lucro_total": 0, "margem": 0
-                }
-            itens_agrupados[chave]["vendidos"] += qtd
-            itens_agrupados[chave]["receita_total"] += receita_item
-            itens_agrupados[chave]["lucro_total"] += lucro_item
-            
-    lista_detalhada = list(itens_agrupados.values())
-    for item in lista_detalhada:
-        if item["receita_total"] > 0:
-            item["margem"] = round((item["lucro_total"] / item["receita_total"]) * 100, 1)
-            
-        if item["codigo_barras"]:
-            cursor.execute("SELECT quantidade FROM produtos WHERE empresa_id = %s AND codigo_barras = %s", (empresa_id, item["codigo_barras"]))
-            row = cursor.fetchone()
-            item["estoque_restante"] = row[0] if row else 0
-        else:
-            item["estoque_restante"] = "-"
-
-    lista_detalhada.sort(key=lambda x: x["receita_total"], reverse=True)
-    
-    # Construir lista de transações para tabela de cierre
-    transacoes = []
-    # Adicionar notas (vendas)
-    cursor.execute("SELECT data_emissao, nome_cliente, valor_total, metodo_pago FROM notas WHERE empresa_id = %s AND DATE(data_emissao) >= %s AND DATE(data_emissao) <= %s ORDER BY data_emissao DESC", (empresa_id, data_inicio, data_fim))
-    notas = cursor.fetchall()
-    for data_emissao, nome_cliente, valor_total, metodo_pago in notas:
-        transacoes.append({
-            "fecha_hora": str(data_emissao)[:16],  # YYYY-MM-DD HH:MM
-            "tipo": "VENTA",
-            "monto": valor_total,
-            "detalle": f"{nome_cliente} ({metodo_pago})"
-        })
-    
-    # Adicionar sangrias
-    cursor.execute("SELECT data, motivo, valor FROM caixa_movimentacoes WHERE empresa_id = %s AND tipo = 'SANGRIA' AND DATE(data) >= %s AND DATE(data) <= %s ORDER BY data DESC", (empresa_id, data_inicio, data_fim))
-    sangrias = cursor.fetchall()
-    for data, motivo, valor in sangrias:
-        transacoes.append({
-            "fecha_hora": str(data)[:16],
-            "tipo": "SANGRIA",
-            "monto": valor,
-            "detalle": motivo
-        })
-    
-    # Adicionar autofacturas
-    cursor.execute("SELECT data, motivo, valor FROM caixa_movimentacoes WHERE empresa_id = %s AND tipo = 'AUTOFACTURA' AND DATE(data) >= %s AND DATE(data) <= %s ORDER BY data DESC", (empresa_id, data_inicio, data_fim))
-    autofacturas = cursor.fetchall()
-    for data, motivo, valor in autofacturas:
-        transacoes.append({
-            "fecha_hora": str(data)[:16],
-            "tipo": "AUTOFACTURA",
-            "monto": valor,
-            "detalle": motivo
-        })
-    
-    # Ordenar transações por data decrescente
-    transacoes.sort(key=lambda x: x["fecha_hora"], reverse=True)
-    
-    conexao.close()
-    
+    periodo = {"empresa_id": empresa_id, "inicio": data_inicio, "fim": data_fim}
+
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+
+        # Totais do período: notas e movimentações de caixa lidas uma única vez cada
+        cursor.execute('''
+            WITH vendas AS (
+                SELECT COALESCE(SUM(valor_total), 0) AS total, COUNT(*) AS qtde
+                FROM notas
+                WHERE empresa_id = %(empresa_id)s AND data_emissao >= %(inicio)s AND data_emissao < %(fim)s::date + 1
+            ), saidas AS (
+                SELECT COALESCE(SUM(valor), 0) AS total
+                FROM caixa_movimentacoes
+                WHERE empresa_id = %(empresa_id)s AND tipo IN ('SANGRIA', 'AUTOFACTURA')
+                  AND data >= %(inicio)s AND data < %(fim)s::date + 1
+            )
+            SELECT vendas.total, vendas.qtde, saidas.total FROM vendas, saidas
+        ''', periodo)
+        total_vendas_periodo, total_notas_periodo, total_sangrias_geral = cursor.fetchone()
+
+        # Agrupa por código de barras (ou descrição, nos itens manuais) e já traz o estoque atual
+        cursor.execute('''
+            WITH itens AS (
+                SELECT MAX(NULLIF(i.codigo_barras, '')) AS codigo_barras,
+                       MAX(COALESCE(i.descricao, 'Manual / Otros')) AS descricao,
+                       SUM(i.quantidade) AS vendidos,
+                       SUM(i.preco_unitario * i.quantidade) AS receita_total,
+                       SUM((i.preco_unitario - COALESCE(i.preco_custo, 0)) * i.quantidade) AS lucro_total
+                FROM nota_itens i
+                JOIN notas n ON n.id = i.nota_id
+                WHERE n.empresa_id = %(empresa_id)s AND n.data_emissao >= %(inicio)s AND n.data_emissao < %(fim)s::date + 1
+                GROUP BY COALESCE(NULLIF(i.codigo_barras, ''), COALESCE(i.descricao, 'Manual / Otros'))
+            )
+            SELECT it.codigo_barras, it.descricao, it.vendidos, it.receita_total, it.lucro_total, COALESCE(p.quantidade, 0)
+            FROM itens it
+            LEFT JOIN produtos p ON p.empresa_id = %(empresa_id)s AND p.codigo_barras = it.codigo_barras
+            ORDER BY it.receita_total DESC
+        ''', periodo)
+        lista_detalhada = [
+            {
+                "codigo_barras": cod, "descricao": desc, "vendidos": vendidos,
+                "estoque_restante": estoque if cod else "-",
+                "receita_total": receita, "lucro_total": lucro,
+                "margem": round((lucro / receita) * 100, 1) if receita > 0 else 0
+            }
+            for cod, desc, vendidos, receita, lucro, estoque in cursor.fetchall()
+        ]
+        lucro_bruto_periodo = sum(item["lucro_total"] for item in lista_detalhada)
+
+        # Transações da tabela de cierre (vendas, sangrias e autofacturas) já ordenadas
+        cursor.execute(SQL_TRANSACOES_CIERRE, periodo)
+        transacoes = [
+            {"fecha_hora": str(data)[:16], "tipo": tipo, "monto": monto, "detalle": detalle}
+            for data, tipo, monto, detalle in cursor.fetchall()
+        ]
+
     return {
         "vendas_hoje": total_vendas_periodo, 
         "lucro_bruto": lucro_bruto_periodo, 
@@ -1255,119 +1895,179 @@ def obter_fechamento_caixa(empresa_id, data_inicio=None, data_fim=None):
         "transacoes": transacoes
     }
 
-def cadastrar_proveedor(empresa_id, nome, ruc, telefone="", email="", endereco=""):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        cursor.execute('''
-            INSERT INTO proveedores (empresa_id, nome, ruc, telefone, email, endereco)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            ON CONFLICT (empresa_id, ruc) DO UPDATE SET
-            nome = EXCLUDED.nome,
-            telefone = EXCLUDED.telefone,
-            email = EXCLUDED.email,
-            endereco = EXCLUDED.endereco
-        ''', (empresa_id, nome, ruc, telefone, email, endereco))
-        conexao.commit()
-        return True, "Proveedor guardado con Ã©xito."
-    except Exception as e:
-        conexao.rollback()
-        return False, f"Error al guardar: {str(e)}"
-    finally:
+# tipo -> (cabeçalho, consulta, coluna de data para o filtro de período)
+EXPORTACOES = {
+    "notas": (
+        ["ID", "Fecha", "Cliente", "RUC Emisor", "CDC", "Metodo de pago", "Total"],
+        "SELECT id, data_emissao, nome_cliente, ruc_emissor, cdc, metodo_pago, valor_total FROM notas WHERE empresa_id = %(empresa_id)s {periodo} ORDER BY id",
+        "data_emissao"
+    ),
+    "notas_credito": (
+        ["ID", "Fecha", "Cliente", "CDC Referencia", "CDC", "Total"],
+        "SELECT id, data_emissao, nome_cliente, cdc_referencia, cdc_novo, valor_total FROM notas_credito WHERE empresa_id = %(empresa_id)s {periodo} ORDER BY id",
+        "data_emissao"
+    ),
+    "compras": (
+        ["ID", "Fecha", "Proveedor", "RUC Proveedor", "Factura", "Total"],
+        "SELECT c.id, c.data_emissao, p.nome, p.ruc, c.numero_factura, c.valor_total FROM compras c LEFT JOIN proveedores p ON p.id = c.proveedor_id WHERE c.empresa_id = %(empresa_id)s {periodo} ORDER BY c.id",
+        "c.data_emissao"
+    ),
+    "mermas": (
+        ["ID", "Fecha", "Codigo", "Descripcion", "Cantidad", "Costo Unitario", "Motivo"],
+        "SELECT id, data_registro, codigo_barras, descricao, quantidade, custo_unitario, motivo FROM mermas WHERE empresa_id = %(empresa_id)s {periodo} ORDER BY id",
+        "data_registro"
+    ),
+    "cierre_caja": (["Fecha", "Tipo", "Monto", "Detalle"], SQL_TRANSACOES_CIERRE, None),
+}
+
+def exportar_linhas(empresa_id, tipo, data_inicio=None, data_fim=None, lote=2000):
+    """
+    Gera o cabeçalho e depois as linhas da exportação pedida, lidas por um cursor nomeado
+    (do lado do servidor) em lotes de `lote`: memória constante mesmo para um ano de notas.
+    A conexão fica emprestada do pool enquanto o gerador estiver sendo consumido.
+    """
+    cabecalho, sql, coluna_data = EXPORTACOES[tipo]
+    params = {"empresa_id": empresa_id, "inicio": data_inicio, "fim": data_fim}
+    if coluna_data is None:
+        # O cierre sempre tem período; sem datas vale o dia de hoje, como na tela
+        params["inicio"] = data_inicio or str(date.today())
+        params["fim"] = data_fim or str(date.today())
+    else:
+        periodo = f"AND {coluna_data} >= %(inicio)s AND {coluna_data} < %(fim)s::date + 1" if data_inicio and data_fim else ""
+        sql = sql.format(periodo=periodo)
+
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor(name=f"exportacao_{tipo}")
+        cursor.itersize = lote
+        cursor.execute(sql, params)
+        yield cabecalho
+        for linha in cursor:
+            yield linha
         cursor.close()
-        conexao.close()
+
+def cadastrar_proveedor(empresa_id, nome, ruc, telefone="", email="", endereco=""):
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            cursor.execute('''
+                INSERT INTO proveedores (empresa_id, nome, ruc, telefone, email, endereco)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (empresa_id, ruc) DO UPDATE SET
+                nome = EXCLUDED.nome,
+                telefone = EXCLUDED.telefone,
+                email = EXCLUDED.email,
+                endereco = EXCLUDED.endereco
+            ''', (empresa_id, nome, ruc, telefone, email, endereco))
+            conexao.commit()
+            return True, "Proveedor guardado con Ã©xito."
+        except Exception as e:
+            conexao.rollback()
+            return False, f"Error al guardar: {str(e)}"
+        finally:
+            cursor.close()
 
 def editar_proveedor(empresa_id, proveedor_id, nome, ruc, telefone, email, endereco):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        cursor.execute('''
-            UPDATE proveedores 
-            SET nome = %s, ruc = %s, telefone = %s, email = %s, endereco = %s 
-            WHERE id = %s AND empresa_id = %s
-        ''', (nome, ruc, telefone, email, endereco, proveedor_id, empresa_id))
-        conexao.commit()
-        return True, "Proveedor actualizado con Ã©xito."
-    except Exception as e:
-        conexao.rollback()
-        return False, f"Error al actualizar: {str(e)}"
-    finally:
-        cursor.close()
-        conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            cursor.execute('''
+                UPDATE proveedores 
+                SET nome = %s, ruc = %s, telefone = %s, email = %s, endereco = %s 
+                WHERE id = %s AND empresa_id = %s
+            ''', (nome, ruc, telefone, email, endereco, proveedor_id, empresa_id))
+            conexao.commit()
+            return True, "Proveedor actualizado con Ã©xito."
+        except Exception as e:
+            conexao.rollback()
+            return False, f"Error al actualizar: {str(e)}"
+        finally:
+            cursor.close()
 
 def listar_proveedores(empresa_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('SELECT id, nome, ruc, telefone, email, endereco FROM proveedores WHERE empresa_id = %s ORDER BY nome ASC', (empresa_id,))
-    linhas = cursor.fetchall()
-    conexao.close()
-    return [{"id": l[0], "nome": l[1], "ruc": l[2], "telefone": l[3], "email": l[4], "endereco": l[5]} for l in linhas]
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('SELECT id, nome, ruc, telefone, email, endereco FROM proveedores WHERE empresa_id = %s ORDER BY nome ASC', (empresa_id,))
+        linhas = cursor.fetchall()
+        return [{"id": l[0], "nome": l[1], "ruc": l[2], "telefone": l[3], "email": l[4], "endereco": l[5]} for l in linhas]
 
 def deletar_proveedor(empresa_id, proveedor_id):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute('DELETE FROM proveedores WHERE empresa_id = %s AND id = %s', (empresa_id, proveedor_id))
-    conexao.commit()
-    conexao.close()
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('DELETE FROM proveedores WHERE empresa_id = %s AND id = %s', (empresa_id, proveedor_id))
+        conexao.commit()
 
 def salvar_entrada_factura(empresa_id, proveedor_id, numero_factura, data_emissao, itens):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    try:
-        valor_total = 0
-        itens_json = json.dumps(itens)
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        try:
+            valor_total = sum(i['quantidade'] * i['custo_unitario'] for i in itens)
+            itens_json = json.dumps(itens)
         
-        for item in itens:
-            cod = item['codigo_barras']
-            qtd = item['quantidade']
-            custo = item['custo_unitario']
-            
-            subtotal = qtd * custo
-            valor_total += subtotal
-            
-            cursor.execute('''
-                UPDATE produtos 
-                SET quantidade = quantidade + %s, preco_custo = %s 
-                WHERE empresa_id = %s AND codigo_barras = %s
-            ''', (qtd, custo, empresa_id, cod))
+            _movimentar_estoque(cursor, empresa_id, [(i['codigo_barras'], i['quantidade'], i['custo_unitario']) for i in itens])
         
-        cursor.execute('''
-            INSERT INTO compras (empresa_id, proveedor_id, numero_factura, data_emissao, valor_total, itens)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (empresa_id, proveedor_id, numero_factura, data_emissao, valor_total, itens_json))
+            cursor.execute('''
+                INSERT INTO compras (empresa_id, proveedor_id, numero_factura, data_emissao, valor_total, itens)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            ''', (empresa_id, proveedor_id, numero_factura, data_emissao, valor_total, itens_json))
         
-        conexao.commit()
-        return True, "Entrada registrada y stock actualizado."
-    except Exception as e:
-        conexao.rollback()
-        return False, f"Error al guardar entrada: {str(e)}"
-    finally:
-        cursor.close()
-        conexao.close()
+            conexao.commit()
+            return True, "Entrada registrada y stock actualizado."
+        except Exception as e:
+            conexao.rollback()
+            return False, f"Error al guardar entrada: {str(e)}"
+        finally:
+            cursor.close()
 
 def validar_senha_admin(empresa_id, senha):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT senha_admin FROM empresas WHERE id = %s", (empresa_id,))
-    linha = cursor.fetchone()
-    conexao.close()
-    if linha and linha[0] == senha:
-        return True
-    return False
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("SELECT senha_admin FROM empresas WHERE id = %s", (empresa_id,))
+        linha = cursor.fetchone()
+        if linha and linha[0] == senha:
+            return True
+        return False
 
 def obter_nota_por_cdc(empresa_id, cdc):
-    conexao = get_conexao()
-    cursor = conexao.cursor()
-    cursor.execute("SELECT ruc_emissor, nome_cliente, valor_total, itens, data_emissao, link_qrcode, metodo_pago FROM notas WHERE empresa_id = %s AND cdc = %s", (empresa_id, cdc))
-    linha = cursor.fetchone()
-    conexao.close()
-    if linha:
-        return {
-            "ruc_emissor": linha[0], "nome_cliente": linha[1], "valor_total": linha[2],
-            "itens": json.loads(linha[3]), "data_emissao": str(linha[4])[:16],
-            "link_qrcode": linha[5], "metodo_pago": linha[6]
-        }
-    return None
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute("SELECT ruc_emissor, nome_cliente, valor_total, itens, data_emissao, link_qrcode, metodo_pago FROM notas WHERE empresa_id = %s AND cdc = %s", (empresa_id, cdc))
+        linha = cursor.fetchone()
+        if linha:
+            return {
+                "ruc_emissor": linha[0], "nome_cliente": linha[1], "valor_total": linha[2],
+                "itens": json.loads(linha[3]), "data_emissao": str(linha[4])[:16],
+                "link_qrcode": linha[5], "metodo_pago": linha[6]
+            }
+        return None
+
+def buscar_documento_por_cdc(empresa_id, cdc):
+    """
+    Resolve um CDC em qualquer tipo de documento (factura, nota de crédito, remisión, autofactura)
+    numa única consulta; cada ramo usa o índice único (empresa_id, cdc) da sua tabela.
+    """
+    with obter_conexao() as conexao:
+        cursor = conexao.cursor()
+        cursor.execute('''
+            SELECT 'FACTURA', ruc_emissor, nome_cliente, valor_total, itens, data_emissao, link_pdf, link_qrcode, metodo_pago, NULL
+            FROM notas WHERE empresa_id = %(empresa_id)s AND cdc = %(cdc)s
+            UNION ALL
+            SELECT 'NOTA_CREDITO', NULL, nome_cliente, valor_total, itens, data_emissao, link_pdf, '', NULL, cdc_referencia
+            FROM notas_credito WHERE empresa_id = %(empresa_id)s AND cdc_novo = %(cdc)s
+            UNION ALL
+            SELECT 'REMISION', ruc_destinatario, nome_destinatario, NULL, itens, data_emissao, link_pdf, link_qrcode, NULL, NULL
+            FROM notas_remision WHERE empresa_id = %(empresa_id)s AND cdc = %(cdc)s
+            UNION ALL
+            SELECT 'AUTOFACTURA', cedula_vendedor, nome_vendedor, valor_total, itens, data_emissao, link_pdf, link_qrcode, NULL, NULL
+            FROM autofacturas WHERE empresa_id = %(empresa_id)s AND cdc = %(cdc)s
+            LIMIT 1
+        ''', {"empresa_id": empresa_id, "cdc": cdc})
+        linha = cursor.fetchone()
+    if not linha: return None
+    return {
+        "tipo": linha[0], "cdc": cdc, "ruc_emissor": linha[1], "nome_cliente": linha[2], "valor_total": linha[3],
+        "itens": json.loads(linha[4]) if linha[4] else [], "data_emissao": str(linha[5])[:16],
+        "link_pdf": linha[6], "link_qrcode": linha[7], "metodo_pago": linha[8], "cdc_referencia": linha[9]
+    }
 
 def alterar_credenciais_admin(empresa_id, senha_atual, novo_ruc, nova_senha):
     """
@@ -1375,303 +2075,290 @@ def alterar_credenciais_admin(empresa_id, senha_atual, novo_ruc, nova_senha):
     Verifica a senha atual antes de atualizar.
     Retorna dict {sucesso: bool, mensagem: str}
     """
-    conexao = None
-    cursor = None
     try:
-        conexao = get_conexao()
-        cursor = conexao.cursor()
+        with obter_conexao() as conexao:
+            cursor = conexao.cursor()
         
-        # 1. Verificar senha atual
-        cursor.execute("""
-            SELECT senha_admin FROM empresas WHERE id = %s
-        """, (empresa_id,))
-        linha = cursor.fetchone()
-        if not linha:
-            return {"sucesso": False, "mensagem": "Empresa não encontrada"}
+            # 1. Verificar senha atual
+            cursor.execute("""
+                SELECT senha_admin FROM empresas WHERE id = %s
+            """, (empresa_id,))
+            linha = cursor.fetchone()
+            if not linha:
+                return {"sucesso": False, "mensagem": "Empresa não encontrada"}
         
-        senha_admin_atual = linha[0]
-        if senha_atual != senha_admin_atual:
-            return {"sucesso": False, "mensagem": "Senha atual incorreta"}
+            senha_admin_atual = linha[0]
+            if senha_atual != senha_admin_atual:
+                return {"sucesso": False, "mensagem": "Senha atual incorreta"}
         
-        # 2. Verificar se novo RUC já existe (e não é o mesmo da empresa atual)
-        cursor.execute("""
-            SELECT id FROM empresas WHERE ruc = %s AND id != %s
-        """, (novo_ruc, empresa_id))
-        if cursor.fetchone():
-            return {"sucesso": False, "mensagem": "O novo RUC já está em uso por outra empresa"}
+            # 2. Verificar se novo RUC já existe (e não é o mesmo da empresa atual)
+            cursor.execute("""
+                SELECT id FROM empresas WHERE ruc = %s AND id != %s
+            """, (novo_ruc, empresa_id))
+            if cursor.fetchone():
+                return {"sucesso": False, "mensagem": "O novo RUC já está em uso por outra empresa"}
         
-        # 3. Atualizar RUC e senha_admin
-        cursor.execute("""
-            UPDATE empresas SET ruc = %s, senha_admin = %s WHERE id = %s
-        """, (novo_ruc, nova_senha, empresa_id))
-        conexao.commit()
+            # 3. Atualizar RUC e senha_admin
+            cursor.execute("""
+                UPDATE empresas SET ruc = %s, senha_admin = %s WHERE id = %s
+            """, (novo_ruc, nova_senha, empresa_id))
+            _avisar_empresa_alterada(cursor, empresa_id)
+            conexao.commit()
+        cache_empresas.invalidar(empresa_id)
         
         return {"sucesso": True, "mensagem": "Credenciais atualizadas com sucesso"}
         
     except psycopg2.Error as e:
-        if conexao:
-            conexao.rollback()
         print(f"[ERRO] Falha ao alterar credenciais: {e}")
         return {"sucesso": False, "mensagem": f"Erro no banco de dados: {e}"}
-    finally:
-        if cursor:
-            cursor.close()
-        if conexao:
-            conexao.close()
 
 def injetar_dados_demo():
     """Cria o usuÃ¡rio de teste pÃºblico (RUC 9999999-9) com dados completos de demonstraÃ§Ã£o"""
-    conexao = None
-    cursor = None
     try:
         import random
         from datetime import datetime, date, timedelta
         
-        conexao = get_conexao()
-        cursor = conexao.cursor()
+        with obter_conexao() as conexao:
+            cursor = conexao.cursor()
         
-        vencimento = date.today() + timedelta(days=365)
+            vencimento = date.today() + timedelta(days=365)
         
-        # Verificar se empresa demo jÃ¡ existe
-        cursor.execute("SELECT id FROM empresas WHERE ruc = %s", ('9999999-9',))
-        existing = cursor.fetchone()
+            # Verificar se empresa demo jÃ¡ existe
+            cursor.execute("SELECT id FROM empresas WHERE ruc = %s", ('9999999-9',))
+            existing = cursor.fetchone()
         
-        if existing:
-            empresa_id = existing[0]
-            print(f"[DEMO] Empresa demo jÃ¡ existe (ID: {empresa_id}).")
-        else:
-            # Inserir empresa demo
-            cursor.execute('''
-                INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', ('UsuÃ¡rio PÃºblico Demo', '9999999-9', 'demo123', 'demo123', 'Demo', 'Activo', vencimento, 0))
+            if existing:
+                empresa_id = existing[0]
+                print(f"[DEMO] Empresa demo jÃ¡ existe (ID: {empresa_id}).")
+            else:
+                # Inserir empresa demo
+                cursor.execute('''
+                    INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', ('UsuÃ¡rio PÃºblico Demo', '9999999-9', 'demo123', 'demo123', 'Demo', 'Activo', vencimento, 0))
             
-            empresa_id = cursor.fetchone()[0]
-            print(f"[DEMO] Empresa demo criada (ID: {empresa_id}).")
+                empresa_id = cursor.fetchone()[0]
+                print(f"[DEMO] Empresa demo criada (ID: {empresa_id}).")
         
-        # ========== LIMPEZA SELETIVA ==========
-        print(f"[DEMO] LIMPEZA FORÃ‡ADA: Deletando vendas e produtos existentes para empresa ID {empresa_id}...")
+            # ========== LIMPEZA SELETIVA ==========
+            print(f"[DEMO] LIMPEZA FORÃ‡ADA: Deletando vendas e produtos existentes para empresa ID {empresa_id}...")
         
-        # 1. Notas (vendas)
-        cursor.execute("DELETE FROM notas WHERE empresa_id = %s", (empresa_id,))
-        notas_deleted = cursor.rowcount
-        print(f"[DEMO]   - Notas removidas: {notas_deleted}")
+            # 1. Notas (vendas)
+            cursor.execute("DELETE FROM notas WHERE empresa_id = %s", (empresa_id,))
+            notas_deleted = cursor.rowcount
+            print(f"[DEMO]   - Notas removidas: {notas_deleted}")
         
-        # 2. Produtos
-        cursor.execute("DELETE FROM produtos WHERE empresa_id = %s", (empresa_id,))
-        produtos_deleted = cursor.rowcount
-        print(f"[DEMO]   - Produtos removidos: {produtos_deleted}")
+            # 2. Produtos
+            cursor.execute("DELETE FROM produtos WHERE empresa_id = %s", (empresa_id,))
+            produtos_deleted = cursor.rowcount
+            print(f"[DEMO]   - Produtos removidos: {produtos_deleted}")
         
-        # 3. Outras tabelas (se existirem)
-        try:
-            cursor.execute("DELETE FROM compras WHERE empresa_id = %s", (empresa_id,))
-            print(f"[DEMO]   - Compras removidas: {cursor.rowcount}")
-        except:
-            pass
+            # 3. Outras tabelas (se existirem)
+            try:
+                cursor.execute("DELETE FROM compras WHERE empresa_id = %s", (empresa_id,))
+                print(f"[DEMO]   - Compras removidas: {cursor.rowcount}")
+            except:
+                pass
         
-        try:
-            cursor.execute("DELETE FROM autofacturas WHERE empresa_id = %s", (empresa_id,))
-            print(f"[DEMO]   - Autofacturas removidas: {cursor.rowcount}")
-        except:
-            pass
+            try:
+                cursor.execute("DELETE FROM autofacturas WHERE empresa_id = %s", (empresa_id,))
+                print(f"[DEMO]   - Autofacturas removidas: {cursor.rowcount}")
+            except:
+                pass
         
-        try:
-            cursor.execute("DELETE FROM mermas WHERE empresa_id = %s", (empresa_id,))
-            print(f"[DEMO]   - Mermas removidas: {cursor.rowcount}")
-        except:
-            pass
+            try:
+                cursor.execute("DELETE FROM mermas WHERE empresa_id = %s", (empresa_id,))
+                print(f"[DEMO]   - Mermas removidas: {cursor.rowcount}")
+            except:
+                pass
         
-        try:
-            cursor.execute("DELETE FROM notas_credito WHERE empresa_id = %s", (empresa_id,))
-            print(f"[DEMO]   - Notas crÃ©dito removidas: {cursor.rowcount}")
-        except:
-            pass
+            try:
+                cursor.execute("DELETE FROM notas_credito WHERE empresa_id = %s", (empresa_id,))
+                print(f"[DEMO]   - Notas crÃ©dito removidas: {cursor.rowcount}")
+            except:
+                pass
         
-        try:
-            cursor.execute("DELETE FROM notas_remision WHERE empresa_id = %s", (empresa_id,))
-            print(f"[DEMO]   - Notas remisiÃ³n removidas: {cursor.rowcount}")
-        except:
-            pass
+            try:
+                cursor.execute("DELETE FROM notas_remision WHERE empresa_id = %s", (empresa_id,))
+                print(f"[DEMO]   - Notas remisiÃ³n removidas: {cursor.rowcount}")
+            except:
+                pass
         
-        # NÃƒO deletar categorias e provedores (podem ter constraints Ãºnicas)
-        print(f"[DEMO] LIMPEZA FORÃ‡ADA CONCLUÃDA. Categorias e provedores mantidos.")
+            # NÃƒO deletar categorias e provedores (podem ter constraints Ãºnicas)
+            print(f"[DEMO] LIMPEZA FORÃ‡ADA CONCLUÃDA. Categorias e provedores mantidos.")
         
-        # ========== CATEGORIAS ==========
-        categorias = ['General', 'Bebidas', 'LÃ¡cteos', 'Limpeza', 'Enlatados', 'PanaderÃ­a', 'Carnes']
-        total_categorias = 0
-        for cat in categorias:
-            cursor.execute('''
-                INSERT INTO categorias (empresa_id, nome)
-                VALUES (%s, %s)
-            ''', (empresa_id, cat))
-            total_categorias += cursor.rowcount
-        print(f"[DEMO] {total_categorias}/{len(categorias)} categorias criadas.")
+            # ========== CATEGORIAS ==========
+            categorias = ['General', 'Bebidas', 'LÃ¡cteos', 'Limpeza', 'Enlatados', 'PanaderÃ­a', 'Carnes']
+            total_categorias = 0
+            for cat in categorias:
+                cursor.execute('''
+                    INSERT INTO categorias (empresa_id, nome)
+                    VALUES (%s, %s)
+                ''', (empresa_id, cat))
+                total_categorias += cursor.rowcount
+            print(f"[DEMO] {total_categorias}/{len(categorias)} categorias criadas.")
         
-        # ========== PROVEDORES ==========
-        provedores = [
-            ('Distribuidora Central S.A.', '80012345-1', '021 234 567', 'ventas@distcentral.com.py', 'Av. Eusebio Ayala km 4.5, AsunciÃ³n'),
-            ('Importadora del Este S.R.L.', '80023456-2', '021 345 678', 'contacto@importeste.com.py', 'Av. EspaÃ±a 1234, Ciudad del Este'),
-            ('Proveedores del Sur S.A.', '80034567-3', '021 456 789', 'info@proveedorsur.com.py', 'Av. San MartÃ­n 567, EncarnaciÃ³n'),
-            ('Alimentos Norte S.A.', '80045678-4', '021 567 890', 'ventas@alimentosnorte.com.py', 'Av. PerÃº 789, ConcepciÃ³n'),
-            ('Mayorista Py S.R.L.', '80056789-5', '021 678 901', 'pedidos@mayoristapy.com.py', 'Av. BrasÃ­lia 456, Pedro Juan Caballero')
-        ]
+            # ========== PROVEDORES ==========
+            provedores = [
+                ('Distribuidora Central S.A.', '80012345-1', '021 234 567', 'ventas@distcentral.com.py', 'Av. Eusebio Ayala km 4.5, AsunciÃ³n'),
+                ('Importadora del Este S.R.L.', '80023456-2', '021 345 678', 'contacto@importeste.com.py', 'Av. EspaÃ±a 1234, Ciudad del Este'),
+                ('Proveedores del Sur S.A.', '80034567-3', '021 456 789', 'info@proveedorsur.com.py', 'Av. San MartÃ­n 567, EncarnaciÃ³n'),
+                ('Alimentos Norte S.A.', '80045678-4', '021 567 890', 'ventas@alimentosnorte.com.py', 'Av. PerÃº 789, ConcepciÃ³n'),
+                ('Mayorista Py S.R.L.', '80056789-5', '021 678 901', 'pedidos@mayoristapy.com.py', 'Av. BrasÃ­lia 456, Pedro Juan Caballero')
+            ]
         
-        total_provedores = 0
-        for nome, ruc, telefone, email, endereco in provedores:
-            cursor.execute('''
-                INSERT INTO proveedores (empresa_id, nome, ruc, telefone, email, endereco)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            ''', (empresa_id, nome, ruc, telefone, email, endereco))
-            total_provedores += cursor.rowcount
-        print(f"[DEMO] {total_provedores}/{len(provedores)} provedores criados.")
+            total_provedores = 0
+            for nome, ruc, telefone, email, endereco in provedores:
+                cursor.execute('''
+                    INSERT INTO proveedores (empresa_id, nome, ruc, telefone, email, endereco)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                ''', (empresa_id, nome, ruc, telefone, email, endereco))
+                total_provedores += cursor.rowcount
+            print(f"[DEMO] {total_provedores}/{len(provedores)} provedores criados.")
         
-        # ========== PRODUTOS ==========
-        produtos = [
-            # CÃ³digo, DescriÃ§Ã£o, Categoria, Subcategoria, Custo, Venda, Estoque
-            ('ARR-001', 'Arroz Premium 1kg', 'General', '', 10000, 12500, 45),
-            ('ACE-002', 'Aceite Girasol 900ml', 'General', '', 15000, 18500, 28),
-            ('AZU-003', 'AzÃºcar Refinado 1kg', 'General', '', 7000, 8500, 62),
-            ('COC-004', 'Coca-Cola 2L', 'Bebidas', 'Gaseosas', 8000, 10500, 36),
-            ('SPR-005', 'Sprite 1.5L', 'Bebidas', 'Gaseosas', 7500, 9800, 42),
-            ('CER-006', 'Cerveza Pilsen 1L', 'Bebidas', 'AlcohÃ³licas', 12000, 15800, 24),
-            ('LEH-007', 'Leche Entera 1L', 'LÃ¡cteos', '', 6000, 8500, 58),
-            ('YOU-008', 'Yogur Natural 1kg', 'LÃ¡cteos', '', 8500, 11500, 32),
-            ('QUE-009', 'Queso Paraguay 500g', 'LÃ¡cteos', '', 22000, 28500, 18),
-            ('JAB-010', 'JabÃ³n en Polvo 3kg', 'Limpeza', '', 25000, 32500, 22),
-            ('DET-011', 'Detergente LÃ­quido 1L', 'Limpeza', '', 12000, 16500, 40),
-            ('PAP-012', 'Papel HigiÃ©nico 4un', 'Limpeza', '', 15000, 19500, 55),
-            ('ATA-013', 'AtÃºn en Lata 200g', 'Enlatados', '', 7500, 9800, 30),
-            ('MAI-014', 'MaÃ­z en Lata 400g', 'Enlatados', '', 6500, 8200, 38),
-            ('PAN-015', 'Pan FrancÃªs un', 'PanaderÃ­a', '', 1500, 2500, 120),
-            ('RES-016', 'Carne Res 1kg', 'Carnes', '', 35000, 45500, 15),
-            ('POL-017', 'Pollo Entero 1.5kg', 'Carnes', '', 22000, 29500, 20),
-            ('JAM-018', 'JamÃ³n Cocido 200g', 'Carnes', '', 12500, 16800, 25),
-            ('GAL-019', 'Galletas MarÃ­a 500g', 'PanaderÃ­a', '', 4500, 6500, 48),
-            ('CAF-020', 'CafÃ© Molido 500g', 'Bebidas', '', 18000, 23500, 16)
-        ]
+            # ========== PRODUTOS ==========
+            produtos = [
+                # CÃ³digo, DescriÃ§Ã£o, Categoria, Subcategoria, Custo, Venda, Estoque
+                ('ARR-001', 'Arroz Premium 1kg', 'General', '', 10000, 12500, 45),
+                ('ACE-002', 'Aceite Girasol 900ml', 'General', '', 15000, 18500, 28),
+                ('AZU-003', 'AzÃºcar Refinado 1kg', 'General', '', 7000, 8500, 62),
+                ('COC-004', 'Coca-Cola 2L', 'Bebidas', 'Gaseosas', 8000, 10500, 36),
+                ('SPR-005', 'Sprite 1.5L', 'Bebidas', 'Gaseosas', 7500, 9800, 42),
+                ('CER-006', 'Cerveza Pilsen 1L', 'Bebidas', 'AlcohÃ³licas', 12000, 15800, 24),
+                ('LEH-007', 'Leche Entera 1L', 'LÃ¡cteos', '', 6000, 8500, 58),
+                ('YOU-008', 'Yogur Natural 1kg', 'LÃ¡cteos', '', 8500, 11500, 32),
+                ('QUE-009', 'Queso Paraguay 500g', 'LÃ¡cteos', '', 22000, 28500, 18),
+                ('JAB-010', 'JabÃ³n en Polvo 3kg', 'Limpeza', '', 25000, 32500, 22),
+                ('DET-011', 'Detergente LÃ­quido 1L', 'Limpeza', '', 12000, 16500, 40),
+                ('PAP-012', 'Papel HigiÃ©nico 4un', 'Limpeza', '', 15000, 19500, 55),
+                ('ATA-013', 'AtÃºn en Lata 200g', 'Enlatados', '', 7500, 9800, 30),
+                ('MAI-014', 'MaÃ­z en Lata 400g', 'Enlatados', '', 6500, 8200, 38),
+                ('PAN-015', 'Pan FrancÃªs un', 'PanaderÃ­a', '', 1500, 2500, 120),
+                ('RES-016', 'Carne Res 1kg', 'Carnes', '', 35000, 45500, 15),
+                ('POL-017', 'Pollo Entero 1.5kg', 'Carnes', '', 22000, 29500, 20),
+                ('JAM-018', 'JamÃ³n Cocido 200g', 'Carnes', '', 12500, 16800, 25),
+                ('GAL-019', 'Galletas MarÃ­a 500g', 'PanaderÃ­a', '', 4500, 6500, 48),
+                ('CAF-020', 'CafÃ© Molido 500g', 'Bebidas', '', 18000, 23500, 16)
+            ]
         
-        total_produtos = 0
-        for cod, desc, cat, subcat, custo, venda, qtd in produtos:
-            cursor.execute('''
-                INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, '')
-            ''', (empresa_id, cod, desc, cat, subcat, custo, venda, qtd))
-            total_produtos += cursor.rowcount
-        print(f"[DEMO] {total_produtos}/{len(produtos)} produtos criados.")
+            total_produtos = 0
+            for cod, desc, cat, subcat, custo, venda, qtd in produtos:
+                cursor.execute('''
+                    INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, '')
+                ''', (empresa_id, cod, desc, cat, subcat, custo, venda, qtd))
+                total_produtos += cursor.rowcount
+            print(f"[DEMO] {total_produtos}/{len(produtos)} produtos criados.")
         
-        # ========== VENDAS (ÃšLTIMOS 30 DIAS) ==========
-        metodos_pago = ['Efectivo', 'Tarjeta', 'Transferencia', 'Efectivo', 'Tarjeta']
-        clientes = [
-            ('Consumidor Final', '80012345-1'),
-            ('Juan PÃ©rez', '1234567-8'),
-            ('MarÃ­a GonzÃ¡lez', '2345678-9'),
-            ('Carlos LÃ³pez', '3456789-0'),
-            ('Ana MartÃ­nez', '4567890-1'),
-            ('Luis RodrÃ­guez', '5678901-2'),
-            ('Supermercado Central', '80098765-4'),
-            ('Restaurante El Buen Sabor', '80087654-3')
-        ]
+            # ========== VENDAS (ÃšLTIMOS 30 DIAS) ==========
+            metodos_pago = ['Efectivo', 'Tarjeta', 'Transferencia', 'Efectivo', 'Tarjeta']
+            clientes = [
+                ('Consumidor Final', '80012345-1'),
+                ('Juan PÃ©rez', '1234567-8'),
+                ('MarÃ­a GonzÃ¡lez', '2345678-9'),
+                ('Carlos LÃ³pez', '3456789-0'),
+                ('Ana MartÃ­nez', '4567890-1'),
+                ('Luis RodrÃ­guez', '5678901-2'),
+                ('Supermercado Central', '80098765-4'),
+                ('Restaurante El Buen Sabor', '80087654-3')
+            ]
         
-        # ========== CAIXA ABERTO (PARA DEMO) ==========
-        # Verificar se jÃ¡ existe uma sessÃ£o de caixa aberta
-        cursor.execute('''
-            SELECT id FROM caixa_sessoes 
-            WHERE empresa_id = %s AND status = 'ABERTO'
-        ''', (empresa_id,))
-        caixa_row = cursor.fetchone()
-        if not caixa_row:
+            # ========== CAIXA ABERTO (PARA DEMO) ==========
+            # Verificar se jÃ¡ existe uma sessÃ£o de caixa aberta
             cursor.execute('''
-                INSERT INTO caixa_sessoes (empresa_id, data_abertura, valor_abertura, status)
-                VALUES (%s, CURRENT_TIMESTAMP, 500000, 'ABERTO')
-                RETURNING id
+                SELECT id FROM caixa_sessoes 
+                WHERE empresa_id = %s AND status = 'ABERTO'
             ''', (empresa_id,))
-            caixa_id = cursor.fetchone()[0]
-            print(f"[DEMO] SessÃ£o de caixa aberta criada (ID: {caixa_id}).")
-        else:
-            caixa_id = caixa_row[0]
-            print(f"[DEMO] SessÃ£o de caixa aberta jÃ¡ existe (ID: {caixa_id}).")
-        
-        # Gerar 25 vendas nos Ãºltimos 30 dias
-        # As primeiras 5 vendas sÃ£o de hoje para aparecer no dashboard
-        hoje = datetime.now()
-        total_vendas = 0
-        for i in range(25):
-            # Data aleatÃ³ria nos Ãºltimos 30 dias
-            if i < 5:
-                dias_atras = 0  # Hoje - para dashboard
+            caixa_row = cursor.fetchone()
+            if not caixa_row:
+                cursor.execute('''
+                    INSERT INTO caixa_sessoes (empresa_id, data_abertura, valor_abertura, status)
+                    VALUES (%s, CURRENT_TIMESTAMP, 500000, 'ABERTO')
+                    RETURNING id
+                ''', (empresa_id,))
+                caixa_id = cursor.fetchone()[0]
+                print(f"[DEMO] SessÃ£o de caixa aberta criada (ID: {caixa_id}).")
             else:
-                dias_atras = random.randint(1, 30)
-            horas_atras = random.randint(0, 23)
-            minutos_atras = random.randint(0, 59)
-            data_venda = hoje - timedelta(days=dias_atras, hours=horas_atras, minutes=minutos_atras)
+                caixa_id = caixa_row[0]
+                print(f"[DEMO] SessÃ£o de caixa aberta jÃ¡ existe (ID: {caixa_id}).")
+        
+            # Gerar 25 vendas nos Ãºltimos 30 dias
+            # As primeiras 5 vendas sÃ£o de hoje para aparecer no dashboard
+            hoje = datetime.now()
+            total_vendas = 0
+            for i in range(25):
+                # Data aleatÃ³ria nos Ãºltimos 30 dias
+                if i < 5:
+                    dias_atras = 0  # Hoje - para dashboard
+                else:
+                    dias_atras = random.randint(1, 30)
+                horas_atras = random.randint(0, 23)
+                minutos_atras = random.randint(0, 59)
+                data_venda = hoje - timedelta(days=dias_atras, hours=horas_atras, minutes=minutos_atras)
             
-            # Selecionar cliente aleatÃ³rio
-            nome_cliente, ruc_cliente = random.choice(clientes)
+                # Selecionar cliente aleatÃ³rio
+                nome_cliente, ruc_cliente = random.choice(clientes)
             
-            # Selecionar 1 a 4 produtos aleatÃ³rios para esta venda
-            num_itens = random.randint(1, 4)
-            itens_selecionados = random.sample(produtos[:15], num_itens)  # Usar apenas os primeiros 15 para variar
+                # Selecionar 1 a 4 produtos aleatÃ³rios para esta venda
+                num_itens = random.randint(1, 4)
+                itens_selecionados = random.sample(produtos[:15], num_itens)  # Usar apenas os primeiros 15 para variar
             
-            itens_json = []
-            valor_total = 0
+                itens_json = []
+                valor_total = 0
             
-            for prod in itens_selecionados:
-                codigo, descricao, categoria, subcat, custo, venda, estoque = prod
-                quantidade = random.randint(1, 3)
-                subtotal = venda * quantidade
-                valor_total += subtotal
+                for prod in itens_selecionados:
+                    codigo, descricao, categoria, subcat, custo, venda, estoque = prod
+                    quantidade = random.randint(1, 3)
+                    subtotal = venda * quantidade
+                    valor_total += subtotal
                 
-                itens_json.append({
-                    'codigo_barras': codigo,
-                    'codigo': codigo,
-                    'descricao': descricao,
-                    'quantidade': quantidade,
-                    'preco_unitario': venda,
-                    'preco_custo': custo,
-                    'subtotal': subtotal
-                })
+                    itens_json.append({
+                        'codigo_barras': codigo,
+                        'codigo': codigo,
+                        'descricao': descricao,
+                        'quantidade': quantidade,
+                        'preco_unitario': venda,
+                        'preco_custo': custo,
+                        'subtotal': subtotal
+                    })
             
-            # CDC fictÃ­cio (Ãºnico)
-            cdc = f'9999999-9-{data_venda.strftime("%Y%m%d")}-{i:06d}'
+                # CDC fictÃ­cio (Ãºnico)
+                cdc = f'9999999-9-{data_venda.strftime("%Y%m%d")}-{i:06d}'
             
-            # MÃ©todo de pago aleatÃ³rio
-            metodo = random.choice(metodos_pago)
+                # MÃ©todo de pago aleatÃ³rio
+                metodo = random.choice(metodos_pago)
             
-            cursor.execute('''
-                INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, cdc, itens, data_emissao, metodo_pago, caixa_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                empresa_id,
-                '9999999-9',
-                nome_cliente,
-                valor_total,
-                cdc,
-                json.dumps(itens_json),
-                data_venda,
-                metodo,
-                caixa_id
-            ))
-            total_vendas += cursor.rowcount
-        print(f"[DEMO] {total_vendas}/25 vendas histÃ³ricas criadas.")
-        conexao.commit()
-        print(f"[DEMO] âœ… Dados de demo completos injetados com sucesso. Empresa ID: {empresa_id}")
-        print(f"[DEMO]   - {total_categorias}/{len(categorias)} categorias")
-        print(f"[DEMO]   - {total_provedores}/{len(provedores)} provedores")
-        print(f"[DEMO]   - {total_produtos}/{len(produtos)} produtos")
-        print(f"[DEMO]   - {total_vendas}/25 vendas histÃ³ricas")
-        return empresa_id
+                cursor.execute('''
+                    INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, cdc, itens, data_emissao, metodo_pago, caixa_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (
+                    empresa_id,
+                    '9999999-9',
+                    nome_cliente,
+                    valor_total,
+                    cdc,
+                    json.dumps(itens_json),
+                    data_venda,
+                    metodo,
+                    caixa_id
+                ))
+                total_vendas += cursor.rowcount
+                inserir_itens_nota(cursor, cursor.fetchone()[0], itens_json)
+            recalcular_resumo_vendas(cursor, empresa_id)
+            print(f"[DEMO] {total_vendas}/25 vendas histÃ³ricas criadas.")
+            conexao.commit()
+            print(f"[DEMO] âœ… Dados de demo completos injetados com sucesso. Empresa ID: {empresa_id}")
+            print(f"[DEMO]   - {total_categorias}/{len(categorias)} categorias")
+            print(f"[DEMO]   - {total_provedores}/{len(provedores)} provedores")
+            print(f"[DEMO]   - {total_produtos}/{len(produtos)} produtos")
+            print(f"[DEMO]   - {total_vendas}/25 vendas histÃ³ricas")
+            return empresa_id
         
     except Exception as e:
         print(f"[DEMO ERRO] {e}")
         import traceback
         traceback.print_exc()
-        if conexao:
-            conexao.rollback()
         # NÃ£o propaga o erro para nÃ£o crashar o servidor
         return None
-    finally:
-        if cursor:
-            cursor.close()
-        if conexao:
-            conexao.close()
@@ -0,0 +1,110 @@
+import os
+import time
+import atexit
+import tempfile
+import threading
+from collections import OrderedDict
+
+from cryptography.hazmat.primitives.serialization import pkcs12
+from cryptography.hazmat.primitives import serialization
+
+# Quanto tempo um certificado decodificado fica em memória e quantas empresas cabem no cache
+CERT_CACHE_TTL = float(os.environ.get("CERT_CACHE_TTL_S", "3600"))
+CERT_CACHE_MAX = int(os.environ.get("CERT_CACHE_MAX", "256"))
+
+
+class MaterialCertificado:
+    """Chave e certificado de um .p12 já decodificados, nos formatos que assinatura e mTLS usam."""
+
+    def __init__(self, private_key, certificate, cadeia=None):
+        self.private_key = private_key
+        self.certificate = certificate
+        self.cert_pem = certificate.public_bytes(serialization.Encoding.PEM)
+        # Certificado + intermediários que vieram no .p12, para a KeyInfo da assinatura
+        self.cadeia_pem = [self.cert_pem] + [c.public_bytes(serialization.Encoding.PEM) for c in (cadeia or [])]
+        # signxml trabalha com PKCS8; requests/OpenSSL aceita o formato tradicional
+        self.key_pem = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        self._key_pem_tradicional = private_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption()
+        )
+        self._arquivos = None
+        self._lock = threading.Lock()
+
+    def arquivos_pem(self):
+        """
+        (cert_path, key_path) para o requests, exigência da biblioteca para mTLS.
+        Os arquivos são criados uma vez (mkstemp, permissão 0600) e apagados quando a entrada sai do cache.
+        """
+        with self._lock:
+            if self._arquivos is None:
+                fd_cert, cert_path = tempfile.mkstemp(suffix=".crt")
+                with os.fdopen(fd_cert, 'wb') as f:
+                    f.write(self.cert_pem)
+                fd_key, key_path = tempfile.mkstemp(suffix=".key")
+                with os.fdopen(fd_key, 'wb') as f:
+                    f.write(self._key_pem_tradicional)
+                self._arquivos = (cert_path, key_path)
+            return self._arquivos
+
+    def descartar(self):
+        with self._lock:
+            if self._arquivos:
+                for caminho in self._arquivos:
+                    if os.path.exists(caminho):
+                        os.remove(caminho)
+                self._arquivos = None
+
+
+_cache = OrderedDict()  # (empresa_id, caminho, mtime) -> (material, carregado_em)
+_cache_lock = threading.Lock()
+
+
+def _descartar_entradas(chaves):
+    for chave in chaves:
+        material, _ = _cache.pop(chave)
+        material.descartar()
+
+
+def obter_material(caminho_p12, senha, empresa_id=None):
+    """
+    Devolve o material do certificado, decodificando o PKCS#12 só na primeira vez.
+    O mtime faz parte da chave: um arquivo substituído no mesmo caminho gera entrada nova.
+    """
+    chave = (empresa_id, caminho_p12, os.path.getmtime(caminho_p12))
+    agora = time.monotonic()
+    with _cache_lock:
+        entrada = _cache.get(chave)
+        if entrada and agora - entrada[1] < CERT_CACHE_TTL:
+            _cache.move_to_end(chave)
+            return entrada[0]
+
+    with open(caminho_p12, "rb") as f:
+        p12_data = f.read()
+    private_key, certificate, cadeia = pkcs12.load_key_and_certificates(p12_data, senha.encode())
+    material = MaterialCertificado(private_key, certificate, cadeia)
+
+    with _cache_lock:
+        # Versões antigas do mesmo certificado não servem mais
+        _descartar_entradas([c for c in _cache if c[:2] == chave[:2]])
+        _cache[chave] = (material, agora)
+        while len(_cache) > CERT_CACHE_MAX:
+            _descartar_entradas([next(iter(_cache))])
+    return material
+
+
+def invalidar_empresa(empresa_id):
+    """Chamado quando a empresa troca certificado ou senha."""
+    with _cache_lock:
+        _descartar_entradas([c for c in _cache if c[0] == empresa_id])
+
+
+@atexit.register
+def _limpar_cache():
+    with _cache_lock:
+        _descartar_entradas(list(_cache))
@@ -0,0 +1,131 @@
+import os
+import time
+import select
+import threading
+from collections import OrderedDict
+
+import psycopg2
+
+# Configuração e plano da empresa mudam pouco e são lidos em quase toda requisição
+CACHE_EMPRESAS_TTL = float(os.environ.get("CACHE_EMPRESAS_TTL_S", "300"))
+CACHE_EMPRESAS_MAX = int(os.environ.get("CACHE_EMPRESAS_MAX", "2048"))
+# Canal do Postgres usado para avisar os outros workers/processos de que uma empresa mudou
+CANAL_EMPRESAS = "empresas_alteradas"
+
+
+class CacheEmpresas:
+    """
+    Cache TTL/LRU por empresa. Quem altera a tabela empresas chama invalidar() e faz NOTIFY
+    na mesma transação; o ouvinte (ouvir_invalidacoes) repassa o aviso aos outros processos.
+    """
+
+    def __init__(self, ttl=CACHE_EMPRESAS_TTL, maximo=CACHE_EMPRESAS_MAX):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._entradas = OrderedDict()  # empresa_id -> (dados, carregado_em)
+        self._lock = threading.Lock()
+        # Muda a cada invalidação: uma leitura que começou antes dela não entra no cache
+        self._geracao = 0
+        self.acertos = 0
+        self.faltas = 0
+
+    def obter(self, empresa_id, carregar):
+        """Dados da empresa; `carregar(empresa_id)` só roda quando não há entrada válida. None não é guardado."""
+        agora = time.monotonic()
+        with self._lock:
+            entrada = self._entradas.get(empresa_id)
+            if entrada and agora - entrada[1] < self.ttl:
+                self._entradas.move_to_end(empresa_id)
+                self.acertos += 1
+                return entrada[0]
+            self.faltas += 1
+            geracao = self._geracao
+        dados = carregar(empresa_id)
+        if dados is not None:
+            with self._lock:
+                if self._geracao == geracao:
+                    self._entradas[empresa_id] = (dados, agora)
+                    self._entradas.move_to_end(empresa_id)
+                    while len(self._entradas) > self.maximo:
+                        self._entradas.popitem(last=False)
+        return dados
+
+    def invalidar(self, empresa_id=None):
+        """Descarta uma empresa (ou todas, com None)."""
+        with self._lock:
+            self._geracao += 1
+            if empresa_id is None:
+                self._entradas.clear()
+            else:
+                self._entradas.pop(empresa_id, None)
+
+    def metricas(self):
+        with self._lock:
+            total = self.acertos + self.faltas
+            return {"entradas": len(self._entradas), "acertos": self.acertos, "faltas": self.faltas,
+                    "taxa_acerto": round(self.acertos / total, 3) if total else 0}
+
+
+cache_empresas = CacheEmpresas()
+
+_ouvinte = None
+_parar = threading.Event()
+# Outros caches por empresa (certificados, clientes SOAP) que também caem quando o aviso chega
+_ao_alterar = []
+
+
+def ao_alterar_empresa(funcao):
+    """Registra `funcao(empresa_id)`, chamada quando outra instância avisa que a empresa mudou."""
+    _ao_alterar.append(funcao)
+
+
+def _empresa_alterada(empresa_id):
+    cache_empresas.invalidar(empresa_id)
+    if empresa_id is None: return
+    for funcao in _ao_alterar:
+        try:
+            funcao(empresa_id)
+        except Exception as e:
+            print(f"[CACHE] Falha ao invalidar empresa {empresa_id}: {e}")
+
+
+def _loop_ouvinte(dsn):
+    while not _parar.is_set():
+        conexao = None
+        try:
+            conexao = psycopg2.connect(dsn)
+            conexao.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conexao.cursor().execute(f"LISTEN {CANAL_EMPRESAS}")
+            # Avisos perdidos enquanto estava desconectado: começa do zero
+            cache_empresas.invalidar()
+            while not _parar.is_set():
+                if select.select([conexao], [], [], 5) == ([], [], []):
+                    continue
+                conexao.poll()
+                while conexao.notifies:
+                    aviso = conexao.notifies.pop(0)
+                    _empresa_alterada(int(aviso.payload) if aviso.payload.isdigit() else None)
+        except Exception as e:
+            print(f"[CACHE] Ouvinte de {CANAL_EMPRESAS} caiu, reconectando: {e}")
+            cache_empresas.invalidar()
+            _parar.wait(5)
+        finally:
+            if conexao is not None:
+                conexao.close()
+
+
+def ouvir_invalidacoes(dsn):
+    """Inicia a thread com conexão dedicada (fora do pool) que escuta o NOTIFY das outras instâncias."""
+    global _ouvinte
+    if _ouvinte or not dsn: return
+    _parar.clear()
+    _ouvinte = threading.Thread(target=_loop_ouvinte, args=(dsn,), name="cache-empresas", daemon=True)
+    _ouvinte.start()
+
+
+def parar_ouvinte():
+    global _ouvinte
+    _parar.set()
+    if _ouvinte:
+        _ouvinte.join(timeout=10)
+        _ouvinte = None
@@ -0,0 +1,118 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+
+from gerador_pdf import gerar_pdf_nota, documento_interno, VERSAO_LAYOUT_PDF
+from armazenamento_pdf import obter_armazenamento
+from pool_cpu import pool_cpu
+
+# Passando deste tamanho, os PDFs baixados há mais tempo saem primeiro
+PDF_CACHE_MAX_MB = float(os.environ.get("PDF_CACHE_MAX_MB", "512"))
+
+_indice = OrderedDict()  # chave -> tamanho em bytes, do menos para o mais recente
+_por_documento = {}  # "empresa/cdc" -> chave atual (versões antigas saem quando a nova entra)
+_total = 0
+_carregado = False
+_lock = threading.Lock()
+
+
+def hash_documento(documento, cdc):
+    """
+    Hash dos dados que aparecem no PDF: o mesmo documento sempre cai no mesmo arquivo,
+    e qualquer mudança nos dados ou no layout gera outro.
+    """
+    conteudo = {"cdc": cdc, "layout": VERSAO_LAYOUT_PDF, "documento": documento}
+    bruto = json.dumps(conteudo, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(bruto.encode("utf-8")).hexdigest()
+
+
+def chave_pdf(empresa_id, cdc, hash_conteudo):
+    # CDC completo + empresa: dois documentos nunca dividem o mesmo arquivo
+    return f"{empresa_id}/{cdc}/{hash_conteudo}.pdf"
+
+
+def _documento_da_chave(chave):
+    return chave.rsplit("/", 1)[0]
+
+
+def _remover(chave):
+    global _total
+    _total -= _indice.pop(chave, 0)
+    documento = _documento_da_chave(chave)
+    if _por_documento.get(documento) == chave:
+        del _por_documento[documento]
+    obter_armazenamento().remover(chave)
+
+
+def _carregar_indice():
+    """Na primeira chamada, reconstrói o índice a partir do armazenamento (ordem de último uso)."""
+    global _total, _carregado
+    if _carregado: return
+    for chave, tamanho, _ in sorted(obter_armazenamento().listar(), key=lambda a: a[2]):
+        _indice[chave] = tamanho
+        _total += tamanho
+        _por_documento[_documento_da_chave(chave)] = chave
+    _carregado = True
+
+
+def _registrar(chave, tamanho):
+    global _total
+    anterior = _por_documento.get(_documento_da_chave(chave))
+    if anterior and anterior != chave:
+        _remover(anterior)
+    _total += tamanho - _indice.pop(chave, 0)
+    _indice[chave] = tamanho
+    _por_documento[_documento_da_chave(chave)] = chave
+    limite = PDF_CACHE_MAX_MB * 1024 * 1024
+    while _total > limite and len(_indice) > 1:
+        _remover(next(iter(_indice)))
+
+
+def _pdf_existente(chave):
+    """Tamanho do PDF já armazenado (atualizando a ordem de uso), ou None."""
+    armazenamento = obter_armazenamento()
+    # Pergunta ao armazenamento, não só ao índice: outro worker pode ter gerado ou despejado o arquivo
+    tamanho = armazenamento.tamanho(chave)
+    if tamanho is not None:
+        with _lock:
+            _carregar_indice()
+            if chave in _indice:
+                _indice.move_to_end(chave)
+            else:
+                _registrar(chave, tamanho)
+        armazenamento.tocar(chave)
+    return tamanho
+
+
+def _guardar_pdf(chave, conteudo):
+    obter_armazenamento().gravar(chave, conteudo)
+    with _lock:
+        _carregar_indice()
+        _registrar(chave, len(conteudo))
+    return len(conteudo)
+
+
+def obter_pdf(empresa_id, documento, cdc):
+    """
+    (chave, tamanho) do PDF do documento no armazenamento; renderiza (no pool de CPU) e grava se ainda não existir.
+    Ler o conteúdo é com obter_armazenamento().ler(chave, inicio, fim).
+    """
+    chave = chave_pdf(empresa_id, cdc, hash_documento(documento, cdc))
+    tamanho = _pdf_existente(chave)
+    if tamanho is None:
+        conteudo = pool_cpu.executar(gerar_pdf_nota, documento, cdc, documento_interno(cdc))
+        tamanho = _guardar_pdf(chave, conteudo)
+    return chave, tamanho
+
+
+async def obter_pdf_async(empresa_id, documento, cdc):
+    """obter_pdf para endpoints async: E/S do armazenamento em thread, renderização no pool de CPU."""
+    chave = chave_pdf(empresa_id, cdc, hash_documento(documento, cdc))
+    tamanho = await asyncio.to_thread(_pdf_existente, chave)
+    if tamanho is None:
+        conteudo = await pool_cpu.executar_async(gerar_pdf_nota, documento, cdc, documento_interno(cdc))
+        tamanho = await asyncio.to_thread(_guardar_pdf, chave, conteudo)
+    return chave, tamanho
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import datetime
+import threading
+import urllib.request
+
+# Cotação BRL -> PYG usada no PIX. A URL é configurável para apontar a um servidor local nos testes.
+CAMBIO_URL = os.environ.get("CAMBIO_URL", "https://economia.awesomeapi.com.br/last/BRL-PYG")
+# Idade em que a cotação passa a ser renovada; até CAMBIO_MAX_STALE ela ainda é usada enquanto renova
+CAMBIO_TTL = float(os.environ.get("CAMBIO_TTL_S", "300"))
+CAMBIO_MAX_STALE = float(os.environ.get("CAMBIO_MAX_STALE_S", "21600"))
+CAMBIO_TIMEOUT = float(os.environ.get("CAMBIO_TIMEOUT_S", "3"))
+# Espera entre tentativas quando a fonte falha
+CAMBIO_RETRY = float(os.environ.get("CAMBIO_RETRY_S", "30"))
+# Sem nenhuma cotação conhecida (ou velha demais)
+CAMBIO_PADRAO = float(os.environ.get("CAMBIO_PADRAO", "1450"))
+# Cobrar um PIX com a cotação padrão é opt-in; sem isso o /gerar-pix recusa até a fonte responder
+CAMBIO_ACEITAR_PADRAO = os.environ.get("CAMBIO_ACEITAR_PADRAO", "0") == "1"
+
+
+def buscar_cotacao(url=CAMBIO_URL, timeout=CAMBIO_TIMEOUT):
+    """Chamada à fonte (bloqueante); só o refresher em segundo plano usa."""
+    req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+    with urllib.request.urlopen(req, timeout=timeout) as response:
+        dados = json.loads(response.read().decode())
+        return float(dados["BRLPYG"]["ask"])
+
+
+class CacheCambio:
+    """
+    Última cotação conhecida, renovada por uma thread. Quem gera o PIX nunca espera a fonte:
+    recebe a cotação em cache (mesmo vencida, até o limite) e, se ela venceu, só acorda o refresher.
+    """
+
+    def __init__(self, url=CAMBIO_URL, ttl=CAMBIO_TTL, max_stale=CAMBIO_MAX_STALE, padrao=CAMBIO_PADRAO):
+        self.url = url
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.padrao = padrao
+        self._taxa = None
+        self._obtida_em = None  # datetime, para registrar junto do pagamento
+        self._obtida_mono = 0.0
+        self._tentativa_mono = float("-inf")
+        self._ultimo_erro = None
+        self._lock = threading.Lock()
+        self._acordar = threading.Event()
+        self._parar = threading.Event()
+        self._thread = None
+
+    def renovar(self):
+        """Busca a cotação agora. Retorna True se conseguiu."""
+        with self._lock:
+            self._tentativa_mono = time.monotonic()
+        try:
+            taxa = buscar_cotacao(self.url)
+        except Exception as e:
+            with self._lock:
+                self._ultimo_erro = str(e)
+            print(f"[CAMBIO] Falha ao renovar cotação: {e}")
+            return False
+        with self._lock:
+            self._taxa = taxa
+            self._obtida_em = datetime.datetime.now()
+            self._obtida_mono = time.monotonic()
+            self._ultimo_erro = None
+        return True
+
+    def _pedir_renovacao(self):
+        # Com a fonte fora do ar, não martelar a cada PIX: no máximo uma tentativa por CAMBIO_RETRY
+        with self._lock:
+            if time.monotonic() - self._tentativa_mono < CAMBIO_RETRY: return
+        self._acordar.set()
+
+    def obter_cotacao(self):
+        """{"taxa", "fonte", "obtida_em"}; fonte é "atual", "vencida" ou "padrao"."""
+        with self._lock:
+            taxa, obtida_em = self._taxa, self._obtida_em
+            idade = time.monotonic() - self._obtida_mono
+        if taxa is None or idade > self.max_stale:
+            self._pedir_renovacao()
+            return {"taxa": self.padrao, "fonte": "padrao", "obtida_em": None}
+        if idade > self.ttl:
+            # stale-while-revalidate: usa a vencida e pede renovação
+            self._pedir_renovacao()
+            return {"taxa": taxa, "fonte": "vencida", "obtida_em": obtida_em}
+        return {"taxa": taxa, "fonte": "atual", "obtida_em": obtida_em}
+
+    def _loop(self, ok):
+        while not self._parar.is_set():
+            self._acordar.wait(self.ttl if ok else CAMBIO_RETRY)
+            if self._parar.is_set(): break
+            self._acordar.clear()
+            ok = self.renovar()
+
+    def iniciar(self):
+        """Primeira busca bloqueante (limitada por CAMBIO_TIMEOUT), para não abrir servindo a padrão."""
+        if self._thread: return
+        self._parar.clear()
+        ok = self.renovar()
+        if not ok:
+            print("[CAMBIO] Sem cotação no startup; nova tentativa em segundo plano")
+        self._thread = threading.Thread(target=self._loop, args=(ok,), name="cambio", daemon=True)
+        self._thread.start()
+
+    def parar(self):
+        self._parar.set()
+        self._acordar.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def status(self):
+        with self._lock:
+            return {
+                "taxa": self._taxa,
+                "obtida_em": str(self._obtida_em) if self._obtida_em else None,
+                "idade_s": round(time.monotonic() - self._obtida_mono, 1) if self._taxa is not None else None,
+                "ultimo_erro": self._ultimo_erro,
+            }
+
+
+cambio = CacheCambio()
@@ -1,38 +1,126 @@
 import os
-import tempfile
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from zeep import Client
+from zeep.cache import InMemoryCache
 from zeep.transports import Transport
-from cryptography.hazmat.primitives.serialization import pkcs12
-from cryptography.hazmat.primitives import serialization
+import io
+import re
 import base64
+import zipfile
+from cache_certificados import obter_material
 
-def extrair_certificados_temporarios(caminho_p12, senha):
-    """Extrai o certificado e a chave privada para arquivos temporários (exigência da biblioteca Requests/Zeep para mTLS)"""
-    with open(caminho_p12, "rb") as f:
-        p12_data = f.read()
-    
-    private_key, cert, _ = pkcs12.load_key_and_certificates(p12_data, senha.encode())
-    
-    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
-    key_pem = private_key.private_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PrivateFormat.TraditionalOpenSSL,
-        encryption_algorithm=serialization.NoEncryption()
-    )
-    
-    # Cria arquivos temporários invisíveis
-    fd_cert, cert_path = tempfile.mkstemp(suffix=".crt")
-    with os.fdopen(fd_cert, 'wb') as f:
-        f.write(cert_pem)
-        
-    fd_key, key_path = tempfile.mkstemp(suffix=".key")
-    with os.fdopen(fd_key, 'wb') as f:
-        f.write(key_pem)
-        
-    return cert_path, key_path
+# URLs oficiais baseadas no manual, por serviço
+WSDL_SIFEN = {
+    "recepcion": {
+        "produccion": "https://sifen.set.gov.py/de/ws/sync/recepcion.wsdl",
+        "testes": "https://sifen-test.set.gov.py/de/ws/sync/recepcion.wsdl",
+    },
+    "lote": {
+        "produccion": "https://sifen.set.gov.py/de/ws/async/recibe-lote.wsdl",
+        "testes": "https://sifen-test.set.gov.py/de/ws/async/recibe-lote.wsdl",
+    },
+    "consulta_lote": {
+        "produccion": "https://sifen.set.gov.py/de/ws/consultas/consulta-lote.wsdl",
+        "testes": "https://sifen-test.set.gov.py/de/ws/consultas/consulta-lote.wsdl",
+    },
+}
+# Apontam o serviço para outro servidor (ex.: stub SOAP local nos testes)
+WSDL_OVERRIDE = {
+    "recepcion": os.environ.get("SIFEN_WSDL_URL"),
+    "lote": os.environ.get("SIFEN_WSDL_URL_LOTE"),
+    "consulta_lote": os.environ.get("SIFEN_WSDL_URL_CONSULTA_LOTE"),
+}
+# Limite da SET para documentos por lote
+SIFEN_MAX_LOTE = 50
+# Clientes sem uso há mais tempo que isto são fechados (conexões keep-alive inclusive)
+CLIENTE_OCIOSO = float(os.environ.get("SIFEN_CLIENTE_OCIOSO_S", "600"))
+SIFEN_TIMEOUT = float(os.environ.get("SIFEN_TIMEOUT_S", "30"))
+
+# O WSDL é o mesmo para todas as empresas: baixado e parseado uma vez por processo
+_cache_wsdl = InMemoryCache(timeout=24 * 3600)
+
+def extrair_certificados_temporarios(caminho_p12, senha, empresa_id=None):
+    """Caminhos do certificado e da chave em PEM (exigência da biblioteca Requests/Zeep para mTLS), reaproveitados do cache"""
+    return obter_material(caminho_p12, senha, empresa_id).arquivos_pem()
+
+class ClienteSifen:
+    """zeep Client + requests.Session com mTLS e pool keep-alive para uma empresa/ambiente/serviço."""
+
+    def __init__(self, wsdl_url, material):
+        self.material = material
+        self.session = requests.Session()
+        self.session.cert = material.arquivos_pem()
+        # SIFEN as vezes exige desabilitar verificação estrita em ambiente de testes
+        self.session.verify = False
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        transport = Transport(session=self.session, cache=_cache_wsdl, operation_timeout=SIFEN_TIMEOUT)
+        self.client = Client(wsdl=wsdl_url, transport=transport)
+        self.usado_em = time.monotonic()
 
-def enviar_xml_para_sifen(xml_assinado, caminho_p12, senha, ambiente="testes", ruc_emissor=None):
+    def fechar(self):
+        self.session.close()
+
+_clientes = {}  # (empresa_id, ambiente, servico) -> ClienteSifen
+_clientes_lock = threading.Lock()
+
+def obter_cliente_sifen(caminho_p12, senha, ambiente="testes", empresa_id=None, servico="recepcion"):
+    """
+    Devolve o cliente SOAP da empresa/ambiente/serviço, criando-o na primeira vez.
+    É recriado quando o material do certificado muda (novo upload, nova senha, TTL do cache)
+    e clientes ociosos de outras empresas são fechados de passagem.
+    """
+    material = obter_material(caminho_p12, senha, empresa_id)
+    urls = WSDL_SIFEN[servico]
+    wsdl_url = WSDL_OVERRIDE[servico] or urls.get(ambiente, urls["testes"])
+    chave = (empresa_id, ambiente, servico)
+    agora = time.monotonic()
+    with _clientes_lock:
+        for outra, cliente in list(_clientes.items()):
+            if outra != chave and agora - cliente.usado_em > CLIENTE_OCIOSO:
+                _clientes.pop(outra).fechar()
+        cliente = _clientes.get(chave)
+        if cliente is not None and cliente.material is material:
+            cliente.usado_em = agora
+            return cliente
+        if cliente is not None:
+            _clientes.pop(chave).fechar()
+
+    # Montar o Client (WSDL + handshake) fora do lock para não segurar as outras empresas
+    novo = ClienteSifen(wsdl_url, material)
+    with _clientes_lock:
+        atual = _clientes.get(chave)
+        if atual is not None and atual.material is material:
+            novo.fechar()
+            return atual
+        _clientes[chave] = novo
+    return novo
+
+def descartar_cliente_sifen(empresa_id):
+    with _clientes_lock:
+        for chave in [c for c in _clientes if c[0] == empresa_id]:
+            _clientes.pop(chave).fechar()
+
+# dCodRes de DE aprovado
+CODIGO_APROVADO = "0260"
+
+def _codigo(valor):
+    # Códigos são 4 dígitos com zeros à esquerda; um int do SOAP perderia o "0" de "0260"
+    return str(valor).zfill(4) if valor is not None else None
+
+def _resultado_documento(resposta):
+    """(dCodRes, dMsgRes, dEstRes) do rRetEnviDe; o resultado vem em rProtDe/gResProc."""
+    protocolo = getattr(resposta, "rProtDe", None) or resposta
+    processamento = getattr(protocolo, "gResProc", None)
+    if isinstance(processamento, list):
+        processamento = processamento[0] if processamento else None
+    origem = processamento if processamento is not None else protocolo
+    codigo = _codigo(getattr(origem, "dCodRes", None))
+    return codigo, getattr(origem, "dMsgRes", None), getattr(protocolo, "dEstRes", None)
+
+def enviar_xml_para_sifen(xml_assinado, caminho_p12, senha, ambiente="testes", ruc_emissor=None, empresa_id=None, d_id=1):
     """Envia o XML para a SIFEN usando SOAP e mTLS"""
     
     # Escudo SIFEN: usuário demo nunca envia dados reais para a SET
@@ -40,47 +128,32 @@ def enviar_xml_para_sifen(xml_assinado, caminho_p12, senha, ambiente="testes", r
         print(f"[SIFEN DEMO] Bloqueio de envio real para usuário demo (RUC {ruc_emissor})")
         return {
             "sucesso": True,
+            "aprovado": True,
             "codigo_retorno": "0000",
             "mensagem_retorno": "Simulación exitosa (Modo Demo)",
             "raw_response": "DEMO-MOCK"
         }
     
-    # URLs oficiais baseadas no manual
-    if ambiente == "produccion":
-        wsdl_url = "https://sifen.set.gov.py/de/ws/sync/recepcion.wsdl"
-    else:
-        wsdl_url = "https://sifen-test.set.gov.py/de/ws/sync/recepcion.wsdl"
-    
-    cert_path = None
-    key_path = None
-    
     try:
-        # Prepara a criptografia da conexão
-        cert_path, key_path = extrair_certificados_temporarios(caminho_p12, senha)
-        
-        session = requests.Session()
-        session.cert = (cert_path, key_path)
-        # SIFEN as vezes exige desabilitar verificação estrita em ambiente de testes
-        session.verify = False 
-        
-        transport = Transport(session=session)
-        client = Client(wsdl=wsdl_url, transport=transport)
+        cliente = obter_cliente_sifen(caminho_p12, senha, ambiente, empresa_id)
         
         # A SIFEN espera o XML codificado em Base64 para evitar quebra de caracteres
         xml_base64 = base64.b64encode(xml_assinado.encode('utf-8')).decode('utf-8')
         
         # A chamada oficial do WebService: rEnviDe (Recepção Síncrona de 1 Documento)
-        # O ID é gerado sequencialmente pela sua empresa
-        resposta = client.service.rEnviDe(
-            dId=1, 
+        # O ID é gerado sequencialmente pela sua empresa (a fila usa o id do envio)
+        resposta = cliente.client.service.rEnviDe(
+            dId=d_id, 
             xDE=xml_base64
         )
         
-        # Processa a resposta da SET
+        # Processa a resposta da SET: uma resposta SOAP não é aprovação, quem decide é dEstRes/dCodRes
+        codigo, mensagem, estado = _resultado_documento(resposta)
         return {
             "sucesso": True,
-            "codigo_retorno": resposta.dCodRes,
-            "mensagem_retorno": resposta.dMsgRes,
+            "aprovado": codigo == CODIGO_APROVADO or str(estado or "").lower().startswith("aprob"),
+            "codigo_retorno": codigo,
+            "mensagem_retorno": mensagem,
             "raw_response": str(resposta)
         }
         
@@ -89,10 +162,59 @@ def enviar_xml_para_sifen(xml_assinado, caminho_p12, senha, ambiente="testes", r
             "sucesso": False,
             "erro": str(e)
         }
-        
-    finally:
-        # Limpeza de Segurança: Apaga as chaves da máquina imediatamente
-        if cert_path and os.path.exists(cert_path):
-            os.remove(cert_path)
-        if key_path and os.path.exists(key_path):
-            os.remove(key_path)
\ No newline at end of file
+
+def montar_lote(xmls_assinados):
+    """rLoteDE com os rDE assinados, compactado em zip e codificado em Base64 como pede o rEnvioLote"""
+    corpo = "".join(re.sub(r"^\s*<\?xml[^>]*\?>\s*", "", x) for x in xmls_assinados)
+    lote_xml = f'<rLoteDE xmlns="http://ekuatia.set.gov.py/sifen/xsd">{corpo}</rLoteDE>'
+    memoria = io.BytesIO()
+    with zipfile.ZipFile(memoria, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("lote.xml", lote_xml.encode("utf-8"))
+    return base64.b64encode(memoria.getvalue()).decode("utf-8")
+
+def enviar_lote_para_sifen(xmls_assinados, caminho_p12, senha, ambiente="testes", empresa_id=None, d_id=1):
+    """Recepção assíncrona: até 50 DE numa única chamada. Devolve o protocolo para consultar o lote depois."""
+    if len(xmls_assinados) > SIFEN_MAX_LOTE:
+        raise ValueError(f"Lote com {len(xmls_assinados)} documentos (máximo {SIFEN_MAX_LOTE})")
+    try:
+        cliente = obter_cliente_sifen(caminho_p12, senha, ambiente, empresa_id, servico="lote")
+        resposta = cliente.client.service.rEnvioLote(dId=d_id, xDE=montar_lote(xmls_assinados))
+        codigo = _codigo(resposta.dCodRes)
+        return {
+            "sucesso": bool(getattr(resposta, "dProtConsLote", None)),
+            "codigo_retorno": codigo,
+            "mensagem_retorno": resposta.dMsgRes,
+            "protocolo": getattr(resposta, "dProtConsLote", None),
+            "erro": None if getattr(resposta, "dProtConsLote", None) else f"{codigo} - {resposta.dMsgRes}"
+        }
+    except Exception as e:
+        return {"sucesso": False, "erro": str(e)}
+
+def consultar_lote_sifen(protocolo, caminho_p12, senha, ambiente="testes", empresa_id=None, d_id=1):
+    """
+    Consulta o processamento de um lote. `processado` fica False enquanto a SET ainda
+    está processando (0361); quando processado, `resultados` traz o retorno de cada CDC.
+    """
+    try:
+        cliente = obter_cliente_sifen(caminho_p12, senha, ambiente, empresa_id, servico="consulta_lote")
+        resposta = cliente.client.service.rEnviConsLoteDe(dId=d_id, dProtConsLote=protocolo)
+        resultados = []
+        for r in getattr(resposta, "gResProcLote", None) or []:
+            retorno = r.gResProc[0] if isinstance(r.gResProc, list) else r.gResProc
+            codigo = _codigo(retorno.dCodRes)
+            resultados.append({
+                "cdc": r.id,
+                "aprovado": codigo == CODIGO_APROVADO or str(r.dEstRes).lower().startswith("aprob"),
+                "codigo_retorno": codigo,
+                "mensagem_retorno": retorno.dMsgRes,
+            })
+        codigo_lote = _codigo(resposta.dCodResLot)
+        return {
+            "sucesso": True,
+            "codigo_lote": codigo_lote,
+            "mensagem_lote": resposta.dMsgResLot,
+            "processado": codigo_lote == "0362",
+            "resultados": resultados
+        }
+    except Exception as e:
+        return {"sucesso": False, "erro": str(e)}
@@ -0,0 +1,54 @@
+import csv
+import io
+import os
+import tempfile
+
+from openpyxl import Workbook
+
+# Quantas linhas juntar antes de mandar um pedaço para o navegador
+LINHAS_POR_PEDACO = 500
+
+
+def gerar_csv(linhas):
+    """
+    Converte um iterador de linhas (a primeira é o cabeçalho) em pedaços de bytes CSV.
+    Nada além de um pedaço fica em memória; o BOM é para o Excel abrir acentos corretamente.
+    """
+    buffer = io.StringIO()
+    escritor = csv.writer(buffer)
+    buffer.write("\ufeff")
+    pendentes = 0
+    for linha in linhas:
+        escritor.writerow(linha)
+        pendentes += 1
+        if pendentes >= LINHAS_POR_PEDACO:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate(0)
+            pendentes = 0
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def gerar_xlsx(linhas, titulo="Exportacion", tamanho_pedaco=64 * 1024):
+    """
+    Monta a planilha em modo write_only (as linhas vão direto para disco) e depois
+    devolve o arquivo em pedaços. O .xlsx é um zip, então só pode sair depois de completo.
+    """
+    livro = Workbook(write_only=True)
+    planilha = livro.create_sheet(title=titulo[:31])
+    for linha in linhas:
+        planilha.append(list(linha))
+
+    arquivo = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
+    arquivo.close()
+    try:
+        livro.save(arquivo.name)
+        with open(arquivo.name, "rb") as f:
+            while True:
+                pedaco = f.read(tamanho_pedaco)
+                if not pedaco:
+                    break
+                yield pedaco
+    finally:
+        os.remove(arquivo.name)
@@ -0,0 +1,155 @@
+import os
+import threading
+import traceback
+
+import banco_dados
+from conexao_sifen import enviar_xml_para_sifen, enviar_lote_para_sifen, consultar_lote_sifen, SIFEN_MAX_LOTE
+
+# Workers por processo; vários processos podem rodar ao mesmo tempo (a fila usa SKIP LOCKED)
+SIFEN_WORKERS = int(os.environ.get("SIFEN_WORKERS", "2"))
+SIFEN_MAX_TENTATIVAS = int(os.environ.get("SIFEN_MAX_TENTATIVAS", "8"))
+# Espera entre tentativas: BASE * 2^(tentativa-1), limitada a MAX
+SIFEN_BACKOFF_BASE = float(os.environ.get("SIFEN_BACKOFF_BASE_S", "5"))
+SIFEN_BACKOFF_MAX = float(os.environ.get("SIFEN_BACKOFF_MAX_S", "900"))
+# Sem aviso de nota nova, a fila é conferida a cada tantos segundos (retentativas vencidas, outros processos)
+SIFEN_INTERVALO_FILA = float(os.environ.get("SIFEN_INTERVALO_FILA_S", "5"))
+# Empresas com pelo menos LOTE_MINIMO documentos na fila enviam por rEnvioLote (até 50 por chamada)
+SIFEN_LOTE_MINIMO = int(os.environ.get("SIFEN_LOTE_MINIMO", "5"))
+# Intervalo entre consultas do lote e quantas consultas antes de devolver os documentos à fila
+SIFEN_LOTE_CONSULTA = float(os.environ.get("SIFEN_LOTE_CONSULTA_S", "15"))
+SIFEN_LOTE_MAX_CONSULTAS = int(os.environ.get("SIFEN_LOTE_MAX_CONSULTAS", "40"))
+
+_acordar = threading.Event()
+_parar = threading.Event()
+_threads = []
+
+
+def espera_backoff(tentativas):
+    return min(SIFEN_BACKOFF_BASE * (2 ** max(tentativas - 1, 0)), SIFEN_BACKOFF_MAX)
+
+
+def _credenciais(empresa_id):
+    config = banco_dados.obter_configuracao(empresa_id) or {}
+    caminho_cert = config.get("caminho_certificado")
+    senha_cert = config.get("senha_certificado")
+    if not (caminho_cert and os.path.exists(caminho_cert) and senha_cert):
+        return None
+    return config, caminho_cert, senha_cert
+
+
+def processar_proximo_lote():
+    """Agrupa os documentos de uma empresa com fila grande num lote. Retorna False se nenhuma empresa se qualificou."""
+    if SIFEN_LOTE_MINIMO <= 0: return False
+    reserva = banco_dados.reservar_lote_sifen(SIFEN_LOTE_MINIMO, SIFEN_MAX_LOTE)
+    if not reserva: return False
+    empresa_id, ambiente, envios = reserva
+    ids = [e["id"] for e in envios]
+
+    credenciais = _credenciais(empresa_id)
+    if not credenciais:
+        for envio in envios:
+            banco_dados.registrar_resultado_envio_sifen(envio["id"], "ERRO", mensagem_retorno="Certificado no disponible")
+        return True
+    _, caminho_cert, senha_cert = credenciais
+
+    retorno = enviar_lote_para_sifen([e["xml_assinado"] for e in envios], caminho_cert, senha_cert, ambiente, empresa_id=empresa_id, d_id=ids[0])
+    if retorno["sucesso"]:
+        lote_id = banco_dados.registrar_lote_enviado(empresa_id, ambiente, retorno["protocolo"], ids, SIFEN_LOTE_CONSULTA)
+        print(f"[SIFEN] Lote {lote_id} com {len(ids)} documentos da empresa {empresa_id} recebido (protocolo {retorno['protocolo']})")
+    else:
+        # O lote inteiro volta para a fila; as tentativas contam por documento
+        esgotados = [e["id"] for e in envios if e["tentativas"] >= SIFEN_MAX_TENTATIVAS]
+        for envio_id in esgotados:
+            banco_dados.registrar_resultado_envio_sifen(envio_id, "ERRO", mensagem_retorno=retorno.get("erro"))
+        restantes = [i for i in ids if i not in esgotados]
+        if restantes:
+            espera = espera_backoff(max(e["tentativas"] for e in envios))
+            print(f"[SIFEN] Lote da empresa {empresa_id} falhou, {len(restantes)} documentos voltam à fila em {espera:.0f}s: {retorno.get('erro')}")
+            banco_dados.reagendar_envios_sifen(restantes, retorno.get("erro"), espera)
+    return True
+
+
+def processar_proxima_consulta_lote():
+    """Consulta um lote já enviado e distribui o resultado para as notas. Retorna False se não havia consulta vencida."""
+    lote = banco_dados.reservar_consulta_lote_sifen(SIFEN_LOTE_CONSULTA)
+    if not lote: return False
+
+    credenciais = _credenciais(lote["empresa_id"])
+    if not credenciais:
+        banco_dados.concluir_lote_sifen(lote["id"], [], "ERRO", "Certificado no disponible", espera_backoff, SIFEN_MAX_TENTATIVAS)
+        return True
+    _, caminho_cert, senha_cert = credenciais
+
+    retorno = consultar_lote_sifen(lote["protocolo"], caminho_cert, senha_cert, lote["ambiente"], empresa_id=lote["empresa_id"], d_id=lote["id"])
+    if retorno["sucesso"] and retorno["processado"]:
+        banco_dados.concluir_lote_sifen(lote["id"], retorno["resultados"], "PROCESADO", retorno.get("mensagem_lote"), espera_backoff, SIFEN_MAX_TENTATIVAS)
+    elif lote["consultas"] >= SIFEN_LOTE_MAX_CONSULTAS or (retorno["sucesso"] and retorno["codigo_lote"] not in ("0361", "0362")):
+        # Lote perdido/expirado na SET: os documentos voltam para a fila
+        motivo = retorno.get("mensagem_lote") or retorno.get("erro") or "Lote sin respuesta"
+        print(f"[SIFEN] Lote {lote['id']} abandonado: {motivo}")
+        banco_dados.concluir_lote_sifen(lote["id"], [], "ERRO", motivo, espera_backoff, SIFEN_MAX_TENTATIVAS)
+    return True
+
+
+def processar_proximo_envio():
+    """Envia um documento da fila. Retorna False quando não havia nada para enviar."""
+    envio = banco_dados.reservar_envio_sifen()
+    if not envio: return False
+
+    credenciais = _credenciais(envio["empresa_id"])
+    if not credenciais:
+        banco_dados.registrar_resultado_envio_sifen(envio["id"], "ERRO", mensagem_retorno="Certificado no disponible")
+        return True
+    config, caminho_cert, senha_cert = credenciais
+
+    retorno = enviar_xml_para_sifen(envio["xml_assinado"], caminho_cert, senha_cert, envio["ambiente"], ruc_emissor=config.get("ruc"), empresa_id=envio["empresa_id"], d_id=envio["id"])
+    if retorno["sucesso"]:
+        # A SET respondeu: aprovado ou rejeitado é definitivo, não volta para a fila
+        status = "APROBADO" if retorno.get("aprovado") else "RECHAZADO"
+        if status == "RECHAZADO":
+            print(f"[SIFEN] Envio {envio['id']} (CDC {envio['cdc']}) rejeitado: {retorno.get('codigo_retorno')} - {retorno.get('mensagem_retorno')}")
+        banco_dados.registrar_resultado_envio_sifen(envio["id"], status, retorno.get("codigo_retorno"), retorno.get("mensagem_retorno"))
+    elif envio["tentativas"] >= SIFEN_MAX_TENTATIVAS:
+        print(f"[SIFEN] Envio {envio['id']} (CDC {envio['cdc']}) desistido após {envio['tentativas']} tentativas: {retorno.get('erro')}")
+        banco_dados.registrar_resultado_envio_sifen(envio["id"], "ERRO", mensagem_retorno=retorno.get("erro"))
+    else:
+        espera = espera_backoff(envio["tentativas"])
+        print(f"[SIFEN] Envio {envio['id']} falhou (tentativa {envio['tentativas']}), nova tentativa em {espera:.0f}s: {retorno.get('erro')}")
+        banco_dados.registrar_resultado_envio_sifen(envio["id"], "PENDENTE", mensagem_retorno=retorno.get("erro"), reenviar_em_s=espera)
+    return True
+
+
+def _loop_worker():
+    while not _parar.is_set():
+        try:
+            # Esvazia o que estiver vencido antes de voltar a dormir
+            # Consultas de lote primeiro, depois lotes de empresas com fila grande, depois envios avulsos
+            while not _parar.is_set() and (processar_proxima_consulta_lote() or processar_proximo_lote() or processar_proximo_envio()):
+                pass
+        except Exception:
+            traceback.print_exc()
+        _acordar.wait(SIFEN_INTERVALO_FILA)
+        _acordar.clear()
+
+
+def acordar_workers():
+    """Chamado depois de enfileirar uma nota para não esperar o próximo ciclo."""
+    _acordar.set()
+
+
+def iniciar_workers():
+    if _threads: return
+    _parar.clear()
+    for i in range(SIFEN_WORKERS):
+        t = threading.Thread(target=_loop_worker, name=f"fila-sifen-{i}", daemon=True)
+        t.start()
+        _threads.append(t)
+    print(f"[SIFEN] {SIFEN_WORKERS} workers da fila de envio iniciados.")
+
+
+def parar_workers():
+    _parar.set()
+    _acordar.set()
+    for t in _threads:
+        t.join(timeout=5)
+    _threads.clear()
@@ -1,8 +1,27 @@
 from fpdf import FPDF
-import os
-import qrcode
+from io import BytesIO
+from servico_qr import gerar_qr_png, url_consulta_sifen
 
-def gerar_pdf_nota(dados_nota, cdc, interno=False):
+# Mudou o layout? Incrementar: a versão entra no hash do cache de PDFs (cache_pdf)
+VERSAO_LAYOUT_PDF = 1
+
+TITULOS_DOCUMENTO = {
+    "FACTURA": "FACTURA ELECTRÓNICA SIFEN",
+    "NOTA_CREDITO": "NOTA DE CRÉDITO ELECTRÓNICA",
+    "REMISION": "NOTA DE REMISIÓN ELECTRÓNICA",
+    "AUTOFACTURA": "AUTOFACTURA ELECTRÓNICA",
+}
+
+def documento_interno(cdc):
+    """Documentos de planos sem SIFEN (INT-...) não levam QR nem validade fiscal."""
+    return cdc.startswith("INT-")
+
+def gerar_pdf_nota(documento, cdc, interno=False):
+    """
+    Renderiza o PDF de um documento já salvo (dict de banco_dados.buscar_documento_por_cdc)
+    e devolve os bytes; quem grava ou serve o arquivo é o cache_pdf.
+    """
+    tipo = documento.get("tipo", "FACTURA")
     pdf = FPDF()
     pdf.add_page()
     
@@ -11,9 +30,11 @@ def gerar_pdf_nota(dados_nota, cdc, interno=False):
     if interno:
         pdf.cell(0, 10, "COMPROBANTE DE VENTA INTERNO", ln=True, align="C")
     else:
-        pdf.cell(0, 10, "FACTURA ELECTRÓNICA SIFEN", ln=True, align="C")
+        pdf.cell(0, 10, TITULOS_DOCUMENTO.get(tipo, TITULOS_DOCUMENTO["FACTURA"]), ln=True, align="C")
     pdf.set_font("Arial", "", 10)
-    pdf.cell(0, 7, f"RUC Emisor: {dados_nota.ruc_emissor}", ln=True, align="C")
+    if documento.get("ruc_emissor"):
+        pdf.cell(0, 7, f"RUC Emisor: {documento['ruc_emissor']}", ln=True, align="C")
+    pdf.cell(0, 7, f"Fecha: {documento.get('data_emissao', '')}", ln=True, align="C")
     pdf.ln(5)
     
     # Corpo
@@ -23,7 +44,9 @@ def gerar_pdf_nota(dados_nota, cdc, interno=False):
     pdf.ln(2)
     
     pdf.set_font("Arial", "", 11)
-    pdf.cell(0, 10, f"Cliente: {dados_nota.nome_cliente}", ln=True)
+    pdf.cell(0, 10, f"Cliente: {documento.get('nome_cliente') or ''}", ln=True)
+    if documento.get("cdc_referencia"):
+        pdf.cell(0, 7, f"Documento asociado: {documento['cdc_referencia']}", ln=True)
     pdf.ln(5)
 
     # Tabela de Produtos (NOVO)
@@ -35,17 +58,21 @@ def gerar_pdf_nota(dados_nota, cdc, interno=False):
     pdf.ln(8)
 
     pdf.set_font("Arial", "", 10)
-    for item in dados_nota.itens:
-        subtotal = item.quantidade * item.preco_unitario
-        pdf.cell(90, 8, str(item.descricao)[:40], border=1)
-        pdf.cell(25, 8, str(item.quantidade), border=1, align="C")
-        pdf.cell(35, 8, f"Gs. {item.preco_unitario:,.0f}", border=1, align="R")
+    for item in documento.get("itens") or []:
+        quantidade = item.get("quantidade", 0)
+        preco = item.get("preco_unitario", 0) or 0
+        subtotal = quantidade * preco
+        pdf.cell(90, 8, str(item.get("descricao", ""))[:40], border=1)
+        pdf.cell(25, 8, str(quantidade), border=1, align="C")
+        pdf.cell(35, 8, f"Gs. {preco:,.0f}", border=1, align="R")
         pdf.cell(40, 8, f"Gs. {subtotal:,.0f}", border=1, align="R")
         pdf.ln(8)
 
-    pdf.ln(5)
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 10, f"TOTAL: Gs. {dados_nota.valor_total:,.0f}", ln=True, align="R")
+    # Remisiones não têm valor
+    if documento.get("valor_total") is not None:
+        pdf.ln(5)
+        pdf.set_font("Arial", "B", 12)
+        pdf.cell(0, 10, f"TOTAL: Gs. {documento['valor_total']:,.0f}", ln=True, align="R")
     
     # Rodapé com CDC e QR Code
     pdf.ln(5)
@@ -53,12 +80,9 @@ def gerar_pdf_nota(dados_nota, cdc, interno=False):
     pdf.multi_cell(0, 5, f"CDC (Código de Control): {cdc}")
     
     if not interno:
-        url_consulta = f"https://ekuatia.set.gov.py/consultas/qr?nId={cdc}"
-        qr = qrcode.make(url_consulta)
-        temp_qr = f"temp_qr_{cdc[:10]}.png"
-        qr.save(temp_qr)
-        
-        pdf.image(temp_qr, x=80, y=pdf.get_y() + 5, w=50)
+        url_consulta = documento.get("link_qrcode") or url_consulta_sifen(cdc)
+        # PNG em memória (fpdf2 aceita BytesIO): nada de arquivo temporário no diretório de trabalho
+        pdf.image(BytesIO(gerar_qr_png(url_consulta)), x=80, y=pdf.get_y() + 5, w=50)
         
         pdf.set_y(pdf.get_y() + 60)
         pdf.set_font("Arial", "B", 10)
@@ -68,13 +92,4 @@ def gerar_pdf_nota(dados_nota, cdc, interno=False):
         pdf.set_font("Arial", "I", 9)
         pdf.multi_cell(0, 5, "Este documento es de uso interno y no tiene validez fiscal.", align="C")
 
-    if not os.path.exists("notas_pdf"):
-        os.makedirs("notas_pdf")
-
-    nome_arquivo = f"notas_pdf/nota_{cdc[:10]}.pdf"
-    pdf.output(nome_arquivo)
-    
-    if not interno and os.path.exists(temp_qr):
-        os.remove(temp_qr)
-    
-    return nome_arquivo
\ No newline at end of file
+    return bytes(pdf.output())
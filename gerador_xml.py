@@ -1,5 +1,12 @@
+import copy
 import random
 from datetime import datetime
+from functools import lru_cache
+from lxml import etree
+from lxml.builder import ElementMaker
+
+NS_SIFEN = "http://ekuatia.set.gov.py/sifen/xsd"
+E = ElementMaker(namespace=NS_SIFEN, nsmap={None: NS_SIFEN})
 
 def calcular_dv_modulo11(numero_str):
     soma = 0
@@ -32,110 +39,151 @@ def gerar_cdc_sifen(ruc_emissor, tipo_doc="01", estab="001", pex="001", numero_n
     dv_cdc = calcular_dv_modulo11(cdc_43)
     return f"{cdc_43}{dv_cdc}"
 
-def construir_xml_sifen(dados, config_empresa):
+def _separar_ruc(ruc):
+    if "-" in ruc:
+        return tuple(ruc.split("-"))
+    return ruc[:-1], ruc[-1]
+
+# Partes que só mudam com a configuração da empresa: montadas uma vez e copiadas em cada DE
+@lru_cache(maxsize=1024)
+def _gOpeDE(csc):
+    return E.gOpeDE(
+        E.iTipEmi("1"),
+        E.dDesTipEmi("Normal"),
+        E.dCodSeg(csc),
+    )
+
+@lru_cache(maxsize=1024)
+def _gTimb(tipo_doc, num_timbrado, estab, pex):
+    return E.gTimb(
+        E.iTiDE(str(int(tipo_doc))),
+        E.dNumTim(num_timbrado),
+        E.dEst(estab),
+        E.dPunExp(pex),
+        E.dNumDoc("0000001"),
+    )
+
+@lru_cache(maxsize=1024)
+def _gEmis(ruc_base, ruc_dv, nome_empresa):
+    return E.gEmis(
+        E.dRucEm(ruc_base),
+        E.dDVEmi(ruc_dv),
+        E.dNomEmi(nome_empresa),
+    )
+
+def _gCamItem(item):
+    subtotal_item = item.quantidade * item.preco_unitario
+    iva_item = round(subtotal_item / 11, 2) # Cálculo padrão IVA 10%
+    elemento = E.gCamItem(
+        E.dTipOp("1"),
+        E.dCodInt(item.codigo_barras or '000'),
+        E.dDesProSer(item.descricao),
+        E.dCantProSer(str(item.quantidade)),
+        E.gValorItem(
+            E.dPUniProSer(str(item.preco_unitario)),
+            E.dTotBruOpeItem(str(subtotal_item)),
+        ),
+        E.gCamIVA(
+            E.iAfecIVA("1"),
+            E.dPropIVA("100"),
+            E.dTasaIVA("10"),
+            E.dLiqIVAItem(str(iva_item)),
+        ),
+    )
+    return elemento, iva_item
+
+def _gDtipDE(tipo_doc):
+    """Campos específicos do tipo: gCamFE na factura, gCamNCDE (motivo) na nota de crédito."""
+    if tipo_doc == "05":
+        # As notas de crédito do sistema nascem de devoluções de mercadoria
+        return E.gDtipDE(
+            E.gCamNCDE(
+                E.iMotEmi("2"),
+                E.dDesMotEmi("Devolución"),
+            ),
+        )
+    return E.gDtipDE(
+        E.gCamFE(
+            E.iIndPres("1"),
+        ),
+    )
+
+def _gCamDEAsoc(cdc_referencia):
+    """Documento associado (grupo H): a factura eletrônica que a nota de crédito corrige."""
+    return E.gCamDEAsoc(
+        E.iTipDocAso("1"),
+        E.dDesTipDocAso("Electrónico"),
+        E.dCdCDERef(cdc_referencia),
+    )
+
+def construir_de_sifen(dados, config_empresa, numero_documento=1, estab="001", pex="001", tipo_doc="01"):
     """
-    Constrói a árvore XML completa com base no Manual Técnico da SIFEN (V150)
+    Constrói a árvore XML completa com base no Manual Técnico da SIFEN (V150).
+    Devolve o elemento lxml (pronto para o assinador, sem serializar) e o CDC.
+    O lxml cuida do escape de descrições e nomes.
+    `numero_documento` vem do alocador de numeração (numeracao.py) e entra no CDC e no gTimb.
+    Com tipo_doc "05" sai uma nota de crédito associada a `dados.cdc_referencia`.
     """
-    cdc_real = gerar_cdc_sifen(dados.ruc_emissor)
+    numero_nota = str(numero_documento).zfill(7)
+    cdc_real = gerar_cdc_sifen(dados.ruc_emissor, tipo_doc=tipo_doc, estab=estab, pex=pex, numero_nota=numero_nota)
     csc = config_empresa.get("csc", "0000000000000000")
     data_hora_atual = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
     
     # Dados da Empresa
     nome_empresa = config_empresa.get("nome_empresa", "Empresa S.A.")
-    if "-" in dados.ruc_emissor:
-        ruc_emissor_base, ruc_emissor_dv = dados.ruc_emissor.split("-")
-    else:
-        ruc_emissor_base = dados.ruc_emissor[:-1]
-        ruc_emissor_dv = dados.ruc_emissor[-1]
+    ruc_emissor_base, ruc_emissor_dv = _separar_ruc(dados.ruc_emissor)
         
     # Dados do Cliente (Se não tiver RUC, assumimos Consumidor Final)
     cliente_nome = dados.nome_cliente if dados.nome_cliente else "Consumidor Final"
     
-    # 1. Montagem dos Itens (gCamItem) e somatórios
-    xml_itens = ""
+    # 1. Itens (gCamItem) e somatórios
+    g_det_gral = E.gDetGral()
     total_iva = 0
-    
-    for i, item in enumerate(dados.itens, 1):
-        descricao = item.descricao
-        quantidade = item.quantidade
-        preco_unitario = item.preco_unitario
-        subtotal_item = quantidade * preco_unitario
-        iva_item = round(subtotal_item / 11, 2) # Cálculo padrão IVA 10%
+    for item in dados.itens:
+        elemento, iva_item = _gCamItem(item)
+        g_det_gral.append(elemento)
         total_iva += iva_item
-        
-        # Tag oficial de cada linha da fatura
-        xml_itens += f"""
-            <gCamItem>
-                <dTipOp>1</dTipOp>
-                <dCodInt>{item.codigo_barras or '000'}</dCodInt>
-                <dDesProSer>{descricao}</dDesProSer>
-                <dCantProSer>{quantidade}</dCantProSer>
-                <gValorItem>
-                    <dPUniProSer>{preco_unitario}</dPUniProSer>
-                    <dTotBruOpeItem>{subtotal_item}</dTotBruOpeItem>
-                </gValorItem>
-                <gCamIVA>
-                    <iAfecIVA>1</iAfecIVA>
-                    <dPropIVA>100</dPropIVA>
-                    <dTasaIVA>10</ddTasaIVA>
-                    <dLiqIVAItem>{iva_item}</dLiqIVAItem>
-                </gCamIVA>
-            </gCamItem>"""
+
+    g_timb = copy.deepcopy(_gTimb(tipo_doc, "12345678", estab, pex))
+    g_timb.find(f"{{{NS_SIFEN}}}dNumDoc").text = numero_nota
 
     # 2. Estrutura Raiz (rDE)
-    xml_bruto = f"""<?xml version="1.0" encoding="UTF-8"?>
-<rDE xmlns="http://ekuatia.set.gov.py/sifen/xsd">
-    <dVerFor>150</dVerFor>
-    <DE Id="{cdc_real}">
-        <dDVId>{cdc_real[-1]}</dDVId>
-        <dFecFirma>{data_hora_atual}</dFecFirma>
-        <dSisFact>1</dSisFact>
-        <gOpeDE>
-            <iTipEmi>1</iTipEmi>
-            <dDesTipEmi>Normal</dDesTipEmi>
-            <dCodSeg>{csc}</dCodSeg>
-        </gOpeDE>
-        <gTimb>
-            <iTiDE>1</iTiDE>
-            <dNumTim>12345678</dNumTim>
-            <dEst>001</dEst>
-            <dPunExp>001</dPunExp>
-            <dNumDoc>0000001</dNumDoc>
-        </gTimb>
-        <gDatGralOpe>
-            <dFeEmiDE>{data_hora_atual}</dFeEmiDE>
-            <gEmis>
-                <dRucEm>{ruc_emissor_base}</dRucEm>
-                <dDVEmi>{ruc_emissor_dv}</dDVEmi>
-                <dNomEmi>{nome_empresa}</dNomEmi>
-            </gEmis>
-            <gDatRec>
-                <iNatRec>1</iNatRec>
-                <dNomRec>{cliente_nome}</dNomRec>
-            </gDatRec>
-        </gDatGralOpe>
-        <gDtipDE>
-            <gCamFE>
-                <iIndPres>1</iIndPres>
-            </gCamFE>
-        </gDtipDE>
-        <gTotSub>
-            <dSubExe>0</dSubExe>
-            <dSubExo>0</dSubExo>
-            <dSub5>0</dSub5>
-            <dSub10>{dados.valor_total}</dSub10>
-            <dTotOpe>{dados.valor_total}</dTotOpe>
-            <dTotGralOpe>{dados.valor_total}</dTotGralOpe>
-            <dIVA5>0</dIVA5>
-            <dIVA10>{total_iva}</dIVA10>
-            <dLiqTotIVA5>0</dLiqTotIVA5>
-            <dLiqTotIVA10>{total_iva}</dLiqTotIVA10>
-            <dTotalIVA>{total_iva}</dTotalIVA>
-        </gTotSub>
-        <gDetGral>
-            {xml_itens}
-        </gDetGral>
-    </DE>
-</rDE>"""
-    
-    return xml_bruto, cdc_real
\ No newline at end of file
+    de = E.DE(
+        E.dDVId(cdc_real[-1]),
+        E.dFecFirma(data_hora_atual),
+        E.dSisFact("1"),
+        copy.deepcopy(_gOpeDE(csc)),
+        g_timb,
+        E.gDatGralOpe(
+            E.dFeEmiDE(data_hora_atual),
+            copy.deepcopy(_gEmis(ruc_emissor_base, ruc_emissor_dv, nome_empresa)),
+            E.gDatRec(
+                E.iNatRec("1"),
+                E.dNomRec(cliente_nome),
+            ),
+        ),
+        _gDtipDE(tipo_doc),
+        E.gTotSub(
+            E.dSubExe("0"),
+            E.dSubExo("0"),
+            E.dSub5("0"),
+            E.dSub10(str(dados.valor_total)),
+            E.dTotOpe(str(dados.valor_total)),
+            E.dTotGralOpe(str(dados.valor_total)),
+            E.dIVA5("0"),
+            E.dIVA10(str(total_iva)),
+            E.dLiqTotIVA5("0"),
+            E.dLiqTotIVA10(str(total_iva)),
+            E.dTotalIVA(str(total_iva)),
+        ),
+        g_det_gral,
+        Id=cdc_real,
+    )
+    if tipo_doc == "05":
+        de.append(_gCamDEAsoc(dados.cdc_referencia))
+    return E.rDE(E.dVerFor("150"), de), cdc_real
+
+def construir_xml_sifen(dados, config_empresa, **numeracao):
+    """Mesmo DE de construir_de_sifen, serializado como texto."""
+    de, cdc_real = construir_de_sifen(dados, config_empresa, **numeracao)
+    return etree.tostring(de, xml_declaration=True, encoding="UTF-8").decode("utf-8"), cdc_real
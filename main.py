@@ -1,18 +1,31 @@
-from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Header, Query#
+from fastapi import FastAPI, HTTPException, File, UploadFile, Form, Header, Query, Request#
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse, StreamingResponse, JSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
 import os
 import shutil
 import mercadopago
-import urllib.request
 import json
+import asyncio
+from urllib.parse import urlencode
 
-from gerador_xml import construir_xml_sifen
+from gerador_xml import construir_de_sifen
+from numeracao import proximo_numero_documento, devolver_sobras_numeracao, TIPO_FACTURA, TIPO_NOTA_CREDITO
 from assinador_xml import assinar_documento
-from gerador_pdf import gerar_pdf_nota
-from conexao_sifen import enviar_xml_para_sifen
+from cache_pdf import obter_pdf_async
+from armazenamento_pdf import obter_armazenamento
+from servico_qr import url_consulta_sifen
+from gerador_kude import gerar_qr_code_sifen
+from conexao_sifen import descartar_cliente_sifen
+from fila_sifen import iniciar_workers as iniciar_fila_sifen, parar_workers as parar_fila_sifen, acordar_workers as acordar_fila_sifen
+from exportador import gerar_csv, gerar_xlsx
+from cache_certificados import invalidar_empresa as invalidar_cache_certificado
+from pool_cpu import pool_cpu, PoolCpuOcupado
+from cambio import cambio, CAMBIO_ACEITAR_PADRAO
+from cache_empresas import cache_empresas, ouvir_invalidacoes, parar_ouvinte, ao_alterar_empresa
+from sessao import emitir_token, verificar_token, assinar_link, link_valido, SESSAO_OBRIGATORIA
+from status_pix import consultar_pagamento_mp, eventos_status, assinatura_valida, url_notificacao, URL_PUBLICA, STATUS_FINAIS
 import banco_dados
 
 app = FastAPI(title="NubePY SaaS - SIFEN")
@@ -32,6 +45,67 @@ def startup_event():
     """Injeta dados de demo no banco ao iniciar o servidor"""
     banco_dados.injetar_dados_demo()
     print("[STARTUP] Dados de demo verificados/injetados.")
+    pool_cpu.iniciar()
+    iniciar_fila_sifen()
+    cambio.iniciar()
+    # Alterações de configuração/plano feitas em outros workers chegam por LISTEN/NOTIFY
+    ao_alterar_empresa(invalidar_cache_certificado)
+    ao_alterar_empresa(descartar_cliente_sifen)
+    ouvir_invalidacoes(banco_dados.DATABASE_URL)
+
+@app.on_event("shutdown")
+def shutdown_event():
+    parar_fila_sifen()
+    cambio.parar()
+    parar_ouvinte()
+    pool_cpu.fechar()
+    devolver_sobras_numeracao()
+
+def _empresa_do_caminho(caminho):
+    # Rotas com a empresa no caminho. O /webhook fica de fora (quem chama é o Mercado Pago, com a
+    # assinatura dele) e o /super-admin age sobre qualquer empresa por definição. Sem sessão, o
+    # /baixar-pdf só passa com link assinado (conferido no endpoint)
+    partes = caminho.strip("/").split("/")
+    if len(partes) == 3 and partes[0] == "baixar-pdf": return partes[1]
+    return None
+
+@app.middleware("http")
+async def validar_sessao(request: Request, call_next):
+    """
+    Com token de sessão (Authorization: Bearer ou ?token= em links/EventSource) a empresa vem dele:
+    o X-Empresa-ID e o ?empresa_id= enviados pelo cliente são substituídos pelo valor assinado, e uma
+    empresa no caminho diferente da sessão é recusada.
+    """
+    autorizacao = request.headers.get("authorization", "")
+    token = autorizacao[7:] if autorizacao.lower().startswith("bearer ") else request.query_params.get("token")
+    sessao = verificar_token(token) if token else None
+    if token and not sessao:
+        return JSONResponse(status_code=401, content={"detail": "Sesión expirada, ingrese nuevamente."})
+    if sessao:
+        request.state.sessao = sessao
+        empresa = str(sessao["empresa_id"])
+        request.scope["headers"] = [(k, v) for k, v in request.scope["headers"] if k != b"x-empresa-id"] + [(b"x-empresa-id", empresa.encode())]
+        if "empresa_id" in request.query_params:
+            parametros = [(k, empresa if k == "empresa_id" else v) for k, v in request.query_params.multi_items()]
+            request.scope["query_string"] = urlencode(parametros).encode()
+        empresa_caminho = _empresa_do_caminho(request.url.path)
+        if empresa_caminho is not None and empresa_caminho != empresa and sessao["rol"] != "superadmin":
+            return JSONResponse(status_code=403, content={"detail": "Acceso denegado."})
+    elif SESSAO_OBRIGATORIA and ("x-empresa-id" in request.headers or "empresa_id" in request.query_params or request.url.path.startswith("/super-admin")):
+        return JSONResponse(status_code=401, content={"detail": "Sesión requerida."})
+    if sessao and request.url.path.startswith("/super-admin") and sessao["rol"] != "superadmin":
+        return JSONResponse(status_code=403, content={"detail": "Acceso denegado."})
+    return await call_next(request)
+
+@app.exception_handler(banco_dados.EstoqueInsuficiente)
+def estoque_insuficiente(request, exc):
+    # Outro caixa vendeu o mesmo estoque entre a conferência e a baixa; a venda inteira foi desfeita
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+@app.exception_handler(PoolCpuOcupado)
+def pool_cpu_ocupado(request, exc):
+    # Melhor o caixa tentar de novo em instantes do que a fila de CPU crescer sem limite
+    return JSONResponse(status_code=503, content={"detail": "Servidor ocupado, intente nuevamente en unos segundos."}, headers={"Retry-After": "2"})
 
 class DadosLogin(BaseModel):
     ruc: str
@@ -158,17 +232,6 @@ class ValidacaoAdmin(BaseModel):
 class PedidoPix(BaseModel):
     valor_guaranis: float
 
-def obter_taxa_cambio():
-    try:
-        req = urllib.request.Request("https://economia.awesomeapi.com.br/last/BRL-PYG", headers={'User-Agent': 'Mozilla/5.0'})
-        with urllib.request.urlopen(req, timeout=3) as response:
-            dados = json.loads(response.read().decode())
-            return float(dados["BRLPYG"]["ask"])
-    except Exception:
-        return 1450.0
-    
-
- 
 @app.post("/gerar-pix")
 
 
@@ -186,10 +249,11 @@ def gerar_pix_dinamico(
     if not token_mp or token_mp.strip() == "":
         raise HTTPException(status_code=400, detail="El comercio no ha configurado su Token de Mercado Pago.")
 
-    # 2. Conversão de Moeda (MVP: Taxa fixa de 1 BRL = 1450 PYG)
-    # No futuro, moveremos esta taxa para a tela de Ajustes.
-    taxa_cambio = obter_taxa_cambio()
-    valor_reais = round(pedido.valor_guaranis / taxa_cambio, 2)
+    # 2. Conversão de Moeda: cotação em cache, renovada em segundo plano (cambio.py)
+    cotacao = cambio.obter_cotacao()
+    if cotacao["fonte"] == "padrao" and not CAMBIO_ACEITAR_PADRAO:
+        raise HTTPException(status_code=503, detail="Cotización BRL/PYG no disponible, intente nuevamente en unos segundos.", headers={"Retry-After": "30"})
+    valor_reais = round(pedido.valor_guaranis / cotacao["taxa"], 2)
     
     if valor_reais < 0.10:
         raise HTTPException(status_code=400, detail="El valor mínimo para PIX es R$ 0,10")
@@ -209,6 +273,9 @@ def gerar_pix_dinamico(
                 "last_name": "Mostrador"
             }
         }
+        # Com URL pública configurada o status chega pelo webhook, não por polling
+        if url_notificacao(empresa_id):
+            dados_pagamento["notification_url"] = url_notificacao(empresa_id)
         
         resposta = sdk.payment().create(dados_pagamento)
         pagamento = resposta["response"]
@@ -222,10 +289,14 @@ def gerar_pix_dinamico(
         # O MP devolve a linha "Copia e Cola" e a imagem do QR Code em Base64
         codigo_copia_cola = pagamento["point_of_interaction"]["transaction_data"]["qr_code"]
         qr_code_img = pagamento["point_of_interaction"]["transaction_data"]["qr_code_base64"]
+        banco_dados.registrar_pagamento_pix(int(empresa_id), pagamento["id"], pedido.valor_guaranis, valor_reais, cotacao)
         
         return {
             "sucesso": True,
             "valor_reais": valor_reais,
+            "taxa_cambio": cotacao["taxa"],
+            "fonte_taxa": cotacao["fonte"],
+            "taxa_estimada": cotacao["fonte"] == "padrao",
             "qr_code_base64": qr_code_img,
             "copia_cola": codigo_copia_cola,
             "id_pagamento_mp": pagamento["id"]
@@ -254,6 +325,8 @@ class FuncionarioEditar(BaseModel):
 def fazer_login(dados: DadosLogin):
     resultado = banco_dados.autenticar_usuario(dados.ruc, dados.senha)
     if resultado["sucesso"]:
+        # Daqui em diante a empresa e o perfil vêm do token, sem nova consulta
+        resultado["token"] = emitir_token(resultado["empresa_id"], resultado["rol"], resultado.get("funcionario_id"))
         # Se for a conta demo (RUC 9999999-9), garantir que os dados demo existam
         if dados.ruc == "9999999-9":
             # Executar a geração de dados demo em background (sem bloquear a resposta)
@@ -284,6 +357,26 @@ def listar_todas_empresas():
 def metricas_saas():
     return banco_dados.obter_metricas_saas()
 
+@app.get("/super-admin/metricas-pool")
+def metricas_pool_banco():
+    """Espera por conexão e saturação do pool do Postgres neste worker"""
+    return banco_dados.metricas_pool()
+
+@app.get("/super-admin/metricas-cache")
+def metricas_cache_empresas():
+    """Acertos do cache de configuração/plano das empresas neste worker"""
+    return cache_empresas.metricas()
+
+@app.get("/super-admin/cambio")
+def status_cambio():
+    """Cotação BRL/PYG em cache, idade e último erro da fonte"""
+    return cambio.status()
+
+@app.get("/super-admin/metricas-cpu")
+def metricas_pool_cpu():
+    """Processos, fila e tempo médio do pool de CPU (assinatura e PDFs) neste worker"""
+    return pool_cpu.metricas()
+
 @app.post("/super-admin/criar-empresa")
 def criar_empresa(dados: NovaEmpresa):
     sucesso, msg = banco_dados.criar_nova_empresa(dados.nome, dados.ruc, dados.senha_admin, dados.senha_caixa, dados.plano, dados.valor_mensalidade)
@@ -452,16 +545,13 @@ def api_emitir_autofactura(dados: DadosAutofactura, x_empresa_id: int = Header(.
     if not permite_sifen:
         # Modo interno para planos Lite/Lite Premium
         cdc_real = f"INT-AUT-{os.urandom(6).hex().upper()}"
-        link_pdf = f"/baixar-pdf/{cdc_real[:10]}"
+        link_pdf = link_pdf_documento(x_empresa_id, cdc_real)
         link_qrcode = ""
         mensaje = "Autofactura generada (Uso Interno)"
     else:
         cdc_real = f"03{x_empresa_id}AUT{os.urandom(8).hex().upper()}"
-        link_pdf = f"/baixar-pdf/{cdc_real[:10]}"
-        if ambiente == "produccion":
-            link_qrcode = f"https://ekuatia.set.gov.py/consultas/qr?nId={cdc_real}"
-        else:
-            link_qrcode = f"https://sifen-test.set.gov.py/consultas/qr?nId={cdc_real}"
+        link_pdf = link_pdf_documento(x_empresa_id, cdc_real)
+        link_qrcode = url_consulta_sifen(cdc_real, ambiente)
         mensaje = "Autofactura generada (Aprobado SIFEN)"
 
     itens_dicts = [{"codigo_barras": i.codigo_barras, "descricao": i.descricao, "quantidade": i.quantidade, "preco_unitario": i.preco_unitario} for i in dados.itens]
@@ -529,6 +619,9 @@ def salvar_config_route(
         csc,
         mercado_pago_token
     )
+    # A senha do certificado pode ter mudado
+    invalidar_cache_certificado(int(empresa_id))
+    descartar_cliente_sifen(int(empresa_id))
     return {"mensagem": "Configuración guardada con éxito"}
 
 @app.post("/upload-certificado")
@@ -537,6 +630,8 @@ def upload_certificado(arquivo: UploadFile = File(...), x_empresa_id: int = Head
     caminho_destino = f"certificados/emp_{x_empresa_id}_{arquivo.filename}"
     with open(caminho_destino, "wb") as buffer: shutil.copyfileobj(arquivo.file, buffer)
     banco_dados.salvar_caminho_certificado(x_empresa_id, caminho_destino)
+    invalidar_cache_certificado(x_empresa_id)
+    descartar_cliente_sifen(x_empresa_id)
     return {"mensaje": "Certificado digital subido"}
 
 @app.post("/alternar-ambiente")
@@ -602,29 +697,39 @@ def api_detalhes_auditoria(auditoria_id: int, x_empresa_id: int = Header(...)):
 
 @app.post("/emitir-nota")
 def emitir_nota(dados: DadosNota, x_empresa_id: int = Header(...)):
-    caixa_atual = banco_dados.status_caixa_atual(x_empresa_id)
-    if not caixa_atual.get("aberto"):
+    # Config, plano, caixa e produtos do carrinho numa única ida ao banco
+    contexto = banco_dados.carregar_contexto_emissao(x_empresa_id, [i.codigo_barras for i in dados.itens])
+    if not contexto: raise HTTPException(status_code=400, detail="Configuración no encontrada.")
+
+    if not contexto["caixa"]["aberto"]:
         raise HTTPException(status_code=403, detail="Debe abrir la caja antes de registrar ventas/devoluciones.")
 
-    config = banco_dados.obter_configuracao(x_empresa_id)
-    if not config: raise HTTPException(status_code=400, detail="Configuración no encontrada.")
+    # Estoque conferido com as linhas já carregadas, antes de gastar um número de documento;
+    # a baixa em salvar_nota confere de novo sob lock
+    if not dados.cdc_referencia and not banco_dados.PERMITIR_ESTOQUE_NEGATIVO:
+        faltas = banco_dados.faltas_estoque(contexto["produtos"], dados.itens)
+        if faltas:
+            detalhe = ", ".join(f"{contexto['produtos'][cod]['descricao']} (quedan {qtd})" for cod, qtd in faltas.items())
+            raise HTTPException(status_code=409, detail=f"Stock insuficiente: {detalhe}")
+
+    config = contexto["config"]
     
     # Verificar se o plano permite emissão SIFEN
-    plano = banco_dados.obter_plano_empresa(x_empresa_id)
+    plano = contexto["plano"]
     permite_sifen = banco_dados.plano_permite_sifen(plano)
 
     # Modo demo para RUC 9999999-9
     if dados.ruc_emissor == '9999999-9':
-        # Gerar CDC fake para registro local
-        import random
-        cdc_real = f"DEMO-{random.randint(100000, 999999)}"
+        # CDC fake para registro local (sequência própria, não colide com as notas reais). 7 dígitos:
+        # os antigos eram aleatórios de 6 (100000-999999) e seguem no índice único por empresa
+        cdc_real = f"DEMO-{proximo_numero_documento(x_empresa_id, '001', '001', 'DEMO'):07d}"
         link_pdf = ""
         link_qrcode = ""
         if dados.cdc_referencia:
             banco_dados.salvar_nota_credito(x_empresa_id, dados.cdc_referencia, cdc_real, dados.nome_cliente, dados.valor_total, dados.itens, link_pdf)
             mensagem_retorno = "Nota de Crédito generada (Demo)"
         else:
-            banco_dados.salvar_nota(x_empresa_id, dados.ruc_emissor, dados.nome_cliente, dados.valor_total, cdc_real, dados.itens, link_pdf, link_qrcode, dados.metodo_pago)
+            banco_dados.salvar_nota(x_empresa_id, dados.ruc_emissor, dados.nome_cliente, dados.valor_total, cdc_real, dados.itens, link_pdf, link_qrcode, dados.metodo_pago, contexto=contexto)
             mensagem_retorno = "Factura generada (Demo)"
         return {
             "demo_mode": True,
@@ -636,17 +741,16 @@ def emitir_nota(dados: DadosNota, x_empresa_id: int = Header(...)):
         
     if not permite_sifen:
         # Modo interno para planos Lite/Lite Premium
-        import random
-        cdc_real = f"INT-{random.randint(100000, 999999)}"
-        link_pdf = f"/baixar-pdf/{cdc_real[:10]}"
+        # 7 dígitos pelo mesmo motivo do DEMO acima: nunca iguala um INT-nnnnnn antigo
+        cdc_real = f"INT-{proximo_numero_documento(x_empresa_id, '001', '001', 'INT'):07d}"
+        link_pdf = link_pdf_documento(x_empresa_id, cdc_real)
         link_qrcode = ""
         if dados.cdc_referencia:
             banco_dados.salvar_nota_credito(x_empresa_id, dados.cdc_referencia, cdc_real, dados.nome_cliente, dados.valor_total, dados.itens, link_pdf)
             mensagem_retorno = "Nota de Crédito generada (Uso Interno)"
         else:
-            banco_dados.salvar_nota(x_empresa_id, dados.ruc_emissor, dados.nome_cliente, dados.valor_total, cdc_real, dados.itens, link_pdf, link_qrcode, dados.metodo_pago)
+            banco_dados.salvar_nota(x_empresa_id, dados.ruc_emissor, dados.nome_cliente, dados.valor_total, cdc_real, dados.itens, link_pdf, link_qrcode, dados.metodo_pago, contexto=contexto)
             mensagem_retorno = "Comprobante de Venta Interno generado"
-        gerar_pdf_nota(dados, cdc_real, interno=True)
         return {
             "interno": True,
             "mensaje": mensagem_retorno,
@@ -657,49 +761,53 @@ def emitir_nota(dados: DadosNota, x_empresa_id: int = Header(...)):
     
     # Fluxo normal SIFEN
     ambiente = config.get("ambiente_sifen", "testes")
-    xml_bruto, cdc_real = construir_xml_sifen(dados, config)
+    tipo_doc = TIPO_NOTA_CREDITO if dados.cdc_referencia else TIPO_FACTURA
+    numero_documento = proximo_numero_documento(x_empresa_id, "001", "001", tipo_doc)
+    de_sifen, cdc_real = construir_de_sifen(dados, config, numero_documento, "001", "001", tipo_doc)
     
     caminho_cert = config.get("caminho_certificado")
     senha_cert = config.get("senha_certificado")
-    xml_final_assinado = xml_bruto
     status_sifen = "No Enviado (Falta Certificado)"
+    envio_sifen = None
     
+    # Só a assinatura acontece aqui; o envio para a SET fica com a fila (fila_sifen)
     try:
         if caminho_cert and os.path.exists(caminho_cert) and senha_cert:
-            xml_final_assinado = assinar_documento(xml_bruto, caminho_cert, senha_cert)
-            retorno_sifen = enviar_xml_para_sifen(xml_final_assinado, caminho_cert, senha_cert, ambiente, ruc_emissor=config['ruc'])
-            
-            if retorno_sifen["sucesso"]:
-                status_sifen = f"Aprobado (Cod: {retorno_sifen.get('codigo_retorno', 'OK')})"
-            else:
-                status_sifen = f"Rechazado SET: {retorno_sifen.get('erro', 'Desconocido')}"
+            xml_final_assinado = assinar_documento(de_sifen, caminho_cert, senha_cert, empresa_id=x_empresa_id)
+            envio_sifen = {"xml_assinado": xml_final_assinado, "ambiente": ambiente}
+            status_sifen = "En cola de envío"
+    except PoolCpuOcupado:
+        raise
     except Exception as e:
         print(f"Erro no processamento SIFEN: {str(e)}")
         status_sifen = f"Error Interno: {str(e)}"
     
-    if ambiente == "produccion":
-        link_qrcode = f"https://ekuatia.set.gov.py/consultas/qr?nId={cdc_real}"
-    else:
-        link_qrcode = f"https://sifen-test.set.gov.py/consultas/qr?nId={cdc_real}"
+    link_qrcode = url_consulta_sifen(cdc_real, ambiente)
 
-    link_pdf = f"/baixar-pdf/{cdc_real[:10]}"
+    link_pdf = link_pdf_documento(x_empresa_id, cdc_real)
     
     if dados.cdc_referencia:
-        banco_dados.salvar_nota_credito(x_empresa_id, dados.cdc_referencia, cdc_real, dados.nome_cliente, dados.valor_total, dados.itens, link_pdf)
+        banco_dados.salvar_nota_credito(x_empresa_id, dados.cdc_referencia, cdc_real, dados.nome_cliente, dados.valor_total, dados.itens, link_pdf, envio_sifen=envio_sifen)
         mensagem_retorno = f"Nota de Crédito generada | SIFEN: {status_sifen}"
     else:
-        banco_dados.salvar_nota(x_empresa_id, dados.ruc_emissor, dados.nome_cliente, dados.valor_total, cdc_real, dados.itens, link_pdf, link_qrcode, dados.metodo_pago)
+        banco_dados.salvar_nota(x_empresa_id, dados.ruc_emissor, dados.nome_cliente, dados.valor_total, cdc_real, dados.itens, link_pdf, link_qrcode, dados.metodo_pago, contexto=contexto, envio_sifen=envio_sifen)
         mensagem_retorno = f"Factura generada | SIFEN: {status_sifen}"
-
-    gerar_pdf_nota(dados, cdc_real, interno=False)
+    if envio_sifen: acordar_fila_sifen()
     
     return {
         "mensaje": mensagem_retorno, 
         "cdc": cdc_real,
         "link_qrcode": link_qrcode,
-        "link_pdf": link_pdf
+        "link_pdf": link_pdf,
+        "status_sifen": "PENDENTE" if envio_sifen else None
     }
 
+@app.get("/status-sifen/{cdc}")
+def status_sifen(cdc: str, x_empresa_id: int = Header(...)):
+    status = banco_dados.obter_status_sifen(x_empresa_id, cdc)
+    if not status: raise HTTPException(status_code=404, detail="Documento sin envío SIFEN")
+    return status
+
 @app.post("/emitir-remision")
 def api_emitir_remision(dados: DadosRemision, x_empresa_id: int = Header(...)):
     config = banco_dados.obter_configuracao(x_empresa_id)
@@ -715,16 +823,13 @@ def api_emitir_remision(dados: DadosRemision, x_empresa_id: int = Header(...)):
     if not permite_sifen:
         # Modo interno para planos Lite/Lite Premium
         cdc_real = f"INT-REM-{os.urandom(6).hex().upper()}"
-        link_pdf = f"/baixar-pdf/{cdc_real[:10]}"
+        link_pdf = link_pdf_documento(x_empresa_id, cdc_real)
         link_qrcode = ""
         mensaje = "Nota de Remisión generada (Uso Interno)"
     else:
         cdc_real = f"02{x_empresa_id}REM{os.urandom(8).hex().upper()}"
-        link_pdf = f"/baixar-pdf/{cdc_real[:10]}"
-        if ambiente == "produccion":
-            link_qrcode = f"https://ekuatia.set.gov.py/consultas/qr?nId={cdc_real}"
-        else:
-            link_qrcode = f"https://sifen-test.set.gov.py/consultas/qr?nId={cdc_real}"
+        link_pdf = link_pdf_documento(x_empresa_id, cdc_real)
+        link_qrcode = url_consulta_sifen(cdc_real, ambiente)
         mensaje = "Nota de Remisión generada (Aprobado SIFEN)"
         
     itens_dicts = [{"codigo_barras": i.codigo_barras, "descricao": i.descricao, "quantidade": i.quantidade} for i in dados.itens]
@@ -746,22 +851,89 @@ def api_emitir_remision(dados: DadosRemision, x_empresa_id: int = Header(...)):
 def api_listar_remisiones(x_empresa_id: int = Header(...)):
     return banco_dados.listar_remisiones(x_empresa_id)
 
+def link_pdf_documento(empresa_id, cdc):
+    # O PDF só é gerado quando este link é aberto (ver baixar_pdf_documento). O link vai para o
+    # cliente sem sessão (WhatsApp), então leva assinatura: CDCs internos são sequenciais
+    return f"/baixar-pdf/{empresa_id}/{cdc}?assinatura={assinar_link('pdf', empresa_id, cdc)}"
+
+def _intervalo_pedido(cabecalho_range, tamanho):
+    """(inicio, fim) de um cabeçalho 'Range: bytes=a-b' de intervalo único; None = arquivo inteiro."""
+    if not cabecalho_range or not cabecalho_range.startswith("bytes=") or "," in cabecalho_range:
+        return None
+    inicio_txt, _, fim_txt = cabecalho_range[6:].strip().partition("-")
+    try:
+        if not inicio_txt:
+            # bytes=-N: os últimos N bytes
+            inicio, fim = max(tamanho - int(fim_txt), 0), tamanho - 1
+        else:
+            inicio = int(inicio_txt)
+            fim = min(int(fim_txt), tamanho - 1) if fim_txt else tamanho - 1
+    except ValueError:
+        return None
+    if inicio > fim or inicio >= tamanho:
+        raise HTTPException(status_code=416, detail="Rango no válido", headers={"Content-Range": f"bytes */{tamanho}"})
+    return inicio, fim
+
+@app.get("/baixar-pdf/{empresa_id}/{cdc}")
+async def baixar_pdf_documento(request: Request, empresa_id: int, cdc: str, assinatura: Optional[str] = None, range: Optional[str] = Header(None)):
+    # async: nenhuma thread do servidor fica presa enquanto o PDF é renderizado no pool de CPU
+    sessao = getattr(request.state, "sessao", None)
+    if not link_valido(assinatura, "pdf", empresa_id, cdc) and not (sessao and sessao["empresa_id"] == empresa_id):
+        raise HTTPException(status_code=403, detail="Enlace no válido")
+    documento = await asyncio.to_thread(banco_dados.buscar_documento_por_cdc, empresa_id, cdc)
+    if not documento: raise HTTPException(status_code=404, detail="PDF no encontrado")
+    chave, tamanho = await obter_pdf_async(empresa_id, documento, cdc)
+    cabecalhos = {"Accept-Ranges": "bytes", "Content-Disposition": f'inline; filename="Documento_{cdc}.pdf"'}
+    intervalo = _intervalo_pedido(range, tamanho)
+    if intervalo is None:
+        cabecalhos["Content-Length"] = str(tamanho)
+        return StreamingResponse(obter_armazenamento().ler(chave), media_type='application/pdf', headers=cabecalhos)
+    inicio, fim = intervalo
+    cabecalhos["Content-Range"] = f"bytes {inicio}-{fim}/{tamanho}"
+    cabecalhos["Content-Length"] = str(fim - inicio + 1)
+    return StreamingResponse(obter_armazenamento().ler(chave, inicio, fim), status_code=206, media_type='application/pdf', headers=cabecalhos)
+
+@app.get("/qrcode/{cdc}")
+def qrcode_documento(cdc: str, ambiente: str = "produccion"):
+    return gerar_qr_code_sifen(cdc, ambiente)
+
 @app.get("/baixar-pdf/{id_nota}")
 def baixar_pdf(id_nota: str):
+    # Links antigos: PDFs gerados na hora da venda em notas_pdf/
     caminho = f"notas_pdf/nota_{id_nota}.pdf"
     if os.path.exists(caminho): return FileResponse(caminho, media_type='application/pdf', filename=f"Documento_{id_nota}.pdf")
     raise HTTPException(status_code=404, detail="PDF no encontrado")
 
 @app.get("/api/nota/{cdc}")
 def obter_nota_por_cdc(cdc: str, x_empresa_id: int = Header(...)):
-    nota = banco_dados.obter_nota_por_cdc(x_empresa_id, cdc)
+    # Qualquer tipo de documento (factura, nota de crédito, remisión, autofactura)
+    nota = banco_dados.buscar_documento_por_cdc(x_empresa_id, cdc)
     if nota: return nota
     raise HTTPException(status_code=404, detail="Nota no encontrada")
 
 @app.get("/listar-notas")
-def listar_notas(busca: Optional[str] = "", inicio: Optional[str] = None, fim: Optional[str] = None, x_empresa_id: int = Header(...)):
-    historico = banco_dados.listar_todas_notas(x_empresa_id, busca, inicio, fim)
-    return {"total": len(historico), "historico": historico}
+def listar_notas(busca: Optional[str] = "", inicio: Optional[str] = None, fim: Optional[str] = None, after_id: Optional[int] = None, limit: int = banco_dados.LIMITE_PAGINA_NOTAS, x_empresa_id: int = Header(...)):
+    historico, proximo = banco_dados.listar_todas_notas(x_empresa_id, busca, inicio, fim, after_id, limit)
+    return {"historico": historico, "proximo_after_id": proximo}
+
+@app.get("/contar-notas")
+def contar_notas(busca: Optional[str] = "", inicio: Optional[str] = None, fim: Optional[str] = None, x_empresa_id: int = Header(...)):
+    return {"total": banco_dados.contar_notas(x_empresa_id, busca, inicio, fim)}
+
+@app.get("/exportar/{tipo}")
+def exportar(tipo: str, formato: str = "csv", inicio: Optional[str] = None, fim: Optional[str] = None, empresa_id: Optional[int] = None, x_empresa_id: Optional[int] = Header(None)):
+    # Downloads por link não mandam cabeçalhos, então a empresa também pode vir na query string
+    empresa = x_empresa_id or empresa_id
+    if not empresa: raise HTTPException(status_code=400, detail="Empresa no informada")
+    if tipo not in banco_dados.EXPORTACOES: raise HTTPException(status_code=404, detail="Exportación no disponible")
+    if formato not in ("csv", "xlsx"): raise HTTPException(status_code=400, detail="Formato inválido")
+
+    linhas = banco_dados.exportar_linhas(empresa, tipo, inicio, fim)
+    if formato == "xlsx":
+        conteudo, media_type = gerar_xlsx(linhas, tipo), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    else:
+        conteudo, media_type = gerar_csv(linhas), "text/csv; charset=utf-8"
+    return StreamingResponse(conteudo, media_type=media_type, headers={"Content-Disposition": f'attachment; filename="{tipo}.{formato}"'})
 
 @app.get("/cierre-caja")
 def api_cierre_caja(inicio: Optional[str] = None, fim: Optional[str] = None, x_empresa_id: int = Header(...)):
@@ -781,22 +953,42 @@ def servir_js():
     return FileResponse("app.js")
 @app.get("/status-pix/{pagamento_id}")
 def verificar_status_pix(pagamento_id: str, empresa_id: str = Header(None, alias="X-Empresa-ID")):
+    # Lê a tabela local (atualizada pelo webhook); sem webhook configurado, ou sem registro,
+    # o status ainda aberto é consultado no Mercado Pago
     try:
-        config = banco_dados.obter_configuracao(int(empresa_id))
-        token_mp = config.get("mercado_pago_token", "")
-        
-        if not token_mp:
-            raise HTTPException(status_code=400, detail="Token MP não configurado")
-            
-        sdk = mercadopago.SDK(token_mp)
-        resposta = sdk.payment().get(pagamento_id)
-        pagamento = resposta["response"]
-        
-        # Retorna o status oficial (ex: "pending", "approved", "rejected")
-        return {"sucesso": True, "status": pagamento.get("status", "pending")}
-        
+        registro = banco_dados.obter_status_pix(int(empresa_id), pagamento_id)
+        if registro and (URL_PUBLICA or registro["status"] in STATUS_FINAIS):
+            return {"sucesso": True, "status": registro["status"]}
+        return {"sucesso": True, "status": consultar_pagamento_mp(int(empresa_id), pagamento_id)}
     except Exception as e:
         return {"sucesso": False, "erro": str(e)}
+
+@app.get("/status-pix/{pagamento_id}/eventos")
+def eventos_status_pix(pagamento_id: str, empresa_id: int):
+    # EventSource não manda cabeçalhos, então a empresa vem na query string
+    return StreamingResponse(eventos_status(empresa_id, pagamento_id), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.post("/webhook/mercadopago/{empresa_id}")
+async def webhook_mercadopago(empresa_id: int, request: Request):
+    """Notificação do Mercado Pago: uma por mudança de status, no lugar do polling de cada caixa"""
+    parametros = request.query_params
+    try:
+        corpo = await request.json()
+    except Exception:
+        corpo = {}
+    tipo = corpo.get("type") or parametros.get("type") or parametros.get("topic")
+    pagamento_id = (corpo.get("data") or {}).get("id") or parametros.get("data.id") or parametros.get("id")
+    if tipo != "payment" or not pagamento_id:
+        return {"ok": True}
+    if not assinatura_valida(request.headers.get("x-signature"), request.headers.get("x-request-id"), parametros.get("data.id") or pagamento_id):
+        raise HTTPException(status_code=401, detail="Firma inválida")
+    try:
+        status = await asyncio.to_thread(consultar_pagamento_mp, empresa_id, pagamento_id)
+    except Exception as e:
+        # 500 faz o Mercado Pago reenviar a notificação mais tarde
+        print(f"[PIX] Webhook do pagamento {pagamento_id} (empresa {empresa_id}) falhou: {e}")
+        raise HTTPException(status_code=500, detail="No se pudo consultar el pago")
+    return {"ok": True, "status": status}
     
   # ==========================================
 # ROTAS DO SUPER ADMIN (COBRANÇA SIPAP)
@@ -806,110 +998,102 @@ def verificar_status_pix(pagamento_id: str, empresa_id: str = Header(None, alias
 def gerar_fatura_manual(empresa_id: int):
     try:
         from datetime import datetime, timedelta
-        conn = banco_dados.get_conexao()
-        cursor = conn.cursor()
+        with banco_dados.obter_conexao() as conn:
+            cursor = conn.cursor()
         
-        # Busca o valor que o cliente tem de pagar
-        cursor.execute("SELECT valor_mensalidade FROM empresas WHERE id = %s", (empresa_id,))
-        cliente = cursor.fetchone()
+            # Busca o valor que o cliente tem de pagar
+            cursor.execute("SELECT valor_mensalidade FROM empresas WHERE id = %s", (empresa_id,))
+            cliente = cursor.fetchone()
         
-        if not cliente:
-            return {"sucesso": False, "detail": "Empresa não encontrada."}
+            if not cliente:
+                return {"sucesso": False, "detail": "Empresa não encontrada."}
             
-        # CORREÇÃO: Lê o valor direto da primeira posição da tupla
-        valor = float(cliente[0]) if cliente[0] else 0.0
+            # CORREÇÃO: Lê o valor direto da primeira posição da tupla
+            valor = float(cliente[0]) if cliente[0] else 0.0
         
-        if valor <= 0:
-            return {"sucesso": False, "detail": "Este plano é gratuito."}
+            if valor <= 0:
+                return {"sucesso": False, "detail": "Este plano é gratuito."}
             
-        # Dá 5 dias de prazo para o cliente pagar
-        vencimento = datetime.now() + timedelta(days=5) 
+            # Dá 5 dias de prazo para o cliente pagar
+            vencimento = datetime.now() + timedelta(days=5) 
         
-        # Salva a conta como Pendente
-        cursor.execute('''
-            INSERT INTO faturas_saas (empresa_id, valor, data_vencimento, status, id_pagamento_mp)
-            VALUES (%s, %s, %s, 'Pendente', 'SIPAP')
-        ''', (empresa_id, valor, vencimento))
+            # Salva a conta como Pendente
+            cursor.execute('''
+                INSERT INTO faturas_saas (empresa_id, valor, data_vencimento, status, id_pagamento_mp)
+                VALUES (%s, %s, %s, 'Pendente', 'SIPAP')
+            ''', (empresa_id, valor, vencimento))
         
-        conn.commit()
-        return {"sucesso": True, "detail": "Factura generada con éxito!"}
+            conn.commit()
+            return {"sucesso": True, "detail": "Factura generada con éxito!"}
     except Exception as e:
-        if 'conn' in locals(): conn.rollback()
         return {"sucesso": False, "detail": str(e)}
     finally:
         if 'cursor' in locals(): cursor.close()
-        if 'conn' in locals(): conn.close()
 
 @app.get("/super-admin/faturas")
 def listar_faturas():
     try:
-        conn = banco_dados.get_conexao()
-        cursor = conn.cursor()
-        # Puxa o nome da empresa e os dados da fatura
-        cursor.execute('''
-            SELECT f.id, e.nome_empresa, f.valor, f.data_vencimento, f.status 
-            FROM faturas_saas f
-            JOIN empresas e ON f.empresa_id = e.id
-            ORDER BY f.id DESC
-        ''')
-        faturas = cursor.fetchall()
-        return faturas
+        with banco_dados.obter_conexao() as conn:
+            cursor = conn.cursor()
+            # Puxa o nome da empresa e os dados da fatura
+            cursor.execute('''
+                SELECT f.id, e.nome_empresa, f.valor, f.data_vencimento, f.status 
+                FROM faturas_saas f
+                JOIN empresas e ON f.empresa_id = e.id
+                ORDER BY f.id DESC
+            ''')
+            faturas = cursor.fetchall()
+            return faturas
     except Exception as e:
         return []
     finally:
         if 'cursor' in locals(): cursor.close()
-        if 'conn' in locals(): conn.close()
 
 @app.put("/super-admin/faturas/{fatura_id}/pagar")
 def aprovar_pagamento(fatura_id: int):
     try:
-        conn = banco_dados.get_conexao()
-        cursor = conn.cursor()
-        # Muda o status para Pago
-        cursor.execute("UPDATE faturas_saas SET status = 'Pago' WHERE id = %s", (fatura_id,))
-        conn.commit()
-        return {"sucesso": True}
+        with banco_dados.obter_conexao() as conn:
+            cursor = conn.cursor()
+            # Muda o status para Pago
+            cursor.execute("UPDATE faturas_saas SET status = 'Pago' WHERE id = %s", (fatura_id,))
+            conn.commit()
+            return {"sucesso": True}
     except Exception as e:
-        if 'conn' in locals(): conn.rollback()
         return {"sucesso": False}
     finally:
         if 'cursor' in locals(): cursor.close()
-        if 'conn' in locals(): conn.close()
 @app.get("/super-admin/faturas")
 def listar_faturas():
     try:
-        conn = banco_dados.conectar()
-        cursor = conn.cursor()
-        # Puxa o nome da empresa e os dados da fatura
-        cursor.execute('''
-            SELECT f.id, e.nome_empresa, f.valor, f.data_vencimento, f.status 
-            FROM faturas_saas f
-            JOIN empresas e ON f.empresa_id = e.id
-            ORDER BY f.id DESC
-        ''')
-        faturas = cursor.fetchall()
-        return faturas
+        with banco_dados.obter_conexao() as conn:
+            cursor = conn.cursor()
+            # Puxa o nome da empresa e os dados da fatura
+            cursor.execute('''
+                SELECT f.id, e.nome_empresa, f.valor, f.data_vencimento, f.status 
+                FROM faturas_saas f
+                JOIN empresas e ON f.empresa_id = e.id
+                ORDER BY f.id DESC
+            ''')
+            faturas = cursor.fetchall()
+            return faturas
     except Exception as e:
         return []
     finally:
         if 'cursor' in locals(): cursor.close()
-        if 'conn' in locals(): conn.close()
 
 @app.put("/super-admin/faturas/{fatura_id}/pagar")
 def aprovar_pagamento(fatura_id: int):
     try:
-        conn = banco_dados.conectar()
-        cursor = conn.cursor()
-        # Muda o status para Pago
-        cursor.execute("UPDATE faturas_saas SET status = 'Pago' WHERE id = %s", (fatura_id,))
-        conn.commit()
-        return {"sucesso": True}
+        with banco_dados.obter_conexao() as conn:
+            cursor = conn.cursor()
+            # Muda o status para Pago
+            cursor.execute("UPDATE faturas_saas SET status = 'Pago' WHERE id = %s", (fatura_id,))
+            conn.commit()
+            return {"sucesso": True}
     except Exception as e:
-        if 'conn' in locals(): conn.rollback()
         return {"sucesso": False}
     finally:
         if 'cursor' in locals(): cursor.close()
-        if 'conn' in locals(): conn.close()
 
 @app.get("/logo_main.svg")
 def get_logo_main():
@@ -943,52 +1127,51 @@ async def pagina_demo():
         if not resultado.get("sucesso"):
             print("[DEMO] Fallback: criando usuário diretamente...")
             # Buscar diretamente no banco ou criar via SQL
-            conexao = banco_dados.get_conexao()
-            cursor = conexao.cursor()
-            try:
-                cursor.execute("SELECT id FROM empresas WHERE ruc = %s", ('9999999-9',))
-                row = cursor.fetchone()
-                if row:
-                    empresa_id = row[0]
-                    rol = 'admin'
-                    plano = 'Demo'
-                    print(f"[DEMO] Usuário encontrado diretamente no banco: ID {empresa_id}")
-                    resultado = {"sucesso": True, "empresa_id": empresa_id, "rol": rol, "plano": plano}
-                else:
-                    # Criar empresa diretamente
-                    from datetime import date, timedelta
-                    vencimento = date.today() + timedelta(days=365)
-                    cursor.execute('''
-                        INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                        RETURNING id
-                    ''', ('Usuário Público Demo', '9999999-9', 'demo123', 'demo123', 'Demo', 'Activo', vencimento, 0))
-                    empresa_id = cursor.fetchone()[0]
+            with banco_dados.obter_conexao() as conexao:
+                cursor = conexao.cursor()
+                try:
+                    cursor.execute("SELECT id FROM empresas WHERE ruc = %s", ('9999999-9',))
+                    row = cursor.fetchone()
+                    if row:
+                        empresa_id = row[0]
+                        rol = 'admin'
+                        plano = 'Demo'
+                        print(f"[DEMO] Usuário encontrado diretamente no banco: ID {empresa_id}")
+                        resultado = {"sucesso": True, "empresa_id": empresa_id, "rol": rol, "plano": plano}
+                    else:
+                        # Criar empresa diretamente
+                        from datetime import date, timedelta
+                        vencimento = date.today() + timedelta(days=365)
+                        cursor.execute('''
+                            INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                            RETURNING id
+                        ''', ('Usuário Público Demo', '9999999-9', 'demo123', 'demo123', 'Demo', 'Activo', vencimento, 0))
+                        empresa_id = cursor.fetchone()[0]
                     
-                    # Criar categoria
-                    cursor.execute("INSERT INTO categorias (empresa_id, nome) VALUES (%s, %s) ON CONFLICT DO NOTHING", (empresa_id, 'General'))
+                        # Criar categoria
+                        cursor.execute("INSERT INTO categorias (empresa_id, nome) VALUES (%s, %s) ON CONFLICT DO NOTHING", (empresa_id, 'General'))
                     
-                    # Criar produtos
-                    produtos = [
-                        ('ARR-001', 'Arroz Premium 1kg', 'General', '', 10000, 12500, 45, ''),
-                        ('ACE-002', 'Aceite Girasol 900ml', 'General', '', 15000, 18500, 28, ''),
-                        ('AZU-003', 'Azúcar Refinado 1kg', 'General', '', 7000, 8500, 62, '')
-                    ]
-                    for cod, desc, cat, subcat, custo, venda, qtd, prov in produtos:
-                        cursor.execute('''
-                            INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                            ON CONFLICT DO NOTHING
-                        ''', (empresa_id, cod, desc, cat, subcat, custo, venda, qtd, prov))
+                        # Criar produtos
+                        produtos = [
+                            ('ARR-001', 'Arroz Premium 1kg', 'General', '', 10000, 12500, 45, ''),
+                            ('ACE-002', 'Aceite Girasol 900ml', 'General', '', 15000, 18500, 28, ''),
+                            ('AZU-003', 'Azúcar Refinado 1kg', 'General', '', 7000, 8500, 62, '')
+                        ]
+                        for cod, desc, cat, subcat, custo, venda, qtd, prov in produtos:
+                            cursor.execute('''
+                                INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                                ON CONFLICT DO NOTHING
+                            ''', (empresa_id, cod, desc, cat, subcat, custo, venda, qtd, prov))
                     
-                    conexao.commit()
-                    rol = 'admin'
-                    plano = 'Demo'
-                    resultado = {"sucesso": True, "empresa_id": empresa_id, "rol": rol, "plano": plano}
-                    print(f"[DEMO] Usuário criado diretamente no banco: ID {empresa_id}")
-            finally:
-                cursor.close()
-                conexao.close()
+                        conexao.commit()
+                        rol = 'admin'
+                        plano = 'Demo'
+                        resultado = {"sucesso": True, "empresa_id": empresa_id, "rol": rol, "plano": plano}
+                        print(f"[DEMO] Usuário criado diretamente no banco: ID {empresa_id}")
+                finally:
+                    cursor.close()
         
         # 4. Verificar se a autenticação foi bem-sucedida
         if not resultado.get("sucesso"):
@@ -1012,6 +1195,8 @@ async def pagina_demo():
             )
         
         plano_primeira = str(plano).split(' ')[0]
+        # Com SESSAO_OBRIGATORIA as chamadas do app sem token voltam 401, igual ao /api/login
+        token = emitir_token(empresa_id, rol, resultado.get("funcionario_id"))
         
         print(f"[DEMO] Autenticação bem-sucedida: empresa_id={empresa_id}, rol={rol}, plano={plano}")
         
@@ -1024,6 +1209,7 @@ async def pagina_demo():
     <script>
         // Injeção automática de credenciais demo (execução imediata)
         empresaAtualId = {empresa_id};
+        tokenSessao = '{token}';
         rolUsuario = '{rol}';
         planoAtivo = '{plano}';
         
@@ -1083,260 +1269,254 @@ def reset_demo():
     import random
     from datetime import datetime, date, timedelta
     
-    conexao = None
-    cursor = None
     try:
-        conexao = banco_dados.get_conexao()
-        cursor = conexao.cursor()
+        with banco_dados.obter_conexao() as conexao:
+            cursor = conexao.cursor()
         
-        # 1. Find or create demo enterprise
-        cursor.execute("SELECT id FROM empresas WHERE ruc = %s", ('9999999-9',))
-        existing = cursor.fetchone()
+            # 1. Find or create demo enterprise
+            cursor.execute("SELECT id FROM empresas WHERE ruc = %s", ('9999999-9',))
+            existing = cursor.fetchone()
         
-        if existing:
-            empresa_id = existing[0]
-            print(f"[RESET DEMO] Enterprise found (ID: {empresa_id})")
-        else:
-            # Create enterprise
-            vencimento = date.today() + timedelta(days=365)
-            cursor.execute('''
-                INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                RETURNING id
-            ''', ('Usuário Público Demo', '9999999-9', 'demo123', 'demo123', 'Demo', 'Activo', vencimento, 0))
-            empresa_id = cursor.fetchone()[0]
-            print(f"[RESET DEMO] Enterprise created (ID: {empresa_id})")
+            if existing:
+                empresa_id = existing[0]
+                print(f"[RESET DEMO] Enterprise found (ID: {empresa_id})")
+            else:
+                # Create enterprise
+                vencimento = date.today() + timedelta(days=365)
+                cursor.execute('''
+                    INSERT INTO empresas (nome_empresa, ruc, senha_admin, senha_caixa, plano, status_assinatura, data_vencimento, valor_mensalidade)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', ('Usuário Público Demo', '9999999-9', 'demo123', 'demo123', 'Demo', 'Activo', vencimento, 0))
+                empresa_id = cursor.fetchone()[0]
+                print(f"[RESET DEMO] Enterprise created (ID: {empresa_id})")
         
-        # 2. FORCE DELETE ALL DATA FOR THIS ENTERPRISE (except categories and providers that might be shared)
-        print(f"[RESET DEMO] Deleting existing sales and products for enterprise {empresa_id}...")
-        cursor.execute("DELETE FROM notas WHERE empresa_id = %s", (empresa_id,))
-        notas_deleted = cursor.rowcount
-        cursor.execute("DELETE FROM produtos WHERE empresa_id = %s", (empresa_id,))
-        produtos_deleted = cursor.rowcount
-        # Do NOT delete categories and providers; they might be shared or have constraints
-        categorias_deleted = 0
-        provedores_deleted = 0
+            # 2. FORCE DELETE ALL DATA FOR THIS ENTERPRISE (except categories and providers that might be shared)
+            print(f"[RESET DEMO] Deleting existing sales and products for enterprise {empresa_id}...")
+            cursor.execute("DELETE FROM notas WHERE empresa_id = %s", (empresa_id,))
+            notas_deleted = cursor.rowcount
+            cursor.execute("DELETE FROM produtos WHERE empresa_id = %s", (empresa_id,))
+            produtos_deleted = cursor.rowcount
+            # Do NOT delete categories and providers; they might be shared or have constraints
+            categorias_deleted = 0
+            provedores_deleted = 0
         
-        # 3. Ensure categories exist (use ON CONFLICT to avoid duplicate key errors)
-        categorias_list = ['General', 'Bebidas', 'Lácteos', 'Limpeza', 'Enlatados', 'Panadería', 'Carnes']
-        categories_created = 0
-        for cat in categorias_list:
-            # Try to insert, if conflict (name already exists), do nothing
-            cursor.execute('''
-                INSERT INTO categorias (empresa_id, nome)
-                VALUES (%s, %s)
-                ON CONFLICT (nome) DO NOTHING
-            ''', (empresa_id, cat))
-            categories_created += cursor.rowcount
-        print(f"[RESET DEMO] Categories ensured: {categories_created} new, {len(categorias_list)-categories_created} already exist.")
+            # 3. Ensure categories exist (use ON CONFLICT to avoid duplicate key errors)
+            categorias_list = ['General', 'Bebidas', 'Lácteos', 'Limpeza', 'Enlatados', 'Panadería', 'Carnes']
+            categories_created = 0
+            for cat in categorias_list:
+                # Try to insert, if conflict (name already exists), do nothing
+                cursor.execute('''
+                    INSERT INTO categorias (empresa_id, nome)
+                    VALUES (%s, %s)
+                    ON CONFLICT (nome) DO NOTHING
+                ''', (empresa_id, cat))
+                categories_created += cursor.rowcount
+            print(f"[RESET DEMO] Categories ensured: {categories_created} new, {len(categorias_list)-categories_created} already exist.")
         
-        # 4. Insert providers with ON CONFLICT
-        provedores = [
-            ('Distribuidora Central S.A.', '80012345-1', '021 234 567', 'ventas@distcentral.com.py', 'Av. Eusebio Ayala km 4.5, Asunción'),
-            ('Importadora del Este S.R.L.', '80023456-2', '021 345 678', 'contacto@importeste.com.py', 'Av. España 1234, Ciudad del Este'),
-            ('Proveedores del Sur S.A.', '80034567-3', '021 456 789', 'info@proveedorsur.com.py', 'Av. San Martín 567, Encarnación'),
-            ('Alimentos Norte S.A.', '80045678-4', '021 567 890', 'ventas@alimentosnorte.com.py', 'Av. Perú 789, Concepción'),
-            ('Mayorista Py S.R.L.', '80056789-5', '021 678 901', 'pedidos@mayoristapy.com.py', 'Av. Brasília 456, Pedro Juan Caballero')
-        ]
-        providers_created = 0
-        for nome, ruc, telefone, email, endereco in provedores:
-            cursor.execute('''
-                INSERT INTO proveedores (empresa_id, nome, ruc, telefone, email, endereco)
-                VALUES (%s, %s, %s, %s, %s, %s)
-                ON CONFLICT (empresa_id, ruc) DO NOTHING
-            ''', (empresa_id, nome, ruc, telefone, email, endereco))
-            providers_created += cursor.rowcount
-        print(f"[RESET DEMO] Providers ensured: {providers_created} new, {len(provedores)-providers_created} already exist.")
+            # 4. Insert providers with ON CONFLICT
+            provedores = [
+                ('Distribuidora Central S.A.', '80012345-1', '021 234 567', 'ventas@distcentral.com.py', 'Av. Eusebio Ayala km 4.5, Asunción'),
+                ('Importadora del Este S.R.L.', '80023456-2', '021 345 678', 'contacto@importeste.com.py', 'Av. España 1234, Ciudad del Este'),
+                ('Proveedores del Sur S.A.', '80034567-3', '021 456 789', 'info@proveedorsur.com.py', 'Av. San Martín 567, Encarnación'),
+                ('Alimentos Norte S.A.', '80045678-4', '021 567 890', 'ventas@alimentosnorte.com.py', 'Av. Perú 789, Concepción'),
+                ('Mayorista Py S.R.L.', '80056789-5', '021 678 901', 'pedidos@mayoristapy.com.py', 'Av. Brasília 456, Pedro Juan Caballero')
+            ]
+            providers_created = 0
+            for nome, ruc, telefone, email, endereco in provedores:
+                cursor.execute('''
+                    INSERT INTO proveedores (empresa_id, nome, ruc, telefone, email, endereco)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (empresa_id, ruc) DO NOTHING
+                ''', (empresa_id, nome, ruc, telefone, email, endereco))
+                providers_created += cursor.rowcount
+            print(f"[RESET DEMO] Providers ensured: {providers_created} new, {len(provedores)-providers_created} already exist.")
         
-        # 5. Insert 20 products
-        produtos = [
-            ('ARR-001', 'Arroz Premium 1kg', 'General', '', 10000, 12500, 45),
-            ('ACE-002', 'Aceite Girasol 900ml', 'General', '', 15000, 18500, 28),
-            ('AZU-003', 'Azúcar Refinado 1kg', 'General', '', 7000, 8500, 62),
-            ('COC-004', 'Coca-Cola 2L', 'Bebidas', 'Gaseosas', 8000, 10500, 36),
-            ('SPR-005', 'Sprite 1.5L', 'Bebidas', 'Gaseosas', 7500, 9800, 42),
-            ('CER-006', 'Cerveza Pilsen 1L', 'Bebidas', 'Alcohólicas', 12000, 15800, 24),
-            ('LEH-007', 'Leche Entera 1L', 'Lácteos', '', 6000, 8500, 58),
-            ('YOU-008', 'Yogur Natural 1kg', 'Lácteos', '', 8500, 11500, 32),
-            ('QUE-009', 'Queso Paraguay 500g', 'Lácteos', '', 22000, 28500, 18),
-            ('JAB-010', 'Jabón en Polvo 3kg', 'Limpeza', '', 25000, 32500, 22),
-            ('DET-011', 'Detergente Líquido 1L', 'Limpeza', '', 12000, 16500, 40),
-            ('PAP-012', 'Papel Higiénico 4un', 'Limpeza', '', 15000, 19500, 55),
-            ('ATA-013', 'Atún en Lata 200g', 'Enlatados', '', 7500, 9800, 30),
-            ('MAI-014', 'Maíz en Lata 400g', 'Enlatados', '', 6500, 8200, 38),
-            ('PAN-015', 'Pan Francês un', 'Panadería', '', 1500, 2500, 120),
-            ('RES-016', 'Carne Res 1kg', 'Carnes', '', 35000, 45500, 15),
-            ('POL-017', 'Pollo Entero 1.5kg', 'Carnes', '', 22000, 29500, 20),
-            ('JAM-018', 'Jamón Cocido 200g', 'Carnes', '', 12500, 16800, 25),
-            ('GAL-019', 'Galletas María 500g', 'Panadería', '', 4500, 6500, 48),
-            ('CAF-020', 'Café Molido 500g', 'Bebidas', '', 18000, 23500, 16)
-        ]
-        for cod, desc, cat, subcat, custo, venda, qtd in produtos:
-            cursor.execute('''
-                INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, '')
-            ''', (empresa_id, cod, desc, cat, subcat, custo, venda, qtd))
+            # 5. Insert 20 products
+            produtos = [
+                ('ARR-001', 'Arroz Premium 1kg', 'General', '', 10000, 12500, 45),
+                ('ACE-002', 'Aceite Girasol 900ml', 'General', '', 15000, 18500, 28),
+                ('AZU-003', 'Azúcar Refinado 1kg', 'General', '', 7000, 8500, 62),
+                ('COC-004', 'Coca-Cola 2L', 'Bebidas', 'Gaseosas', 8000, 10500, 36),
+                ('SPR-005', 'Sprite 1.5L', 'Bebidas', 'Gaseosas', 7500, 9800, 42),
+                ('CER-006', 'Cerveza Pilsen 1L', 'Bebidas', 'Alcohólicas', 12000, 15800, 24),
+                ('LEH-007', 'Leche Entera 1L', 'Lácteos', '', 6000, 8500, 58),
+                ('YOU-008', 'Yogur Natural 1kg', 'Lácteos', '', 8500, 11500, 32),
+                ('QUE-009', 'Queso Paraguay 500g', 'Lácteos', '', 22000, 28500, 18),
+                ('JAB-010', 'Jabón en Polvo 3kg', 'Limpeza', '', 25000, 32500, 22),
+                ('DET-011', 'Detergente Líquido 1L', 'Limpeza', '', 12000, 16500, 40),
+                ('PAP-012', 'Papel Higiénico 4un', 'Limpeza', '', 15000, 19500, 55),
+                ('ATA-013', 'Atún en Lata 200g', 'Enlatados', '', 7500, 9800, 30),
+                ('MAI-014', 'Maíz en Lata 400g', 'Enlatados', '', 6500, 8200, 38),
+                ('PAN-015', 'Pan Francês un', 'Panadería', '', 1500, 2500, 120),
+                ('RES-016', 'Carne Res 1kg', 'Carnes', '', 35000, 45500, 15),
+                ('POL-017', 'Pollo Entero 1.5kg', 'Carnes', '', 22000, 29500, 20),
+                ('JAM-018', 'Jamón Cocido 200g', 'Carnes', '', 12500, 16800, 25),
+                ('GAL-019', 'Galletas María 500g', 'Panadería', '', 4500, 6500, 48),
+                ('CAF-020', 'Café Molido 500g', 'Bebidas', '', 18000, 23500, 16)
+            ]
+            for cod, desc, cat, subcat, custo, venda, qtd in produtos:
+                cursor.execute('''
+                    INSERT INTO produtos (empresa_id, codigo_barras, descricao, categoria, subcategoria, preco_custo, preco_venda, quantidade, codigo_proveedor)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, '')
+                ''', (empresa_id, cod, desc, cat, subcat, custo, venda, qtd))
         
-        # 5.5 Ensure open cash session and get its ID
-        cursor.execute("SELECT id FROM caixa_sessoes WHERE empresa_id = %s AND status = 'ABERTO'", (empresa_id,))
-        caixa_row = cursor.fetchone()
-        if not caixa_row:
-            cursor.execute('''
-                INSERT INTO caixa_sessoes (empresa_id, data_abertura, valor_abertura, status)
-                VALUES (%s, CURRENT_TIMESTAMP, 500000, 'ABERTO')
-                RETURNING id
-            ''', (empresa_id,))
-            caixa_id = cursor.fetchone()[0]
-        else:
-            caixa_id = caixa_row[0]
-        print(f"[RESET DEMO] Using cash session ID: {caixa_id}")
+            # 5.5 Ensure open cash session and get its ID
+            cursor.execute("SELECT id FROM caixa_sessoes WHERE empresa_id = %s AND status = 'ABERTO'", (empresa_id,))
+            caixa_row = cursor.fetchone()
+            if not caixa_row:
+                cursor.execute('''
+                    INSERT INTO caixa_sessoes (empresa_id, data_abertura, valor_abertura, status)
+                    VALUES (%s, CURRENT_TIMESTAMP, 500000, 'ABERTO')
+                    RETURNING id
+                ''', (empresa_id,))
+                caixa_id = cursor.fetchone()[0]
+            else:
+                caixa_id = caixa_row[0]
+            print(f"[RESET DEMO] Using cash session ID: {caixa_id}")
         
-        # 6. Generate 25 sales in the last 30 days
-        metodos_pago = ['Efectivo', 'Tarjeta', 'Transferencia', 'Efectivo', 'Tarjeta']
-        clientes = [
-            ('Consumidor Final', '80012345-1'),
-            ('Juan Pérez', '1234567-8'),
-            ('María González', '2345678-9'),
-            ('Carlos López', '3456789-0'),
-            ('Ana Martínez', '4567890-1'),
-            ('Luis Rodríguez', '5678901-2'),
-            ('Supermercado Central', '80098765-4'),
-            ('Restaurante El Buen Sabor', '80087654-3')
-        ]
+            # 6. Generate 25 sales in the last 30 days
+            metodos_pago = ['Efectivo', 'Tarjeta', 'Transferencia', 'Efectivo', 'Tarjeta']
+            clientes = [
+                ('Consumidor Final', '80012345-1'),
+                ('Juan Pérez', '1234567-8'),
+                ('María González', '2345678-9'),
+                ('Carlos López', '3456789-0'),
+                ('Ana Martínez', '4567890-1'),
+                ('Luis Rodríguez', '5678901-2'),
+                ('Supermercado Central', '80098765-4'),
+                ('Restaurante El Buen Sabor', '80087654-3')
+            ]
         
-        hoje = datetime.now()
-        for i in range(25):
-            if i < 5:
-                dias_atras = 0  # Today - for dashboard
-            else:
-                dias_atras = random.randint(1, 30)
-            horas_atras = random.randint(0, 23)
-            minutos_atras = random.randint(0, 59)
-            data_venda = hoje - timedelta(days=dias_atras, hours=horas_atras, minutes=minutos_atras)
+            hoje = datetime.now()
+            for i in range(25):
+                if i < 5:
+                    dias_atras = 0  # Today - for dashboard
+                else:
+                    dias_atras = random.randint(1, 30)
+                horas_atras = random.randint(0, 23)
+                minutos_atras = random.randint(0, 59)
+                data_venda = hoje - timedelta(days=dias_atras, hours=horas_atras, minutes=minutos_atras)
             
-            nome_cliente, ruc_cliente = random.choice(clientes)
-            num_itens = random.randint(1, 4)
-            itens_selecionados = random.sample(produtos[:15], num_itens)
+                nome_cliente, ruc_cliente = random.choice(clientes)
+                num_itens = random.randint(1, 4)
+                itens_selecionados = random.sample(produtos[:15], num_itens)
             
-            itens_json = []
-            valor_total = 0
+                itens_json = []
+                valor_total = 0
             
-            for prod in itens_selecionados:
-                codigo, descricao, categoria, subcat, custo, venda, estoque = prod
-                quantidade = random.randint(1, 3)
-                subtotal = venda * quantidade
-                valor_total += subtotal
+                for prod in itens_selecionados:
+                    codigo, descricao, categoria, subcat, custo, venda, estoque = prod
+                    quantidade = random.randint(1, 3)
+                    subtotal = venda * quantidade
+                    valor_total += subtotal
                 
-                itens_json.append({
-                    'codigo_barras': codigo,
-                    'codigo': codigo,
-                    'descricao': descricao,
-                    'quantidade': quantidade,
-                    'preco_unitario': venda,
-                    'preco_custo': custo,
-                    'subtotal': subtotal
-                })
+                    itens_json.append({
+                        'codigo_barras': codigo,
+                        'codigo': codigo,
+                        'descricao': descricao,
+                        'quantidade': quantidade,
+                        'preco_unitario': venda,
+                        'preco_custo': custo,
+                        'subtotal': subtotal
+                    })
             
-            cdc = f'9999999-9-{data_venda.strftime("%Y%m%d")}-{i:06d}'
-            metodo = random.choice(metodos_pago)
+                cdc = f'9999999-9-{data_venda.strftime("%Y%m%d")}-{i:06d}'
+                metodo = random.choice(metodos_pago)
             
-            cursor.execute('''
-                INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, cdc, itens, data_emissao, metodo_pago, caixa_id)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ''', (
-                empresa_id,
-                '9999999-9',
-                nome_cliente,
-                valor_total,
-                cdc,
-                json.dumps(itens_json),
-                data_venda,
-                metodo,
-                caixa_id
-            ))
+                cursor.execute('''
+                    INSERT INTO notas (empresa_id, ruc_emissor, nome_cliente, valor_total, cdc, itens, data_emissao, metodo_pago, caixa_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (
+                    empresa_id,
+                    '9999999-9',
+                    nome_cliente,
+                    valor_total,
+                    cdc,
+                    json.dumps(itens_json),
+                    data_venda,
+                    metodo,
+                    caixa_id
+                ))
+                banco_dados.inserir_itens_nota(cursor, cursor.fetchone()[0], itens_json)
+            banco_dados.recalcular_resumo_vendas(cursor, empresa_id)
         
 
         
-        conexao.commit()
+            conexao.commit()
         
-        # Inject cash withdrawals (sangrias) for the demo
-        motivos_sangria = ["Pago a proveedor", "Gastos operativos", "Retiro de efectivo"]
-        for _ in range(3):
-            valor_sangria = random.randint(150000, 300000)
-            motivo = random.choice(motivos_sangria)
-            cursor.execute('''
-                INSERT INTO caixa_movimentacoes (empresa_id, caixa_id, tipo, valor, motivo, data)
-                VALUES (%s, %s, 'SANGRIA', %s, %s, %s)
-            ''', (empresa_id, caixa_id, valor_sangria, motivo, hoje - timedelta(days=random.randint(0, 30))))
+            # Inject cash withdrawals (sangrias) for the demo
+            motivos_sangria = ["Pago a proveedor", "Gastos operativos", "Retiro de efectivo"]
+            for _ in range(3):
+                valor_sangria = random.randint(150000, 300000)
+                motivo = random.choice(motivos_sangria)
+                cursor.execute('''
+                    INSERT INTO caixa_movimentacoes (empresa_id, caixa_id, tipo, valor, motivo, data)
+                    VALUES (%s, %s, 'SANGRIA', %s, %s, %s)
+                ''', (empresa_id, caixa_id, valor_sangria, motivo, hoje - timedelta(days=random.randint(0, 30))))
         
-        # Inject 3 stock take audits for demo (spread over last 30 days)
-        for _ in range(3):
-            data_auditoria = (hoje - timedelta(days=random.randint(1, 30))).date()
-            cursor.execute('''
-                INSERT INTO auditorias (empresa_id, data, impacto_financeiro, total_itens)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-            ''', (empresa_id, data_auditoria, 0, 0))
-            auditoria_id = cursor.fetchone()[0]
-            
-            # Pick 3-5 random products for this audit
-            produtos_auditoria = random.sample(produtos[:12], random.randint(3, 5))
-            impacto_total = 0
-            total_itens = 0
-            for prod in produtos_auditoria:
-                codigo, descricao, categoria, subcat, custo, venda, estoque = prod
-                # Ensure there is a variance (non-zero difference)
-                diferenca = random.choice([-2, -1, 1, 2])
-                qtd_sistema = estoque
-                qtd_fisica = qtd_sistema + diferenca
-                custo_unitario = custo
-                impacto = diferenca * custo_unitario
-                impacto_total += impacto
-                total_itens += 1
+            # Inject 3 stock take audits for demo (spread over last 30 days)
+            for _ in range(3):
+                data_auditoria = (hoje - timedelta(days=random.randint(1, 30))).date()
                 cursor.execute('''
-                    INSERT INTO auditorias_itens (auditoria_id, codigo_barras, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                ''', (auditoria_id, codigo, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario))
+                    INSERT INTO auditorias (empresa_id, data, impacto_financeiro, total_itens)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING id
+                ''', (empresa_id, data_auditoria, 0, 0))
+                auditoria_id = cursor.fetchone()[0]
             
-            # Update audit total
-            cursor.execute('''
-                UPDATE auditorias SET impacto_financeiro = %s, total_itens = %s WHERE id = %s
-            ''', (impacto_total, total_itens, auditoria_id))
+                # Pick 3-5 random products for this audit
+                produtos_auditoria = random.sample(produtos[:12], random.randint(3, 5))
+                impacto_total = 0
+                total_itens = 0
+                for prod in produtos_auditoria:
+                    codigo, descricao, categoria, subcat, custo, venda, estoque = prod
+                    # Ensure there is a variance (non-zero difference)
+                    diferenca = random.choice([-2, -1, 1, 2])
+                    qtd_sistema = estoque
+                    qtd_fisica = qtd_sistema + diferenca
+                    custo_unitario = custo
+                    impacto = diferenca * custo_unitario
+                    impacto_total += impacto
+                    total_itens += 1
+                    cursor.execute('''
+                        INSERT INTO auditorias_itens (auditoria_id, codigo_barras, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario)
+                        VALUES (%s, %s, %s, %s, %s, %s, %s)
+                    ''', (auditoria_id, codigo, descricao, qtd_sistema, qtd_fisica, diferenca, custo_unitario))
+            
+                # Update audit total
+                cursor.execute('''
+                    UPDATE auditorias SET impacto_financeiro = %s, total_itens = %s WHERE id = %s
+                ''', (impacto_total, total_itens, auditoria_id))
         
-        conexao.commit()
+            conexao.commit()
         
-        return {
-            "status": "Success",
-            "message": "Showroom built",
-            "enterprise_id": empresa_id,
-            "deleted": {
-                "notas": notas_deleted,
-                "produtos": produtos_deleted,
-                "categorias": categorias_deleted,
-                "provedores": provedores_deleted
-            },
-            "created": {
-                "categorias": categories_created,
-                "categorias_total": len(categorias_list),
-                "provedores": providers_created,
-                "provedores_total": len(provedores),
-                "produtos": len(produtos),
-                "vendas": 25
+            return {
+                "status": "Success",
+                "message": "Showroom built",
+                "enterprise_id": empresa_id,
+                "deleted": {
+                    "notas": notas_deleted,
+                    "produtos": produtos_deleted,
+                    "categorias": categorias_deleted,
+                    "provedores": provedores_deleted
+                },
+                "created": {
+                    "categorias": categories_created,
+                    "categorias_total": len(categorias_list),
+                    "provedores": providers_created,
+                    "provedores_total": len(provedores),
+                    "produtos": len(produtos),
+                    "vendas": 25
+                }
             }
-        }
         
     except Exception as e:
         # Return exact error
         error_msg = str(e)
         print(f"[RESET DEMO ERROR] {error_msg}")
-        if conexao:
-            conexao.rollback()
         return {
             "status": "Error",
             "message": error_msg
-        }
-    finally:
-        if cursor:
-            cursor.close()
-        if conexao:
-            conexao.close()
\ No newline at end of file
+        }
\ No newline at end of file
@@ -0,0 +1,65 @@
+import os
+import threading
+
+import banco_dados
+
+# Números reservados por ida ao banco. Com 1 (padrão) a numeração não tem buracos, mas toda venda
+# passa pela linha da sequência. Blocos maiores aliviam essa linha ao custo de buracos que na SIFEN
+# exigem inutilização: a sobra é devolvida no shutdown, mas só se ninguém reservou depois, e um
+# processo morto sem shutdown perde o bloco.
+SEQ_BLOCO = int(os.environ.get("SEQ_BLOCO", "1"))
+
+# Tipos de documento da SIFEN (iTiDE / prefixo do CDC)
+TIPO_FACTURA = "01"
+TIPO_NOTA_CREDITO = "05"
+
+
+class AlocadorNumeracao:
+    """Entrega números de documento a partir de blocos reservados em sequencias_documentos."""
+
+    def __init__(self, tamanho_bloco=SEQ_BLOCO):
+        self.tamanho_bloco = max(1, tamanho_bloco)
+        self._blocos = {}  # (empresa_id, estab, pex, tipo_doc) -> [proximo, fim_exclusivo]
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _lock_da_chave(self, chave):
+        with self._lock:
+            return self._locks.setdefault(chave, threading.Lock())
+
+    def proximo_numero(self, empresa_id, estab="001", pex="001", tipo_doc=TIPO_FACTURA):
+        chave = (empresa_id, estab, pex, tipo_doc)
+        # Lock por sequência: caixas de outras empresas não esperam a reserva de um bloco novo
+        with self._lock_da_chave(chave):
+            bloco = self._blocos.get(chave)
+            if bloco is None or bloco[0] >= bloco[1]:
+                inicio = banco_dados.reservar_bloco_numeracao(empresa_id, estab, pex, tipo_doc, self.tamanho_bloco)
+                bloco = [inicio, inicio + self.tamanho_bloco]
+                self._blocos[chave] = bloco
+            numero = bloco[0]
+            bloco[0] += 1
+            return numero
+
+    def devolver_sobras(self):
+        """Devolve ao banco o que sobrou de cada bloco (chamado no shutdown)."""
+        with self._lock:
+            chaves = list(self._blocos)
+        for chave in chaves:
+            with self._lock_da_chave(chave):
+                bloco = self._blocos.pop(chave, None)
+                if bloco and bloco[0] < bloco[1]:
+                    try:
+                        banco_dados.devolver_sobra_numeracao(*chave, bloco[0], bloco[1])
+                    except Exception as e:
+                        print(f"[NUMERACAO] Falha ao devolver números {bloco[0]}-{bloco[1] - 1} de {chave}: {e}")
+
+
+_alocador = AlocadorNumeracao()
+
+
+def proximo_numero_documento(empresa_id, estab="001", pex="001", tipo_doc=TIPO_FACTURA):
+    return _alocador.proximo_numero(empresa_id, estab, pex, tipo_doc)
+
+
+def devolver_sobras_numeracao():
+    _alocador.devolver_sobras()
@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import pool as pg_pool
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# Tamanho e comportamento do pool (configurável por variáveis de ambiente)
+POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+# O ThreadedConnectionPool fecha na devolução toda conexão acima do mínimo; com mínimo = máximo
+# as conexões ficam abertas e o pool não reconecta a cada pico de carga
+POOL_MIN = int(os.environ.get("DB_POOL_MIN", str(POOL_MAX)))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "10"))
+# Conexões ociosas há mais tempo que isto passam por um "SELECT 1" antes de serem entregues
+POOL_HEALTHCHECK_OCIOSO = float(os.environ.get("DB_POOL_HEALTHCHECK_S", "30"))
+
+
+class PoolEsgotado(Exception):
+    """Nenhuma conexão ficou livre dentro do tempo limite."""
+
+
+class PoolConexoes:
+    """Pool de conexões psycopg2 por processo, com espera limitada, health check e métricas."""
+
+    def __init__(self, dsn, minimo=POOL_MIN, maximo=POOL_MAX, timeout=POOL_TIMEOUT,
+                 healthcheck_ocioso=POOL_HEALTHCHECK_OCIOSO):
+        self.dsn = dsn
+        minimo = min(minimo, maximo)
+        self.minimo = minimo
+        self.maximo = maximo
+        self.timeout = timeout
+        self.healthcheck_ocioso = healthcheck_ocioso
+        self._pool = pg_pool.ThreadedConnectionPool(minimo, maximo, dsn)
+        # O ThreadedConnectionPool falha na hora quando esgota; o semáforo faz a requisição esperar
+        self._vagas = threading.BoundedSemaphore(maximo)
+        self._lock = threading.Lock()
+        self._devolvida_em = {}
+        self._em_uso = 0
+        self._pico_em_uso = 0
+        self._checkouts = 0
+        self._esperas = 0
+        self._esgotamentos = 0
+        self._descartadas = 0
+        self._espera_total = 0.0
+        self._espera_max = 0.0
+
+    def _conexao_saudavel(self, conexao):
+        if conexao.closed:
+            return False
+        ociosa_desde = self._devolvida_em.get(id(conexao))
+        if ociosa_desde is not None and time.monotonic() - ociosa_desde < self.healthcheck_ocioso:
+            return True
+        try:
+            cursor = conexao.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            conexao.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def obter(self):
+        inicio = time.monotonic()
+        if not self._vagas.acquire(blocking=False):
+            with self._lock:
+                self._esperas += 1
+            if not self._vagas.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._esgotamentos += 1
+                raise PoolEsgotado(f"Pool de conexões esgotado ({self.maximo} em uso)")
+        try:
+            conexao = self._pool.getconn()
+            while not self._conexao_saudavel(conexao):
+                self._devolvida_em.pop(id(conexao), None)
+                self._pool.putconn(conexao, close=True)
+                with self._lock:
+                    self._descartadas += 1
+                conexao = self._pool.getconn()
+        except Exception:
+            self._vagas.release()
+            raise
+        espera = time.monotonic() - inicio
+        with self._lock:
+            self._checkouts += 1
+            self._em_uso += 1
+            self._pico_em_uso = max(self._pico_em_uso, self._em_uso)
+            self._espera_total += espera
+            self._espera_max = max(self._espera_max, espera)
+        return conexao
+
+    def devolver(self, conexao, descartar=False):
+        try:
+            if not descartar and not conexao.closed:
+                try:
+                    # Nada pendente pode vazar para o próximo usuário da conexão
+                    conexao.rollback()
+                except psycopg2.Error:
+                    descartar = True
+            descartar = descartar or bool(conexao.closed)
+            self._pool.putconn(conexao, close=descartar)
+            # O putconn também fecha conexões excedentes ao mínimo; o id de uma conexão fechada
+            # pode ser reutilizado por outra e herdar um carimbo de ociosidade que não é dela
+            if conexao.closed:
+                self._devolvida_em.pop(id(conexao), None)
+            else:
+                self._devolvida_em[id(conexao)] = time.monotonic()
+        finally:
+            with self._lock:
+                self._em_uso -= 1
+                if descartar:
+                    self._descartadas += 1
+            self._vagas.release()
+
+    def metricas(self):
+        with self._lock:
+            checkouts = self._checkouts
+            return {
+                "minimo": self.minimo,
+                "maximo": self.maximo,
+                "em_uso": self._em_uso,
+                "pico_em_uso": self._pico_em_uso,
+                "saturacao": round(self._em_uso / self.maximo, 3),
+                "checkouts": checkouts,
+                "esperas": self._esperas,
+                "esgotamentos": self._esgotamentos,
+                "descartadas": self._descartadas,
+                "espera_media_ms": round(self._espera_total / checkouts * 1000, 3) if checkouts else 0,
+                "espera_max_ms": round(self._espera_max * 1000, 3),
+            }
+
+    def fechar(self):
+        self._pool.closeall()
+        self._devolvida_em.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def obter_pool():
+    """Cria o pool do processo na primeira utilização."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = PoolConexoes(DATABASE_URL)
+    return _pool
+
+
+@contextmanager
+def obter_conexao():
+    """
+    Empresta uma conexão do pool durante o bloco `with`.
+    Commits continuam explícitos; o que não foi commitado é desfeito na devolução.
+    Conexões que falharam a nível de rede são descartadas em vez de voltarem ao pool.
+    """
+    pool = obter_pool()
+    conexao = pool.obter()
+    descartar = False
+    try:
+        yield conexao
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        descartar = True
+        raise
+    finally:
+        pool.devolver(conexao, descartar=descartar)
+
+
+def metricas_pool():
+    if _pool is None:
+        return {"inicializado": False}
+    return {"inicializado": True, **_pool.metricas()}
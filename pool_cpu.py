@@ -0,0 +1,120 @@
+import os
+import time
+import asyncio
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# Processos para o trabalho pesado de CPU (assinatura RSA, renderização de PDF).
+# Fora do processo do uvicorn o GIL não serializa as vendas; 0 desliga e tudo roda no próprio processo.
+CPU_PROCESSOS = int(os.environ.get("CPU_PROCESSOS", str(os.cpu_count() or 1)))
+# Tarefas aguardando/rodando no pool antes de recusar trabalho novo (503 no lugar de fila infinita)
+CPU_FILA_MAX = int(os.environ.get("CPU_FILA_MAX", str(max(CPU_PROCESSOS, 1) * 8)))
+
+
+def _contexto_processos():
+    """
+    fork copia o processo com os locks das outras threads (pool do banco, fila SIFEN) possivelmente
+    presos; os filhos nascem do forkserver (ou spawn, onde ele não existe) sem herdar esse estado.
+    """
+    metodo = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(metodo)
+
+
+class PoolCpuOcupado(Exception):
+    """A fila do pool de CPU está cheia."""
+
+
+class PoolCpu:
+    """ProcessPoolExecutor com limite de fila e métricas, compartilhado por assinatura e PDFs."""
+
+    def __init__(self, processos=CPU_PROCESSOS, fila_max=CPU_FILA_MAX):
+        self.processos = processos
+        self.fila_max = fila_max
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pendentes = 0
+        self._pico_pendentes = 0
+        self._concluidas = 0
+        self._recusadas = 0
+        self._erros = 0
+        self._tempo_total = 0.0
+
+    @property
+    def ativo(self):
+        return self.processos > 0
+
+    def _obter_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.processos, mp_context=_contexto_processos())
+        return self._executor
+
+    def iniciar(self):
+        """Sobe o executor no startup, antes das threads de fundo, em vez de na primeira venda."""
+        if not self.ativo:
+            return
+        with self._lock:
+            self._obter_executor()
+
+    def submeter(self, funcao, *args):
+        """Future (concurrent.futures) da tarefa; `funcao` e os argumentos precisam ser serializáveis por pickle."""
+        with self._lock:
+            if self._pendentes >= self.fila_max:
+                self._recusadas += 1
+                raise PoolCpuOcupado(f"{self._pendentes} tareas en cola")
+            self._pendentes += 1
+            self._pico_pendentes = max(self._pico_pendentes, self._pendentes)
+            executor = self._obter_executor()
+        inicio = time.monotonic()
+        try:
+            futuro = executor.submit(funcao, *args)
+        except Exception:
+            with self._lock:
+                self._pendentes -= 1
+            raise
+
+        def _concluida(f):
+            with self._lock:
+                self._pendentes -= 1
+                self._concluidas += 1
+                self._tempo_total += time.monotonic() - inicio
+                if f.exception() is not None:
+                    self._erros += 1
+        futuro.add_done_callback(_concluida)
+        return futuro
+
+    def executar(self, funcao, *args):
+        """Para código síncrono: a thread espera sem segurar o GIL enquanto o processo trabalha."""
+        if not self.ativo:
+            return funcao(*args)
+        return self.submeter(funcao, *args).result()
+
+    async def executar_async(self, funcao, *args):
+        """Para endpoints async: o event loop segue atendendo enquanto o processo trabalha."""
+        if not self.ativo:
+            return await asyncio.to_thread(funcao, *args)
+        return await asyncio.wrap_future(self.submeter(funcao, *args))
+
+    def metricas(self):
+        with self._lock:
+            concluidas = self._concluidas
+            return {
+                "processos": self.processos,
+                "fila_max": self.fila_max,
+                "pendentes": self._pendentes,
+                "pico_pendentes": self._pico_pendentes,
+                "ocupacao": round(self._pendentes / self.fila_max, 3) if self.fila_max else 0,
+                "concluidas": concluidas,
+                "erros": self._erros,
+                "recusadas": self._recusadas,
+                "tempo_medio_ms": round(self._tempo_total / concluidas * 1000, 3) if concluidas else 0,
+            }
+
+    def fechar(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+pool_cpu = PoolCpu()
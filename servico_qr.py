@@ -0,0 +1,31 @@
+import os
+import io
+from functools import lru_cache
+
+import qrcode
+
+# Quantos QR (PNG) ficam em memória; cada um tem poucos KB
+QR_CACHE_MAX = int(os.environ.get("QR_CACHE_MAX", "2048"))
+
+
+def url_consulta_sifen(cdc, ambiente="produccion"):
+    if ambiente == "produccion":
+        return f"https://ekuatia.set.gov.py/consultas/qr?nId={cdc}"
+    return f"https://sifen-test.set.gov.py/consultas/qr?nId={cdc}"
+
+
+@lru_cache(maxsize=QR_CACHE_MAX)
+def gerar_qr_png(conteudo):
+    """PNG do QR de `conteudo`, gerado em memória. bytes é imutável, então o cache pode ser compartilhado."""
+    qr = qrcode.QRCode(version=1, box_size=10, border=4)
+    qr.add_data(conteudo)
+    qr.make(fit=True)
+    img = qr.make_image(fill_color="black", back_color="white")
+    memoria = io.BytesIO()
+    img.save(memoria, format="PNG")
+    return memoria.getvalue()
+
+
+def gerar_qr_varios(conteudos):
+    """Reimpressão em massa: {conteudo: png}, gerando cada QR repetido uma vez só."""
+    return {c: gerar_qr_png(c) for c in dict.fromkeys(conteudos)}
@@ -0,0 +1,88 @@
+import os
+import hmac
+import json
+import time
+import base64
+import hashlib
+import secrets
+
+# Validade do token de sessão emitido no login
+SESSAO_TTL = float(os.environ.get("SESSAO_TTL_H", "12")) * 3600
+# Requisições com X-Empresa-ID e sem token válido são recusadas (401). SESSAO_OBRIGATORIA=0 só
+# enquanto houver caixas abertos com a versão antiga do app.js, que ainda não manda o token
+SESSAO_OBRIGATORIA = os.environ.get("SESSAO_OBRIGATORIA", "1") != "0"
+# Todos os workers precisam da mesma chave; sem a variável ela é criada uma vez neste arquivo
+SESSAO_SEGREDO_ARQUIVO = os.environ.get("SESSAO_SEGREDO_ARQUIVO", ".sessao_segredo")
+
+
+def _carregar_segredo():
+    segredo = os.environ.get("SESSAO_SEGREDO")
+    if segredo:
+        return segredo.encode()
+    try:
+        # O_EXCL: se dois workers sobem juntos, só um cria; o outro lê o que foi criado
+        fd = os.open(SESSAO_SEGREDO_ARQUIVO, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+    for _ in range(50):
+        with open(SESSAO_SEGREDO_ARQUIVO) as f:
+            conteudo = f.read().strip()
+        if conteudo:
+            return conteudo.encode()
+        time.sleep(0.01)
+    raise RuntimeError(f"{SESSAO_SEGREDO_ARQUIVO} vacío")
+
+
+_segredo = _carregar_segredo()
+
+
+def _b64(dados):
+    return base64.urlsafe_b64encode(dados).rstrip(b"=").decode()
+
+
+def _de_b64(texto):
+    return base64.urlsafe_b64decode(texto + "=" * (-len(texto) % 4))
+
+
+def _assinatura(corpo):
+    return _b64(hmac.new(_segredo, corpo.encode(), hashlib.sha256).digest())
+
+
+def emitir_token(empresa_id, rol, funcionario_id=None):
+    """
+    Token "<payload>.<hmac>" com empresa e perfil; nada fica guardado no servidor.
+    O plano não vai no token: ele muda sem novo login e é lido de cache_empresas.
+    """
+    payload = {"e": empresa_id, "r": rol, "exp": int(time.time() + SESSAO_TTL)}
+    if funcionario_id: payload["f"] = funcionario_id
+    corpo = _b64(json.dumps(payload, separators=(",", ":")).encode())
+    return f"{corpo}.{_assinatura(corpo)}"
+
+
+def verificar_token(token):
+    """
+    Dados da sessão ({"empresa_id", "rol", "funcionario_id"}) ou None se o token
+    for inválido ou vencido. Só HMAC e JSON: nenhuma consulta ao banco.
+    """
+    # Tokens emitidos aqui são base64url; fora do ASCII o compare_digest com str levantaria TypeError
+    if not token or not token.isascii() or token.count(".") != 1: return None
+    corpo, assinatura = token.split(".")
+    if not hmac.compare_digest(_assinatura(corpo).encode(), assinatura.encode()): return None
+    try:
+        payload = json.loads(_de_b64(corpo))
+    except ValueError:
+        return None
+    if payload.get("exp", 0) < time.time(): return None
+    return {"empresa_id": payload["e"], "rol": payload["r"], "funcionario_id": payload.get("f")}
+
+
+def assinar_link(*partes):
+    """Assinatura de um link público (ex.: PDF compartilhado por WhatsApp), sem validade."""
+    return _assinatura("link:" + ":".join(str(p) for p in partes))
+
+
+def link_valido(assinatura, *partes):
+    if not assinatura or not assinatura.isascii(): return False
+    return hmac.compare_digest(assinar_link(*partes).encode(), assinatura.encode())
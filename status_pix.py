@@ -0,0 +1,94 @@
+import os
+import hmac
+import json
+import time
+import asyncio
+import hashlib
+
+import mercadopago
+
+import banco_dados
+
+# URL pública deste servidor (https). Com ela cada cobrança leva notification_url e o Mercado Pago
+# avisa o webhook; sem ela o stream de status consulta o MP a cada PIX_CONSULTA_MP_S como plano B.
+URL_PUBLICA = os.environ.get("URL_PUBLICA", "").rstrip("/")
+# Chave secreta das notificações (painel do Mercado Pago); vazia desliga a verificação da assinatura
+MP_WEBHOOK_SECRET = os.environ.get("MP_WEBHOOK_SECRET", "")
+# De quanto em quanto tempo o stream relê a tabela local e quanto tempo uma conexão dura
+PIX_SSE_INTERVALO = float(os.environ.get("PIX_SSE_INTERVALO_S", "1"))
+PIX_SSE_MAX = float(os.environ.get("PIX_SSE_MAX_S", "600"))
+PIX_CONSULTA_MP = float(os.environ.get("PIX_CONSULTA_MP_S", "15"))
+
+STATUS_FINAIS = ("approved", "rejected", "cancelled", "refunded", "charged_back")
+
+
+def url_notificacao(empresa_id):
+    if not URL_PUBLICA: return None
+    return f"{URL_PUBLICA}/webhook/mercadopago/{empresa_id}"
+
+
+def consultar_pagamento_mp(empresa_id, pagamento_id):
+    """Lê o status oficial no Mercado Pago e grava na tabela local. Retorna o status."""
+    config = banco_dados.obter_configuracao(empresa_id) or {}
+    token_mp = config.get("mercado_pago_token", "")
+    if not token_mp:
+        raise ValueError("Token MP não configurado")
+    resultado = mercadopago.SDK(token_mp).payment().get(pagamento_id)
+    pagamento = resultado.get("response") or {}
+    if resultado.get("status") != 200:
+        # Num 404/401 o corpo de erro também tem "status" (o código HTTP); não é status de pagamento
+        raise ValueError(f"Mercado Pago respondió {resultado.get('status')}: {pagamento.get('message', '')}")
+    status = pagamento.get("status", "pending")
+    banco_dados.atualizar_status_pix(empresa_id, pagamento_id, status)
+    return status
+
+
+def assinatura_valida(x_signature, x_request_id, data_id):
+    """
+    Confere o cabeçalho x-signature ("ts=...,v1=...") do Mercado Pago.
+    Mesmo sem segredo configurado o status nunca vem da notificação: ele é relido no MP.
+    """
+    if not MP_WEBHOOK_SECRET: return True
+    if not x_signature: return False
+    partes = dict(p.strip().split("=", 1) for p in x_signature.split(",") if "=" in p)
+    ts, v1 = partes.get("ts"), partes.get("v1")
+    if not ts or not v1: return False
+    manifesto = f"id:{str(data_id).lower()};request-id:{x_request_id or ''};ts:{ts};"
+    esperado = hmac.new(MP_WEBHOOK_SECRET.encode(), manifesto.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(esperado, v1)
+
+
+def _evento(dados):
+    return f"data: {json.dumps(dados)}\n\n"
+
+
+async def eventos_status(empresa_id, pagamento_id):
+    """
+    Server-Sent Events com o status do pagamento, lido da tabela local (qualquer worker do
+    uvicorn enxerga o que o webhook gravou). Termina no primeiro status final ou após PIX_SSE_MAX;
+    o EventSource do navegador reconecta sozinho.
+    """
+    inicio = time.monotonic()
+    ultima_consulta_mp = inicio
+    ultimo = None
+    ultimo_envio = inicio
+    while time.monotonic() - inicio < PIX_SSE_MAX:
+        registro = await asyncio.to_thread(banco_dados.obter_status_pix, empresa_id, pagamento_id)
+        status = registro["status"] if registro else "pending"
+        if not URL_PUBLICA and status not in STATUS_FINAIS and time.monotonic() - ultima_consulta_mp >= PIX_CONSULTA_MP:
+            # Sem webhook configurado: uma consulta ao MP por stream a cada PIX_CONSULTA_MP_S
+            ultima_consulta_mp = time.monotonic()
+            try:
+                status = await asyncio.to_thread(consultar_pagamento_mp, empresa_id, pagamento_id)
+            except Exception as e:
+                print(f"[PIX] Falha ao consultar pagamento {pagamento_id}: {e}")
+        if status != ultimo:
+            yield _evento({"status": status})
+            ultimo, ultimo_envio = status, time.monotonic()
+        elif time.monotonic() - ultimo_envio >= 15:
+            # Comentário SSE: mantém a conexão viva atrás de proxies
+            yield ": ping\n\n"
+            ultimo_envio = time.monotonic()
+        if status in STATUS_FINAIS:
+            return
+        await asyncio.sleep(PIX_SSE_INTERVALO)